@@ -6,11 +6,19 @@ from shared import shared
 
 # -- General
 import os
+import time
+import asyncio
+import socket
+import threading
 import sqlite3
-import duckdb
+import psycopg2
 from sqlparse import split as sql_split
 import json
-from shutil import move
+import hashlib
+import numpy as np
+from shutil import move, copyfile, rmtree
+from contextlib import closing
+import pandas as pd
 import toml
 from urllib.request import urlretrieve
 from tempfile import TemporaryDirectory
@@ -19,10 +27,18 @@ import nest_asyncio
 nest_asyncio.apply()
 
 # -- Llamaindex
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext
+from llama_index.core import (
+    VectorStoreIndex,
+    SimpleDirectoryReader,
+    StorageContext,
+    PromptTemplate,
+)
 from llama_index.core.extractors import TitleExtractor, KeywordExtractor
-from llama_index.vector_stores.duckdb import DuckDBVectorStore
-from llama_index.vector_stores.postgres import PGVectorStore
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import TextNode, MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from pydantic import BaseModel
 
 # -- Shiny
 from shiny.express import ui
@@ -44,6 +60,34 @@ else:
         os.path.normpath(config["localStorage"]["storageFolder"]), ""
     )
 
+# Files are added to the vector database by background workers (ingestion_worker.py)
+jobsDB = os.path.normpath(config["ingestion"]["jobsDB"])
+jobsFolder = os.path.normpath(config["ingestion"]["jobsFolder"])
+ingestionWorkers = config["ingestion"]["workers"]
+pollInterval = config["ingestion"]["pollInterval"]
+jobStatus = {0: "Queued", 1: "Running", 2: "Done", 3: "Failed"}
+ingestionStages = ["queued", "store", "parse", "extract", "index", "summarise", "done"]
+# Files and chunks that were processed before are looked up by their content hash
+cacheDB = os.path.normpath(config["ingestion"]["cacheDB"])
+cachedMetadata = ["document_title", "excerpt_keywords"]
+# Requests per job that run at the same time (OpenAI calls are mostly waiting)
+extractWorkers = config["ingestion"]["extractWorkers"]
+embedWorkers = config["ingestion"]["embedWorkers"]
+embedBatchSize = config["ingestion"]["embedBatchSize"]
+# Rate limited requests are retried with exponential back-off
+ingestionLLM = shared.getLLM("ingestion", max_retries=config["ingestion"]["maxRetries"])
+embedRetries = config["ingestion"]["maxRetries"]
+
+
+# Structured output of the file summary
+class FileSummary(BaseModel):
+    """Short title, subtitle and top-10 keywords of a document"""
+
+    title: str
+    subtitle: str
+    keywords: list[str]
+
+
 # ----------- FUNCTIONS -----------
 # *********************************
 
@@ -53,6 +97,15 @@ def createLocalAccornsDB(
     DBpath=shared.sqliteDB, sqlFile=os.path.join(appDBDir, "appDB_sqlite_accorns.sql")
 ):
     if os.path.exists(DBpath):
+        # Table added after the first version
+        with closing(sqlite3.connect(DBpath)) as conn:
+            _ = conn.execute(
+                'CREATE TABLE IF NOT EXISTS "topic_file" ("tID" INTEGER, "fID" INTEGER, '
+                '"uID" INTEGER, "added" TEXT, PRIMARY KEY("tID", "fID"), '
+                'FOREIGN KEY("tID") REFERENCES "topic"("tID") '
+                "ON DELETE CASCADE ON UPDATE CASCADE)"
+            )
+            conn.commit()
         return (1, "Accorns database already exists. Skipping")
 
     # Create a new database from the SQL file
@@ -74,7 +127,7 @@ def createLocalAccornsDB(
 def createLocalVectorDB(
     DBpath=shared.vectorDB, sqlFile=os.path.join(appDBDir, "appDB_duckdb_vectordb.sql")
 ):
-    conn = duckdb.connect(DBpath)
+    conn = shared.duckdbConnect(DBpath)
     cursor = conn.cursor()
     # Check if the documents, file and keyword tables exist
     cursor.execute(
@@ -82,8 +135,10 @@ def createLocalVectorDB(
     )
     # Check there are three tables
     if cursor.fetchone()[0] == 3:
+        msg = migrateLocalVectorDB(cursor)
+        cursor.commit()
         conn.close()
-        return (1, "Vector database already exists. Skipping")
+        return (1, f"Vector database already exists. {msg}")
 
     with open(sqlFile, "r") as file:
         query = sql_split(file.read())
@@ -91,25 +146,567 @@ def createLocalVectorDB(
         for x in query:
             _ = cursor.execute(x)
 
+    # New vector databases use the configured embedding model
+    createCorpusVersion(cursor, (shared.embedModelName, shared.embedDim))
+    cursor.execute(
+        'ALTER TABLE "documents" ALTER "embedding" '
+        f"SET DATA TYPE FLOAT[{shared.embedDim}]"
+    )
+    _ = createLocalVectorIndex(cursor)
     cursor.commit()
     conn.close()
 
     return (0, "Local DuckDB vector database created")
 
 
-# Create vector database and add files
-def addFileToDB(
-    newFile,
-    shinyToken,
-    vectorDB,
-    remoteAppDB=shared.remoteAppDB,
-    storageFolder=None,
-    newFileName=None,
+# Update a vector database created by an older version: the embedding column needs
+# a fixed size for the HNSW index and the file_name / fID columns were added
+def migrateLocalVectorDB(cursor):
+    cursor.execute(
+        "SELECT column_name, data_type FROM duckdb_columns() "
+        "WHERE table_name = 'documents'"
+    )
+    columns = dict(cursor.fetchall())
+    createCorpusVersion(cursor)
+    cursor.execute('SELECT "embedDim" FROM "corpus"')
+    embedding = f"FLOAT[{cursor.fetchone()[0]}]"
+
+    # Tables with an index can't be altered
+    if columns["embedding"] != embedding or "file_name" not in columns:
+        cursor.execute('DROP INDEX IF EXISTS "documents_embedding"')
+
+    if columns["embedding"] != embedding:
+        cursor.execute(
+            f'ALTER TABLE "documents" ALTER "embedding" SET DATA TYPE {embedding}'
+        )
+
+    if "file_name" not in columns:
+        cursor.execute('ALTER TABLE "documents" ADD COLUMN "file_name" VARCHAR')
+        cursor.execute('ALTER TABLE "documents" ADD COLUMN "fID" INTEGER')
+        cursor.execute(
+            'UPDATE "documents" SET "file_name" = '
+            "json_extract_string(metadata_, '$.file_name')"
+        )
+        cursor.execute(
+            'UPDATE "documents" SET "fID" = f."fID" FROM "file" f '
+            'WHERE "documents"."file_name" = f."fileName"'
+        )
+
+    return createLocalVectorIndex(cursor)[1]
+
+
+# Create the corpus table (version and embedding model) of a vector database created
+# by an older version, or fill in the embedding model of a new one
+def createCorpusVersion(cursor, embedding=shared.legacyEmbedding, remoteAppDB=False):
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS "corpus" ("version" INTEGER, "modified" TEXT, '
+        '"embedModel" TEXT, "embedDim" INTEGER)'
+    )
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = 'corpus'"
+    )
+    columns = [x[0] for x in cursor.fetchall()]
+    if "embedModel" not in columns:
+        cursor.execute('ALTER TABLE "corpus" ADD COLUMN "embedModel" TEXT')
+        cursor.execute('ALTER TABLE "corpus" ADD COLUMN "embedDim" INTEGER')
+
+    cursor.execute(
+        'INSERT INTO "corpus" SELECT 0, NULL, NULL, NULL '
+        'WHERE NOT EXISTS (SELECT 1 FROM "corpus")'
+    )
+    shared.executeQuery(
+        cursor,
+        'UPDATE "corpus" SET "embedModel" = ?, "embedDim" = ? WHERE "embedModel" IS NULL',
+        embedding,
+        remoteAppDB=remoteAppDB,
+    )
+
+
+# Create the indexes of a local vector database (if needed): HNSW on the embeddings
+# and regular indexes for looking up the chunks of a file
+def createLocalVectorIndex(conn, table="documents"):
+    for column in ["file_name", "fID"]:
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "{table}_{column}" ON "{table}"("{column}")'
+        )
+
+    exists = conn.execute(
+        "SELECT count(*) FROM duckdb_indexes() WHERE index_name = ?",
+        (f"{table}_embedding",),
+    ).fetchone()[0]
+    if exists:
+        return (1, "HNSW index already exists")
+
+    conn.execute(
+        f'CREATE INDEX "{table}_embedding" ON "{table}" USING HNSW ("embedding") '
+        f"WITH (metric = 'cosine', M = {shared.hnswM}, ef_construction = {shared.hnswEfConstruction})"
+    )
+    return (0, "HNSW index created")
+
+
+# Query to create the pgvector index on the embeddings of the postgres vector database.
+# IVFFlat clusters are based on the current rows, so rebuild it after adding many files
+def remoteVectorIndexQuery(cursor, name, concurrently=False, table="data_document"):
+    if shared.pgVectorIndex == "hnsw":
+        method = "hnsw"
+        params = (
+            f"m = {shared.pgHnswM}, ef_construction = {shared.pgHnswEfConstruction}"
+        )
+    else:
+        method = "ivfflat"
+        lists = shared.pgIvfflatLists
+        if lists == 0:
+            cursor.execute(f"SELECT count(*) FROM {table}")
+            rows = cursor.fetchone()[0]
+            lists = max(10, rows // 1000 if rows <= 1e6 else int(rows**0.5))
+        params = f"lists = {lists}"
+
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} ON {table} "
+        f"USING {method} (embedding vector_cosine_ops) WITH ({params})"
+    )
+
+
+# Create the index on the embeddings of the postgres vector database (if needed).
+# The data_document table is created by llama-index when the first file is added
+def createRemoteVectorIndex(cursor):
+    cursor.execute("SELECT to_regclass('data_document')")
+    if cursor.fetchone()[0] is None:
+        return (1, "The vector database has no documents yet")
+
+    cursor.execute(
+        "SELECT count(*) FROM pg_indexes WHERE indexname = 'data_document_embedding'"
+    )
+    if cursor.fetchone()[0]:
+        return (1, "Vector index already exists")
+
+    cursor.execute(remoteVectorIndexQuery(cursor, "data_document_embedding"))
+    return (0, f"{shared.pgVectorIndex.upper()} index created")
+
+
+# Tables added to the remote accorns database by later versions. The accorns role
+# needs the CREATE privilege on the public schema, otherwise the statements are
+# returned to run as the postgres admin
+def migrateRemoteAccornsDB():
+    statements = [
+        'CREATE TABLE IF NOT EXISTS "topic_file" ("tID" INTEGER, "fID" INTEGER, '
+        '"uID" INTEGER, "added" TEXT, PRIMARY KEY("tID", "fID"), '
+        'FOREIGN KEY("tID") REFERENCES "topic"("tID") '
+        "ON DELETE CASCADE ON UPDATE CASCADE)",
+        'GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE "topic_file" TO scuirrel',
+    ]
+    with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT to_regclass('topic_file')")
+        if cursor.fetchone()[0] is not None:
+            return (1, "Accorns database is up to date")
+
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            conn.commit()
+        except psycopg2.errors.InsufficientPrivilege:
+            conn.rollback()
+            return (
+                0,
+                "The topic_file table is missing and the accorns user can't create "
+                "it. Run the following as the postgres admin on the accorns "
+                "database:\n" + ";\n".join(statements) + ";",
+            )
+    return (1, "Added the topic_file table to the accorns database")
+
+
+# The data_document table is created by llama-index when the first file is added.
+# Add the file_name and fID columns (generated from the metadata, so they are filled
+# in on insert), index them and create the index on the embeddings (if needed)
+def migrateRemoteVectorDB():
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT to_regclass('corpus'), to_regclass('data_document')")
+        corpus, documents = cursor.fetchone()
+        # New vector databases use the configured embedding model
+        createCorpusVersion(
+            cursor,
+            shared.legacyEmbedding
+            if documents
+            else (shared.embedModelName, shared.embedDim),
+            remoteAppDB=True,
+        )
+        if corpus is None:
+            cursor.execute('GRANT SELECT ON TABLE "corpus" TO scuirrel')
+        conn.commit()
+
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'data_document'"
+        )
+        columns = [x[0] for x in cursor.fetchall()]
+        if not columns:
+            return (1, "The vector database has no documents yet")
+
+        if "file_name" not in columns:
+            cursor.execute(
+                "ALTER TABLE data_document ADD COLUMN file_name TEXT "
+                "GENERATED ALWAYS AS (metadata_ ->> 'file_name') STORED"
+            )
+        if "fID" not in columns:
+            # Chunks added by an older version have no fID in their metadata
+            cursor.execute(
+                "UPDATE data_document d SET metadata_ = "
+                """(d.metadata_::jsonb || jsonb_build_object('fID', f."fID"))::json """
+                """FROM "file" f WHERE d.file_name = f."fileName" """
+                "AND d.metadata_ ->> 'fID' IS NULL"
+            )
+            cursor.execute(
+                'ALTER TABLE data_document ADD COLUMN "fID" INTEGER '
+                "GENERATED ALWAYS AS ((metadata_ ->> 'fID')::integer) STORED"
+            )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS data_document_file_name "
+            "ON data_document (file_name)"
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS data_document_fid ON data_document ("fID")'
+        )
+        msg = createRemoteVectorIndex(cursor)[1]
+        conn.commit()
+
+    return (0, f"Vector database up to date. {msg}")
+
+
+# Rebuilding the index and re-embedding run one at a time in the app. The message
+# reports the progress of the running task to all admins (Files tab)
+vectorTask = {"lock": threading.Lock(), "message": None, "progress": None}
+
+
+# Run rebuildVectorIndex or reembedVectorDB, unless one of them is already running
+def runVectorTask(function, message, **kwargs):
+    if not vectorTask["lock"].acquire(blocking=False):
+        return (0, "The vector index is already being rebuilt or re-embedded")
+    vectorTask["message"] = message
+    try:
+        return function(**kwargs)
+    finally:
+        vectorTask["message"] = None
+        vectorTask["progress"] = None
+        vectorTask["lock"].release()
+
+
+# Progress function for reembedVectorDB
+def vectorTaskProgress(message):
+    vectorTask["progress"] = message
+
+
+# Rebuild the index on the embeddings with the current settings (e.g. after adding
+# many files). In postgres the new index is built next to the old one, so searching
+# keeps working while it is being built
+def rebuildVectorIndex(remoteAppDB=shared.remoteAppDB, vectorDB=shared.vectorDB):
+    if not remoteAppDB:
+        with shared.vectorDBConn(None, remoteAppDB=False, vectorDB=vectorDB) as conn:
+            conn.begin()
+            conn.execute('DROP INDEX IF EXISTS "documents_embedding"')
+            _ = createLocalVectorIndex(conn)
+            conn.commit()
+        return (0, "HNSW index rebuilt")
+
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        # Indexes can only be built concurrently outside a transaction
+        conn.set_session(autocommit=True)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT to_regclass('data_document')")
+            if cursor.fetchone()[0] is None:
+                return (1, "The vector database has no documents yet")
+
+            # An index left by an interrupted rebuild is invalid, so start over
+            cursor.execute("DROP INDEX IF EXISTS data_document_embedding_new")
+            cursor.execute(
+                remoteVectorIndexQuery(
+                    cursor, "data_document_embedding_new", concurrently=True
+                )
+            )
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS data_document_embedding")
+            cursor.execute(
+                "ALTER INDEX data_document_embedding_new RENAME TO data_document_embedding"
+            )
+        finally:
+            conn.set_session(autocommit=False)
+
+    return (0, f"{shared.pgVectorIndex.upper()} index rebuilt")
+
+
+# Number of chunks in the vector database, the embedding model, the index on the
+# embeddings and its settings
+def vectorIndexInfo(remoteAppDB=shared.remoteAppDB, vectorDB=shared.vectorDB):
+    embedding = shared.corpusEmbedding(shared.postgresAccorns, remoteAppDB, vectorDB)
+    if not remoteAppDB:
+        with shared.vectorDBConn(None, remoteAppDB=False, vectorDB=vectorDB) as conn:
+            chunks = conn.execute('SELECT count(*) FROM "documents"').fetchone()[0]
+            index = conn.execute(
+                "SELECT count(*) FROM duckdb_indexes() "
+                "WHERE index_name = 'documents_embedding'"
+            ).fetchone()[0]
+        return {
+            "embedding": embedding,
+            "index": "HNSW" if index else None,
+            "settings": f"M = {shared.hnswM}, ef_construction = "
+            f"{shared.hnswEfConstruction}, ef_search = {shared.hnswEfSearch}",
+            "chunks": chunks,
+            "size": None,
+        }
+
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT to_regclass('data_document') IS NOT NULL, "
+            "to_regclass('data_document_embedding') IS NOT NULL"
+        )
+        table, index = cursor.fetchone()
+        chunks, size = 0, None
+        if table:
+            cursor.execute("SELECT count(*) FROM data_document")
+            chunks = cursor.fetchone()[0]
+        if index:
+            cursor.execute(
+                "SELECT pg_size_pretty(pg_relation_size('data_document_embedding'))"
+            )
+            size = cursor.fetchone()[0]
+
+    return {
+        "embedding": embedding,
+        "index": shared.pgVectorIndex.upper() if index else None,
+        "settings": (
+            f"m = {shared.pgHnswM}, ef_construction = {shared.pgHnswEfConstruction}, "
+            f"ef_search = {shared.pgHnswEfSearch}"
+            if shared.pgVectorIndex == "hnsw"
+            else f"lists = {shared.pgIvfflatLists or 'auto'}, "
+            f"probes = {shared.pgIvfflatProbes}"
+        ),
+        "chunks": chunks,
+        "size": size,
+    }
+
+
+# Re-embed all chunks with the configured embedding model. The new embeddings are
+# added to a shadow table while SCUIRREL keeps using the current one, after which the
+# tables are switched in a single transaction. Chunks added or deleted meanwhile are
+# caught up during the switch. The progress function is called with a message
+def reembedVectorDB(
+    remoteAppDB=shared.remoteAppDB, vectorDB=shared.vectorDB, progress=None
 ):
-    # In case the file is a URL download it first
-    isURL = False
+    progress = progress if progress else lambda message: None
+    embedding = (shared.embedModelName, shared.embedDim)
+    current = shared.corpusEmbedding(shared.postgresAccorns, remoteAppDB, vectorDB)
+    if current == embedding:
+        return (1, f"The vector database already uses {embeddingName(embedding)}")
+
+    table = "data_document" if remoteAppDB else "documents"
+    shadow = f"{table}_shadow"
+    with shared.vectorDBConn(
+        shared.postgresAccorns, remoteAppDB=remoteAppDB, vectorDB=vectorDB
+    ) as conn:
+        # DuckDB cursors are separate connections, so use the connection itself
+        cursor = conn.cursor() if remoteAppDB else conn
+        cursor.execute(f'DROP TABLE IF EXISTS "{shadow}"')
+        if remoteAppDB:
+            cursor.execute("SELECT to_regclass('data_document')")
+            if cursor.fetchone()[0] is not None:
+                cursor.execute(
+                    f"CREATE TABLE {shadow} "
+                    "(LIKE data_document INCLUDING DEFAULTS INCLUDING GENERATED)"
+                )
+                cursor.execute(
+                    f"ALTER TABLE {shadow} ALTER COLUMN embedding "
+                    f"TYPE vector({embedding[1]})"
+                )
+            else:
+                # llama-index creates the table with the new embedding length
+                shadow = None
+        else:
+            cursor.execute(
+                f'CREATE TABLE "{shadow}" ("node_id" VARCHAR, "text" VARCHAR, '
+                f'"embedding" FLOAT[{embedding[1]}], "metadata_" JSON, '
+                '"file_name" VARCHAR, "fID" INTEGER)'
+            )
+        conn.commit()
+
+    # The connection is released while a batch is embedded, so other processes can
+    # use the vector database (the DuckDB file is locked while it is open)
+    done = 0
+    while shadow is not None:
+        with shared.vectorDBConn(
+            shared.postgresAccorns, remoteAppDB=remoteAppDB, vectorDB=vectorDB
+        ) as conn:
+            rows = pendingChunks(
+                conn.cursor() if remoteAppDB else conn, table, shadow, remoteAppDB
+            )
+        if not rows:
+            break
+        embeddings = embedChunks(rows, embedding, remoteAppDB)
+        with shared.vectorDBConn(
+            shared.postgresAccorns, remoteAppDB=remoteAppDB, vectorDB=vectorDB
+        ) as conn:
+            insertChunks(
+                conn.cursor() if remoteAppDB else conn,
+                shadow,
+                rows,
+                embeddings,
+                remoteAppDB,
+            )
+            conn.commit()
+        done += len(rows)
+        progress(f"Re-embedded {done} chunks")
+
+    with shared.vectorDBConn(
+        shared.postgresAccorns, remoteAppDB=remoteAppDB, vectorDB=vectorDB
+    ) as conn:
+        cursor = conn.cursor() if remoteAppDB else conn
+        if shadow is not None:
+            # Index the new embeddings before the switch
+            if remoteAppDB:
+                progress("Creating the vector index")
+                cursor.execute(f"ALTER TABLE {shadow} ADD PRIMARY KEY (id)")
+                cursor.execute(
+                    f"CREATE INDEX {shadow}_file_name ON {shadow} (file_name)"
+                )
+                cursor.execute(f'CREATE INDEX {shadow}_fid ON {shadow} ("fID")')
+                cursor.execute(
+                    remoteVectorIndexQuery(cursor, f"{shadow}_embedding", table=shadow)
+                )
+                conn.commit()
+
+            # Switch the tables, blocking new chunks (searching keeps working)
+            progress("Switching to the new embeddings")
+            if remoteAppDB:
+                cursor.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")
+            else:
+                conn.begin()
+            while copyChunks(cursor, table, shadow, embedding, remoteAppDB):
+                pass
+            cursor.execute(
+                f'DELETE FROM "{shadow}" WHERE "node_id" NOT IN '
+                f'(SELECT "node_id" FROM "{table}")'
+            )
+            if remoteAppDB:
+                # The sequence of the id column is dropped with the table otherwise
+                cursor.execute(f"SELECT pg_get_serial_sequence('{table}', 'id')")
+                sequence = cursor.fetchone()[0]
+                if sequence is not None:
+                    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {shadow}.id")
+                cursor.execute(f"DROP TABLE {table}")
+                cursor.execute(f"ALTER TABLE {shadow} RENAME TO {table}")
+                for index in ["pkey", "file_name", "fid", "embedding"]:
+                    cursor.execute(
+                        f"ALTER INDEX {shadow}_{index} RENAME TO {table}_{index}"
+                    )
+                cursor.execute(f"GRANT SELECT ON TABLE {table} TO scuirrel")
+            else:
+                cursor.execute(f'DROP TABLE "{table}"')
+                cursor.execute(f'ALTER TABLE "{shadow}" RENAME TO "{table}"')
+                _ = createLocalVectorIndex(cursor)
+
+        shared.executeQuery(
+            cursor,
+            'UPDATE "corpus" SET "embedModel" = ?, "embedDim" = ?',
+            embedding,
+            remoteAppDB=remoteAppDB,
+        )
+        shared.bumpCorpusVersion(cursor, remoteAppDB)
+        conn.commit()
+
+    shared.clearIndexCache()
+    return (0, f"The vector database now uses {embeddingName(embedding)}")
+
+
+# Select (a batch of) the chunks that are not in the shadow table yet
+def pendingChunks(cursor, table, shadow, remoteAppDB, batchSize=1000):
+    columns = (
+        ["text", "metadata_", "node_id", "id"]
+        if remoteAppDB
+        else ["text", "metadata_", "node_id", "file_name", "fID"]
+    )
+    cursor.execute(
+        f'SELECT {", ".join(f"t.{x}" for x in columns)} FROM "{table}" t '
+        f'WHERE NOT EXISTS (SELECT 1 FROM "{shadow}" s WHERE s.node_id = t.node_id) '
+        f"LIMIT {batchSize}"
+    )
+    return cursor.fetchall()
+
+
+# Embed the selected chunks (using the chunk cache), returns the embeddings in the
+# format of the vector database
+def embedChunks(rows, embedding, remoteAppDB):
+    nodes = [
+        metadata_dict_to_node(
+            x[1] if isinstance(x[1], dict) else json.loads(x[1]), x[0]
+        )
+        for x in rows
+    ]
+    newNodes = useChunkCache(nodes, embedding)
+    if newNodes:
+        asyncio.run(embedNodes(newNodes, embedding))
+        cacheChunks(newNodes, embedding)
+
+    if remoteAppDB:
+        return [str(x.embedding) for x in nodes]
+    return [x.embedding for x in nodes]
+
+
+# Add the re-embedded chunks to the shadow table
+def insertChunks(cursor, shadow, rows, embeddings, remoteAppDB):
+    if remoteAppDB:
+        query = (
+            f"INSERT INTO {shadow} (text, metadata_, node_id, id, embedding) "
+            "VALUES (?, ?, ?, ?, ?::vector)"
+        )
+    else:
+        query = (
+            f'INSERT INTO "{shadow}" ("text", "metadata_", "node_id", "file_name", '
+            '"fID", "embedding") VALUES (?, ?, ?, ?, ?, ?)'
+        )
+
+    shared.executeQuery(
+        cursor,
+        query,
+        [
+            (x[0], json.dumps(x[1]) if isinstance(x[1], dict) else x[1], *x[2:], e)
+            for x, e in zip(rows, embeddings)
+        ],
+        remoteAppDB=remoteAppDB,
+    )
+
+
+# Embed the chunks that are not in the shadow table yet and add them in one go (used
+# while the tables are switched). Returns the number of chunks added
+def copyChunks(cursor, table, shadow, embedding, remoteAppDB):
+    rows = pendingChunks(cursor, table, shadow, remoteAppDB)
+    if rows:
+        insertChunks(
+            cursor, shadow, rows, embedChunks(rows, embedding, remoteAppDB), remoteAppDB
+        )
+    return len(rows)
+
+
+# Check if a file name is already in file table of the vector database
+def registeredFile(fileName):
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        existingFile = shared.pandasQuery(
+            conn,
+            'SELECT "fileName" FROM "file" WHERE "fileName" = ?',
+            (fileName,),
+        )
+    return existingFile.shape[0] > 0
+
+
+# Download (URL) or move the new file to permanent storage (if requested) after
+# checking it was not added before. Returns the path, name and hash of the file and the
+# temporary directory of a download, or the result of addFileToDB if it can't be added
+def storeFile(newFile, newFileName, storageFolder, resume):
+    # In case the file is a URL download it first, the temporary directory is returned
+    # so it is kept until the file is parsed
+    tempDir = None
     if newFile.startswith("http://") or newFile.startswith("https://"):
-        isURL = True
         newFileName = os.path.basename(newFile)
         _, ext = os.path.splitext(newFile)
 
@@ -135,22 +732,23 @@ def addFileToDB(
     # Move the file to permanent storage if requested
     newFileName = os.path.basename(newFile) if newFileName is None else newFileName
 
-    # Check if the file name is already in file table of the vector database
-    conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-    existingFile = shared.pandasQuery(
-        conn,
-        'SELECT "fileName" FROM "file" WHERE "fileName" = ?',
-        (newFileName,),
-    )
-    conn.close()
+    # A resumed job might have crashed after the file was registered
+    existingFile = registeredFile(newFileName)
+    if existingFile and resume:
+        return (0, "Completed")
 
-    if existingFile.shape[0] > 0:
+    if existingFile:
         return (
             1,
             "A file with this name already exists. Please rename the file before uploading it again",
         )
 
-    if (storageFolder is not None) & (not isURL):
+    newFileHash = fileHash(newFile)
+    duplicate = duplicateFile(newFileHash)
+    if duplicate is not None:
+        return (3, f"This file was already added to the vector database as {duplicate}")
+
+    if (storageFolder is not None) & (tempDir is None):
         if not os.path.exists(storageFolder):
             os.makedirs(storageFolder)
 
@@ -158,84 +756,193 @@ def addFileToDB(
 
         move(newFile, newFilePath)
         newFile = newFilePath
-    elif not isURL:
+    elif tempDir is None:
         newFilePath = os.path.join(os.path.dirname(newFile), newFileName)
         move(newFile, newFilePath)
         newFile = newFilePath
 
-    newData = SimpleDirectoryReader(input_files=[newFile]).load_data()
+    return (newFile, newFileName, newFileHash, tempDir)
 
-    # Delete the file from URL if not set to be kept
-    if (storageFolder is None) & isURL:
-        os.remove(newFile)
 
-    if remoteAppDB:
-        vector_store = PGVectorStore.from_params(
-            host=shared.postgresHost,
-            port=shared.postgresPort,
-            user=shared.postgresAccorns,
-            password=os.environ.get("POSTGRES_PASS_ACCORNS"),
-            database="vector_db",
-            table_name="document",
-            embed_dim=1536,  # openai embedding dimension
-        )
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        index = VectorStoreIndex.from_documents(
-            newData,
-            storage_context=storage_context,
-            transformations=[TitleExtractor(), KeywordExtractor()],
+# Create vector database and add files. When a jobDir is provided, the extracted
+# nodes are saved there so a crashed job can resume without repeating the LLM calls.
+# The progress function is called with the name of each stage when it starts (and
+# with a message on the number of chunks processed per second)
+def addFileToDB(
+    newFile,
+    shinyToken,
+    vectorDB,
+    remoteAppDB=shared.remoteAppDB,
+    storageFolder=None,
+    newFileName=None,
+    jobDir=None,
+    progress=None,
+):
+    progress = progress if progress else lambda stage, message=None: None
+    rates = {}
+    nodesFile = os.path.join(jobDir, "nodes.json") if jobDir else None
+    resume = nodesFile is not None and os.path.exists(nodesFile)
+
+    # A resumed job might have moved the file already, its new path and hash are kept
+    # in the job folder
+    storedFile = os.path.join(jobDir, "file.json") if jobDir else None
+    progress("store")
+    isURL = False
+    if storedFile is not None and os.path.exists(storedFile):
+        with open(storedFile, "r") as f:
+            stored = json.load(f)
+        newFile, newFileName, newFileHash = (
+            stored["file"],
+            stored["fileName"],
+            stored["hash"],
         )
+        # The job might have crashed after the file was registered
+        if registeredFile(newFileName):
+            return (0, "Completed")
     else:
-        # Add file to vector store https://docs.llamaindex.ai/en/stable/examples/vector_stores/DuckDBDemo/?h=duckdb
-        vector_store = DuckDBVectorStore.from_local(vectorDB)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        index = VectorStoreIndex.from_documents(
-            newData,
-            storage_context=storage_context,
-            transformations=[TitleExtractor(), KeywordExtractor()],
+        result = storeFile(newFile, newFileName, storageFolder, resume)
+        if isinstance(result[0], int):
+            return result
+        newFile, newFileName, newFileHash, tempDir = result
+        isURL = tempDir is not None
+        if storedFile is not None and not isURL:
+            with open(storedFile, "w") as f:
+                json.dump(
+                    {"file": newFile, "fileName": newFileName, "hash": newFileHash}, f
+                )
+
+    if resume:
+        with open(nodesFile, "r") as f:
+            nodes = [TextNode.from_dict(x) for x in json.load(f)]
+    else:
+        progress("parse")
+        nodes = SimpleDirectoryReader(input_files=[newFile]).load_data()
+
+        # Extract the titles and keywords of the document (LLM), chunks that were
+        # processed before (e.g. in a previous version of the file) are reused
+        progress("extract")
+        newNodes = useChunkCache(
+            nodes,
+            shared.corpusEmbedding(shared.postgresAccorns, remoteAppDB, vectorDB),
         )
+        if newNodes:
+            start = time.perf_counter()
+            _ = run_transformations(
+                newNodes,
+                [
+                    TitleExtractor(llm=ingestionLLM, num_workers=extractWorkers),
+                    KeywordExtractor(llm=ingestionLLM, num_workers=extractWorkers),
+                ],
+            )
+            rates["extraction"] = chunkRate(len(newNodes), start)
+            progress("extract", f"{len(newNodes)} chunks, {rates['extraction']}")
+        if nodesFile:
+            with open(nodesFile, "w") as f:
+                json.dump([x.to_dict() for x in nodes], f)
+
+    # Delete the file from URL if not set to be kept
+    if (storageFolder is None) & isURL:
+        os.remove(newFile)
 
     # Get the metadata out of the DB excerpt_keywords document_title
     fileName = os.path.basename(newFileName)
 
-    if remoteAppDB:
-        conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
+    # Add file to vector store https://docs.llamaindex.ai/en/stable/examples/vector_stores/DuckDBDemo/?h=duckdb
+    progress("index")
+    with shared.vectorDBConn(
+        postgresUser=shared.postgresAccorns, vectorDB=vectorDB
+    ) as conn:
+        # Remove vectors left by a job that crashed while inserting them
         cursor = conn.cursor()
-        _ = cursor.execute(
-            (
-                "SELECT metadata_ ->> 'document_title' as x, metadata_ ->> 'excerpt_keywords' as y "
-                "FROM data_document WHERE metadata_ ->> 'file_name' = %s"
-            ),
-            (fileName,),
-        )
-
-        q = cursor.fetchall()
-        # When we create the document table we need to grant access to the scuirrel user
-        _ = cursor.execute("GRANT SELECT ON TABLE data_document TO scuirrel")
+        deleteFileVectors(cursor, fileName, remoteAppDB)
+        # Reserve the fID so it can be stored with the chunks
+        shared.executeQuery(cursor, "SELECT nextval('seq_fID')")
+        fID = cursor.fetchone()[0]
         conn.commit()
-        conn.close()
 
-        chunkTitles = "* " + "\n* ".join(set([x[0] for x in q]))
-        chunkKeywords = ", ".join(set((", ".join([x[1] for x in q])).split(", ")))
-    else:
-        conn = shared.vectorDBConn(
-            postgresUser=shared.postgresAccorns, vectorDB=vectorDB
+    # The fID is only used for lookups, not part of the text that is embedded / sent
+    for node in nodes:
+        node.metadata["fID"] = fID
+        for keys in [
+            node.excluded_embed_metadata_keys,
+            node.excluded_llm_metadata_keys,
+        ]:
+            if "fID" not in keys:
+                keys.append("fID")
+
+    # Embed the new chunks with the embedding model of the vector database and add them
+    # to the cache. If an admin switched the model meanwhile, embed them again
+    while True:
+        shared.clearIndexCache()
+        embedding = shared.corpusEmbedding(
+            shared.postgresAccorns, remoteAppDB, vectorDB
         )
-        cursor = conn.cursor()
-        _ = cursor.execute(
-            (
-                "SELECT metadata_ ->> ['document_title', 'excerpt_keywords'] FROM documents WHERE "
-                "CAST(json_extract(metadata_, '$.file_name') as VARCHAR) = ?"
-            ),
-            parameters=('"' + fileName + '"',),
+        newNodes = useChunkCache(nodes, embedding)
+        if newNodes:
+            start = time.perf_counter()
+            asyncio.run(
+                embedNodes(
+                    newNodes,
+                    embedding,
+                    lambda done: progress(
+                        "index",
+                        f"Embedded {done}/{len(newNodes)} chunks, {chunkRate(done, start)}",
+                    ),
+                )
+            )
+            rates["embedding"] = chunkRate(len(newNodes), start)
+            cacheChunks(newNodes, embedding)
+
+        vector_store = shared.getVectorStore(
+            postgresUser=shared.postgresAccorns, remote=remoteAppDB, vectorDB=vectorDB
         )
-        q = cursor.fetchall()
-        conn.close()
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        try:
+            _ = VectorStoreIndex(nodes, storage_context=storage_context)
+        except Exception:
+            # The new table has embeddings of a different length
+            if (
+                shared.corpusEmbedding(shared.postgresAccorns, remoteAppDB, vectorDB)
+                == embedding
+            ):
+                raise
+
+        if (
+            shared.corpusEmbedding(shared.postgresAccorns, remoteAppDB, vectorDB)
+            == embedding
+        ):
+            break
+
+        with shared.vectorDBConn(
+            postgresUser=shared.postgresAccorns, vectorDB=vectorDB
+        ) as conn:
+            deleteFileVectors(conn.cursor(), fileName, remoteAppDB)
+            conn.commit()
 
-        chunkTitles = "* " + "\n* ".join(set([x[0][0] for x in q]))
-        chunkKeywords = ", ".join(set((", ".join([x[0][1] for x in q])).split(", ")))
+    # The corpus changed, so cached indexes need to be rebuilt
+    shared.clearIndexCache()
 
-    # Summarise everything using the LLM and add it to the appDB
+    if remoteAppDB:
+        _ = migrateRemoteVectorDB()
+        with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+            # When we create the document table we need to grant access to the scuirrel user
+            _ = conn.cursor().execute("GRANT SELECT ON TABLE data_document TO scuirrel")
+            conn.commit()
+
+    # Summarise the titles and keywords of the chunks using the LLM (no retrieval needed)
+    progress("summarise")
+    chunkTitles = "* " + "\n* ".join(
+        sorted(set([x.metadata.get("document_title", "") for x in nodes]))
+    )
+    chunkKeywords = ", ".join(
+        sorted(
+            {
+                y
+                for x in nodes
+                for y in x.metadata.get("excerpt_keywords", "").split(", ")
+            }
+        )
+    )
     docSum = (
         "Below is a list of subheadings belonging to the same document."
         f"Note that many of them might be near identical:\n\n{chunkTitles}"
@@ -243,73 +950,478 @@ def addFileToDB(
         "\n\nAgain note that some key words are very related.\n"
         "Your task is to summarize all of this into a single, succinct short title, a subtitle, "
         "and a list of the top-10 keywords. Stay as close to the original titles as possible."
-        " The output should be in the following valid JSON format: \n\n"
-        '{"title": "", "subtitle": "", "keywords": []}'
     )
-    docSum = json.loads(str(index.as_query_engine().query(docSum)))
+    docSum = ingestionLLM.structured_predict(
+        FileSummary, PromptTemplate("{docSum}"), docSum=docSum
+    ).model_dump()
 
-    conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns, vectorDB=vectorDB)
-    cursor = conn.cursor()
-    _ = shared.executeQuery(
-        cursor,
-        'INSERT INTO "file"("fID", "fileName", "title", "subtitle", "shinyToken", "created") '
-        "VALUES(nextval('seq_fID'), ?, ?, ?, ?, ?)",
-        (fileName, docSum["title"], docSum["subtitle"], shinyToken, shared.dt()),
+    with shared.vectorDBConn(
+        postgresUser=shared.postgresAccorns, vectorDB=vectorDB
+    ) as conn:
+        cursor = conn.cursor()
+        _ = shared.executeQuery(
+            cursor,
+            'INSERT INTO "file"("fID", "fileName", "title", "subtitle", "shinyToken", "created") '
+            "VALUES(?, ?, ?, ?, ?, ?)",
+            (
+                fID,
+                fileName,
+                docSum["title"],
+                docSum["subtitle"],
+                shinyToken,
+                shared.dt(),
+            ),
+        )
+        _ = shared.executeQuery(
+            cursor,
+            'INSERT INTO "keyword"("kID", "fID", "keyword") '
+            f"VALUES(nextval('seq_kID'),{int(fID)}, ?)",
+            [(item,) for item in docSum["keywords"]],
+        )
+        shared.bumpCorpusVersion(cursor, remoteAppDB)
+        conn.commit()
+
+    with cacheDBConn() as conn:
+        _ = conn.execute(
+            'INSERT OR REPLACE INTO "fileHash"("hash", "fileName", "created") '
+            "VALUES(?, ?, ?)",
+            (newFileHash, fileName, shared.dt()),
+        )
+        conn.commit()
+
+    rates = "".join([f", {k} {v}" for k, v in rates.items()])
+    return (0, f"Completed: {len(nodes)} chunks{rates}")
+
+
+# Embed nodes with an embedding (model, dimensions) in batches of embedBatchSize with
+# embedWorkers requests at the same time. The progress function is called with the
+# number of embedded nodes
+async def embedNodes(nodes, embedding, progress=None):
+    semaphore = asyncio.Semaphore(embedWorkers)
+    embedModel = shared.getEmbedModel(
+        *embedding, embed_batch_size=embedBatchSize, max_retries=embedRetries
     )
-    shared.executeQuery(cursor, "SELECT currval('seq_fID')")
-    fID = cursor.fetchone()[0]
-    _ = shared.executeQuery(
-        cursor,
-        'INSERT INTO "keyword"("kID", "fID", "keyword") '
-        f"VALUES(nextval('seq_kID'),{int(fID)}, ?)",
-        [(item,) for item in docSum["keywords"]],
+    done = 0
+
+    async def embedBatch(batch):
+        nonlocal done
+        async with semaphore:
+            embeddings = await embedModel.aget_text_embedding_batch(
+                [x.get_content(metadata_mode=MetadataMode.EMBED) for x in batch]
+            )
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+        done += len(batch)
+        if progress:
+            progress(done)
+
+    await asyncio.gather(
+        *[
+            embedBatch(nodes[i : i + embedBatchSize])
+            for i in range(0, len(nodes), embedBatchSize)
+        ]
     )
-    conn.commit()
-    conn.close()
 
-    return (0, "Completed")
+
+# Number of chunks processed per second since start
+def chunkRate(n, start):
+    return f"{n / max(time.perf_counter() - start, 1e-6):.1f} chunks/s"
+
+
+# Create the local database with the content hashes of processed files and chunks
+def createCacheDB(
+    DBpath=cacheDB, sqlFile=os.path.join(appDBDir, "appDB_sqlite_cache.sql")
+):
+    if os.path.dirname(DBpath) and not os.path.exists(os.path.dirname(DBpath)):
+        os.makedirs(os.path.dirname(DBpath))
+
+    with open(sqlFile, "r") as file:
+        query = sql_split(file.read())
+
+    with cacheDBConn(DBpath) as conn:
+        cursor = conn.cursor()
+        for x in query:
+            _ = cursor.execute(x)
+        conn.commit()
+
+    return (0, "Ingestion cache ready")
+
+
+def cacheDBConn(DBpath=cacheDB):
+    return closing(sqlite3.connect(DBpath, timeout=30))
+
+
+# SHA-256 hash of the content of a file
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# SHA-256 hash of the text of a chunk
+def chunkHash(node):
+    return hashlib.sha256(node.get_content().encode("utf-8")).hexdigest()
+
+
+# Name of a file in the vector database with the same content (None if there is none)
+def duplicateFile(digest):
+    with cacheDBConn() as conn:
+        cached = conn.execute(
+            'SELECT "fileName" FROM "fileHash" WHERE "hash" = ?', (digest,)
+        ).fetchone()
+    if cached is None:
+        return None
+
+    # The file might have been deleted since
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        existingFile = shared.pandasQuery(
+            conn, 'SELECT "fileName" FROM "file" WHERE "fileName" = ?', (cached[0],)
+        )
+    return cached[0] if existingFile.shape[0] > 0 else None
+
+
+# Key of an embedding (model, dimensions) in the chunk cache
+def embeddingName(embedding):
+    return f"{embedding[0]} ({embedding[1]})"
+
+
+# Add the extracted metadata and embeddings of chunks that were processed before
+# (with the same embedding) to the nodes. Returns the nodes not in the cache
+def useChunkCache(nodes, embedding):
+    # Embeddings of another model (e.g. from before a switch) are replaced
+    for node in nodes:
+        node.embedding = None
+    hashes = [chunkHash(x) for x in nodes]
+    with cacheDBConn() as conn:
+        cached = {}
+        # Stay below the maximum number of SQLite parameters
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i : i + 500]
+            cached.update(
+                {
+                    x[0]: x[1:]
+                    for x in conn.execute(
+                        'SELECT "hash", "metadata", "embedding" FROM "chunk" '
+                        f'WHERE "model" = ? AND "hash" IN ({", ".join("?" * len(batch))})',
+                        (embeddingName(embedding), *batch),
+                    )
+                }
+            )
+
+    newNodes = []
+    for node, digest in zip(nodes, hashes):
+        if digest in cached:
+            node.metadata.update(json.loads(cached[digest][0]))
+            node.embedding = np.frombuffer(cached[digest][1], dtype=np.float32).tolist()
+        else:
+            newNodes.append(node)
+
+    return newNodes
+
+
+# Add the extracted metadata and embeddings of new chunks to the cache
+def cacheChunks(nodes, embedding):
+    with cacheDBConn() as conn:
+        _ = conn.executemany(
+            'INSERT OR REPLACE INTO "chunk"("hash", "model", "metadata", "embedding", "created") '
+            "VALUES(?, ?, ?, ?, ?)",
+            [
+                (
+                    chunkHash(x),
+                    embeddingName(embedding),
+                    json.dumps(
+                        {k: x.metadata[k] for k in cachedMetadata if k in x.metadata}
+                    ),
+                    np.asarray(x.embedding, dtype=np.float32).tobytes(),
+                    shared.dt(),
+                )
+                for x in nodes
+            ],
+        )
+        conn.commit()
+
+
+# Delete the vectors of a file from the vector database
+def deleteFileVectors(cursor, fileName, remoteAppDB=shared.remoteAppDB):
+    if remoteAppDB:
+        # The table is created by llama-index when the first file is added
+        _ = cursor.execute("SELECT to_regclass('data_document')")
+        if cursor.fetchone()[0] is None:
+            return
+        _ = cursor.execute(
+            "DELETE FROM data_document WHERE file_name = %s", (fileName,)
+        )
+    else:
+        _ = cursor.execute(
+            'DELETE FROM "documents" WHERE "file_name" = ?', parameters=(fileName,)
+        )
+
+
+# Create the local database with the ingestion job queue (if needed)
+def createIngestionDB(
+    DBpath=jobsDB, sqlFile=os.path.join(appDBDir, "appDB_sqlite_ingestion.sql")
+):
+    for folder in [os.path.dirname(DBpath), jobsFolder]:
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    with open(sqlFile, "r") as file:
+        query = sql_split(file.read())
+
+    with jobsDBConn(DBpath) as conn:
+        cursor = conn.cursor()
+        for x in query:
+            _ = cursor.execute(x)
+        # Queues created before the hash of the file was stored
+        _ = cursor.execute('PRAGMA table_info("job")')
+        if "hash" not in [x[1] for x in cursor.fetchall()]:
+            _ = cursor.execute('ALTER TABLE "job" ADD COLUMN "hash" TEXT')
+        conn.commit()
+    _ = createCacheDB()
+
+    return (0, "Ingestion job queue ready")
+
+
+# The job queue is always a local SQLite database shared by the app and the workers
+def jobsDBConn(DBpath=jobsDB):
+    return closing(sqlite3.connect(DBpath, timeout=30))
+
+
+# Add a file to the ingestion queue. The file is copied to the job folder as the
+# uploaded file is removed when the session ends. If the same file is already queued
+# or running, the upload is attached to that job instead (result 4)
+def addIngestionJob(newFile, shinyToken, newFileName=None, vectorDB=shared.vectorDB):
+    isURL = newFile.startswith("http://") or newFile.startswith("https://")
+    newFileName = os.path.basename(newFile) if newFileName is None else newFileName
+    newFileHash = None if isURL else fileHash(newFile)
+
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        existingFile = shared.pandasQuery(
+            conn,
+            'SELECT "fileName" FROM "file" WHERE "fileName" = ?',
+            (newFileName,),
+        )
+
+    with jobsDBConn() as conn:
+        cursor = conn.cursor()
+        # Other sessions can't queue the same file in between
+        _ = cursor.execute("BEGIN IMMEDIATE")
+        _ = cursor.execute(
+            'SELECT "jID" FROM "job" WHERE "fileName" = ? AND "status" < 2',
+            (newFileName,),
+        )
+        if existingFile.shape[0] > 0 or cursor.fetchone() is not None:
+            conn.rollback()
+            return (
+                1,
+                "A file with this name already exists. Please rename the file before uploading it again",
+            )
+
+        duplicate = None if isURL else duplicateFile(newFileHash)
+        if duplicate is not None:
+            conn.rollback()
+            return (
+                3,
+                f"This file was already added to the vector database as {duplicate}",
+            )
+
+        pending = None
+        if not isURL:
+            _ = cursor.execute(
+                'SELECT "jID", "fileName" FROM "job" WHERE "hash" = ? AND "status" < 2',
+                (newFileHash,),
+            )
+            pending = cursor.fetchone()
+        if pending is not None:
+            _ = cursor.execute(
+                'INSERT INTO "jobRequest"("jID","fileName","shinyToken","created") '
+                "VALUES(?,?,?,?)",
+                (pending[0], newFileName, shinyToken, shared.dt()),
+            )
+            # Update the job so the sessions polling the queue show it
+            _ = cursor.execute(
+                'UPDATE "job" SET "updates" = "updates" + 1 WHERE "jID" = ?',
+                (pending[0],),
+            )
+            conn.commit()
+            return (
+                4,
+                f"This file is already being added to the vector database as {pending[1]}",
+            )
+
+        _ = cursor.execute(
+            'INSERT INTO "job"("fileName","hash","vectorDB","shinyToken","created","modified") '
+            "VALUES(?,?,?,?,?,?)",
+            (newFileName, newFileHash, vectorDB, shinyToken, shared.dt(), shared.dt()),
+        )
+        jID = cursor.lastrowid
+        jobDir = os.path.join(jobsFolder, str(jID))
+        os.makedirs(jobDir, exist_ok=True)
+        if not isURL:
+            copyfile(newFile, os.path.join(jobDir, newFileName))
+            newFile = os.path.join(jobDir, newFileName)
+        _ = cursor.execute(
+            'UPDATE "job" SET "file" = ? WHERE "jID" = ?', (newFile, jID)
+        )
+        conn.commit()
+
+    return (0, jID)
+
+
+# Update the fields of a job
+def updateIngestionJob(jID, **fields):
+    fields["modified"] = shared.dt()
+    columns = ", ".join([f'"{x}" = ?' for x in fields])
+    with jobsDBConn() as conn:
+        _ = conn.execute(
+            f'UPDATE "job" SET {columns}, "updates" = "updates" + 1 WHERE "jID" = ?',
+            (*fields.values(), jID),
+        )
+        conn.commit()
+
+
+# Check if the worker process that claimed a job is still running
+def workerAlive(worker):
+    host, pid = worker.split(":")[:2]
+    # Workers run on the same host as the queue, so the host was restarted / replaced
+    if host != socket.gethostname():
+        return False
+    # Jobs claimed by this process before a restart (PIDs are often reused in containers)
+    if int(pid) == os.getpid() and worker not in activeWorkers:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+# Worker IDs running in this process
+activeWorkers = set()
+
+
+# Claim the oldest queued job for a worker. Jobs of workers that died are queued again
+def claimIngestionJob(worker):
+    with jobsDBConn() as conn:
+        cursor = conn.cursor()
+        _ = cursor.execute("BEGIN IMMEDIATE")
+        _ = cursor.execute('SELECT "jID", "worker" FROM "job" WHERE "status" = 1')
+        for jID, other in cursor.fetchall():
+            if not workerAlive(other):
+                _ = cursor.execute(
+                    'UPDATE "job" SET "status" = 0, "worker" = NULL, '
+                    '"updates" = "updates" + 1 WHERE "jID" = ?',
+                    (jID,),
+                )
+
+        _ = cursor.execute(
+            'SELECT "jID", "file", "fileName", "vectorDB", "shinyToken" FROM "job" '
+            'WHERE "status" = 0 ORDER BY "jID" LIMIT 1'
+        )
+        job = cursor.fetchone()
+        if job is not None:
+            _ = cursor.execute(
+                'UPDATE "job" SET "status" = 1, "worker" = ?, "modified" = ?, '
+                '"updates" = "updates" + 1 WHERE "jID" = ?',
+                (worker, shared.dt(), job[0]),
+            )
+        conn.commit()
+
+    if job is None:
+        return None
+    return dict(zip(["jID", "file", "fileName", "vectorDB", "shinyToken"], job))
+
+
+# Run a claimed job and register the result
+def runIngestionJob(job):
+    jobDir = os.path.join(jobsFolder, str(job["jID"]))
+    try:
+        result = addFileToDB(
+            newFile=job["file"],
+            shinyToken=job["shinyToken"],
+            vectorDB=job["vectorDB"],
+            storageFolder=storageFolder,
+            newFileName=job["fileName"],
+            jobDir=jobDir,
+            progress=lambda stage, message=None: updateIngestionJob(
+                job["jID"], stage=stage, message=message
+            ),
+        )
+        updateIngestionJob(
+            job["jID"], status=2, stage="done", result=result[0], message=result[1]
+        )
+    except Exception as e:
+        updateIngestionJob(job["jID"], status=3, message=str(e))
+        return
+
+    rmtree(jobDir, ignore_errors=True)
+
+
+# Summary of the job queue that changes whenever a job is updated (for polling)
+def ingestionJobsVersion():
+    with jobsDBConn() as conn:
+        return conn.execute('SELECT count(*), sum("updates") FROM "job"').fetchone()
+
+
+# Jobs that are waiting or running, and the finished jobs of a session (including
+# the jobs its uploads were attached to)
+def ingestionJobs(shinyToken):
+    with jobsDBConn() as conn:
+        jobs = pd.read_sql_query(
+            'SELECT * FROM "job" WHERE "status" < 2 OR "shinyToken" = ? OR "jID" IN '
+            '(SELECT "jID" FROM "jobRequest" WHERE "shinyToken" = ?) ORDER BY "jID"',
+            conn,
+            params=(shinyToken, shinyToken),
+        )
+    jobs["progress"] = [
+        int(100 * ingestionStages.index(x) / (len(ingestionStages) - 1))
+        for x in jobs["stage"]
+    ]
+    return jobs
 
 
 # Add the demo to the app
 def addDemo(shinyToken):
     msg = 0
 
-    conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-    cursor = conn.cursor()
+    with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
 
-    # Check if the demo has already been added
-    cursor.execute("SELECT * FROM topic LIMIT 1")
-    if cursor.fetchone() is None:
-        msg = 1
+        # Check if the demo has already been added
+        cursor.execute("SELECT * FROM topic LIMIT 1")
+        if cursor.fetchone() is None:
+            msg = 1
 
-        # Check if the conn is to duckdb or postgres
-        if "sqlite" in str(conn):
-            with open(os.path.join(appDBDir, "appDB_sqlite_demo.sql"), "r") as file:
-                query = sql_split(file.read())
+            # Check if the conn is to duckdb or postgres
+            if "sqlite" in str(conn):
+                with open(os.path.join(appDBDir, "appDB_sqlite_demo.sql"), "r") as file:
+                    query = sql_split(file.read())
 
-            for x in query:
-                _ = cursor.execute(x)
+                for x in query:
+                    _ = cursor.execute(x)
 
-        else:
-            with open(os.path.join(appDBDir, "appDB_postgres_demo.sql"), "r") as file:
-                query = file.read()
-                _ = cursor.execute(query)
+            else:
+                with open(
+                    os.path.join(appDBDir, "appDB_postgres_demo.sql"), "r"
+                ) as file:
+                    query = file.read()
+                    _ = cursor.execute(query)
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
     # Add the demo file to the vector database
     # Check if the demo file is already in the database
-    conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-    cursor = conn.cursor()
-    _ = cursor.execute('SELECT "fID" FROM file LIMIT 1')
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
+        _ = cursor.execute('SELECT "fID" FROM file LIMIT 1')
 
-    if cursor.fetchone() is None:
-        msg = 3 if msg == 1 else 2
-        addFileToDB(
-            newFile=shared.demoFile, shinyToken=shinyToken, vectorDB=shared.vectorDB
-        )
-    conn.close()
+        if cursor.fetchone() is None:
+            msg = 3 if msg == 1 else 2
+            addFileToDB(
+                newFile=shared.demoFile, shinyToken=shinyToken, vectorDB=shared.vectorDB
+            )
 
     return (
         msg,
@@ -2,10 +2,23 @@ DROP TABLE IF EXISTS "documents";
 CREATE TABLE "documents" (
   "node_id" VARCHAR, 
   "text" VARCHAR, 
-  "embedding" FLOAT[], 
-  "metadata_" JSON
+  "embedding" FLOAT[1536], -- Set to the configured dimensions in createLocalVectorDB
+  "metadata_" JSON,
+  "file_name" VARCHAR,
+  "fID" INTEGER
   );
 
+-- Increased after each change of the files, see shared.corpusVersion. The embedding
+-- model is filled in by createLocalVectorDB and changed by reembedVectorDB
+DROP TABLE IF EXISTS "corpus";
+CREATE TABLE "corpus" (
+  "version" INTEGER,
+  "modified" TEXT,
+  "embedModel" TEXT,
+  "embedDim" INTEGER
+);
+INSERT INTO "corpus" VALUES (0, NULL, NULL, NULL);
+
 DROP SEQUENCE IF EXISTS seq_fID;
 DROP TABLE IF EXISTS metadata;
 CREATE SEQUENCE seq_fID START 1;
@@ -92,6 +92,17 @@ CREATE TABLE group_topic(
     ON DELETE CASCADE ON UPDATE CASCADE
 );
 
+-- Files (fID in the vector database) searched for a topic, all files if there are none
+CREATE TABLE topic_file(
+  "tID" INTEGER,
+  "fID" INTEGER,
+  "uID" INTEGER,
+  "added" TEXT,
+  PRIMARY KEY("tID", "fID"),
+  FOREIGN KEY("tID") REFERENCES "topic"("tID") 
+    ON DELETE CASCADE ON UPDATE CASCADE
+);
+
 CREATE TABLE "accessCode" (
 	"aID" SERIAL PRIMARY KEY,
   "code" TEXT,
@@ -269,3 +280,4 @@ GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO scuirrel;
 GRANT CONNECT ON DATABASE accorns TO accorns;
 GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO accorns;
 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO accorns;
+GRANT CREATE ON SCHEMA public TO accorns;
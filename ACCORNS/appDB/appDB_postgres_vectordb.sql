@@ -34,6 +34,16 @@ CREATE TABLE file (
   "modified" TEXT
 );
 
+-- Increased after each change of the files, see shared.corpusVersion. The embedding
+-- model is filled in by migrateRemoteVectorDB and changed by reembedVectorDB
+CREATE TABLE corpus (
+  "version" INTEGER,
+  "modified" TEXT,
+  "embedModel" TEXT,
+  "embedDim" INTEGER
+);
+INSERT INTO corpus VALUES (0, NULL, NULL, NULL);
+
 CREATE SEQUENCE seq_kID START 1;
 CREATE TABLE keyword (
   "kID" SERIAL PRIMARY KEY,
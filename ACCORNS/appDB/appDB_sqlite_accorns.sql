@@ -75,6 +75,18 @@ CREATE TABLE "group_topic" (
     ON DELETE CASCADE ON UPDATE CASCADE
 );
 
+-- Files (fID in the vector database) searched for a topic, all files if there are none
+DROP TABLE IF EXISTS "topic_file";
+CREATE TABLE "topic_file" (
+  "tID" INTEGER,
+  "fID" INTEGER,
+  "uID" INTEGER,
+  "added" TEXT,
+  PRIMARY KEY("tID", "fID"),
+  FOREIGN KEY("tID") REFERENCES "topic"("tID") 
+    ON DELETE CASCADE ON UPDATE CASCADE
+);
+
 DROP TABLE IF EXISTS "accessCode";
 CREATE TABLE IF NOT EXISTS "accessCode" (
 	"aID" INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS "fileHash" (
+	"hash" TEXT PRIMARY KEY,
+  "fileName" TEXT,
+  "created" TEXT
+);
+
+CREATE TABLE IF NOT EXISTS "chunk" (
+	"hash" TEXT,
+  "model" TEXT,
+  "metadata" TEXT,
+  "embedding" BLOB,
+  "created" TEXT,
+  PRIMARY KEY ("hash", "model")
+);
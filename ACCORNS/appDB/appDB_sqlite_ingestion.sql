@@ -0,0 +1,26 @@
+CREATE TABLE IF NOT EXISTS "job" (
+	"jID" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "file" TEXT,
+  "fileName" TEXT,
+  "hash" TEXT,
+  "vectorDB" TEXT,
+  "shinyToken" TEXT,
+  "status" INTEGER DEFAULT 0,
+  "stage" TEXT DEFAULT 'queued',
+  "result" INTEGER,
+  "message" TEXT,
+  "worker" TEXT,
+  "updates" INTEGER DEFAULT 0,
+  "created" TEXT,
+  "modified" TEXT
+);
+
+CREATE INDEX IF NOT EXISTS "job_status" ON "job" ("status");
+
+-- Uploads of a file that was already being added are attached to the first job
+CREATE TABLE IF NOT EXISTS "jobRequest" (
+  "jID" INTEGER,
+  "fileName" TEXT,
+  "shinyToken" TEXT,
+  "created" TEXT
+);
@@ -0,0 +1,61 @@
+# *********************************************
+# ----------- ACCORNS INGESTION WORKER --------
+# *********************************************
+
+# Workers that add the queued files (see accorns_shared.addIngestionJob) to the
+# vector database. ACCORNS starts them automatically, but with a remote (postgres)
+# vector database extra workers can be started from the root folder with:
+#   python -m ACCORNS.ingestion_worker
+# The job queue and the job files are local (SQLite), so extra workers have to run on
+# the same host as the app
+
+import shared.shared as shared
+import ACCORNS.accorns_shared as accorns_shared
+
+# -- General
+import os
+import socket
+import threading
+import multiprocessing
+
+
+# Keep processing jobs until the stop event is set
+def runWorker(stop=None, pollInterval=accorns_shared.pollInterval):
+    worker = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    accorns_shared.activeWorkers.add(worker)
+    accorns_shared.createIngestionDB()
+    stop = threading.Event() if stop is None else stop
+
+    while not stop.is_set():
+        job = accorns_shared.claimIngestionJob(worker)
+        if job is None:
+            stop.wait(pollInterval)
+            continue
+
+        print(f"Worker {worker} processing {job['fileName']} (job {job['jID']})")
+        accorns_shared.runIngestionJob(job)
+
+
+# Start the workers. With postgres these are separate (spawned, not forked) processes.
+# A local DuckDB file can only be opened by one process, so then threads are used
+def startWorkers(n=accorns_shared.ingestionWorkers, remoteAppDB=shared.remoteAppDB):
+    context = multiprocessing.get_context("spawn") if remoteAppDB else threading
+    start = context.Process if remoteAppDB else threading.Thread
+    stop = context.Event()
+    workers = [
+        start(target=runWorker, kwargs={"stop": stop}, daemon=True) for _ in range(n)
+    ]
+    for worker in workers:
+        worker.start()
+
+    return (stop, workers)
+
+
+# Stop the workers after their current job
+def stopWorkers(workers):
+    stop, _ = workers
+    stop.set()
+
+
+if __name__ == "__main__":
+    runWorker()
@@ -0,0 +1,95 @@
+# *************************************************
+# ----------- SCUIRREL CONVERSATION LOG -----------
+# *************************************************
+
+# The messages of a chat session. Kept separate from the chat module and
+# scuirrel_shared (which needs the vector database) so it can be used without the app,
+# e.g. in tests/benchmark_conversation.py
+
+import shared.shared as shared
+
+from array import array
+import time
+
+
+# Messages and conversation. Append-only log with one array / list per column
+# so adding a message is O(1) and no DataFrame is needed per session
+class Conversation:
+    columns = ("cID", "isBot", "timeStamp", "content", "pCode", "pMessage")
+    __slots__ = ("id", "mID", "evalUpdates", "savedAt") + columns
+
+    def __init__(self):
+        self.id = 0  # Number of messages, the next message gets this id
+        self.cID = array("q")
+        self.isBot = array("b")
+        self.timeStamp = []
+        self.content = []
+        self.pCode = []
+        self.pMessage = []
+        # Messages are saved to the database in batches (see scuirrel_shared.saveMessages)
+        self.mID = []  # Database IDs of the saved messages
+        self.evalUpdates = []  # Saved messages of which the evaluation changed
+        self.savedAt = time.time()
+
+    def add_message(
+        self,
+        cID: int,
+        isBot: int,
+        content: str,
+        pCode: int = None,
+        pMessage: str = None,
+        timeStamp: str = None,
+    ):
+        self.cID.append(cID)
+        self.isBot.append(isBot)
+        self.timeStamp.append(timeStamp if timeStamp else shared.dt())
+        self.content.append(content)
+        self.pCode.append(pCode)
+        self.pMessage.append(pMessage)
+        self.id += 1
+
+    def addEval(self, score, comment):
+        self.pCode[-1] = score
+        self.pMessage[-1] = comment
+        if len(self.mID) == self.id:
+            self.evalUpdates.append(self.id - 1)
+
+    # The last n messages with who sent them
+    def recent(self, n):
+        return (
+            [
+                f"{'MENTOR' if isBot else 'STUDENT'}: {content}"
+                for isBot, content in zip(self.isBot[-n:], self.content[-n:])
+            ]
+            if n > 0
+            else []
+        )
+
+    # The messages about a concept (before message end) as they appear in the prompts
+    def transcript(self, cID, end=None):
+        end = self.id if end is None else end
+        return "\n".join(
+            f"--- {'MENTOR' if isBot else 'STUDENT'}:\n{content}"
+            for c, isBot, content in zip(
+                self.cID[:end], self.isBot[:end], self.content[:end]
+            )
+            if c == cID
+        )
+
+    # Score of the last evaluated reply about a concept (None if there is none)
+    def lastScore(self, cID):
+        for c, pCode in zip(reversed(self.cID), reversed(self.pCode)):
+            if c == cID and pCode is not None:
+                return int(pCode)
+        return None
+
+    # Number of messages not yet saved to the database
+    def unsaved(self):
+        return self.id - len(self.mID)
+
+    def astuple(self, order=None, start=0):
+        if order is not None and (set(self.columns) != set(order)):
+            raise ValueError("messages order not correct")
+        order = order if order else self.columns
+        # The tuples reference the stored values, nothing is copied
+        return list(zip(*(getattr(self, x)[start:] for x in order)))
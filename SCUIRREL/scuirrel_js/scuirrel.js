@@ -54,3 +54,25 @@ Shiny.addCustomMessageHandler("scrollElement", function(x){
         console.log("scrolling to bottom");
     }
 });
+
+// Show the reply of the bot while it is being generated. Each message contains the text
+// added since the previous one, the last message (done) the complete reply
+Shiny.addCustomMessageHandler("streamChat", function(x) {
+    var bubble = document.getElementById(x.id);
+    if (!bubble) {
+        bubble = document.createElement("div");
+        bubble.id = x.id;
+        bubble.className = "botChat talk-bubble";
+        bubble.dataset.n = 0;
+        bubble.setAttribute("onclick", "chatSelection(this," + x.msgID + ")");
+        bubble.appendChild(document.createElement("p"));
+        document.getElementById(x.container).appendChild(bubble);
+    }
+    if (x.done) {
+        bubble.dataset.done = "true";
+        bubble.querySelector("p").textContent = x.text;
+    } else if (bubble.dataset.done != "true" && x.n == Number(bubble.dataset.n) + 1) {
+        bubble.dataset.n = x.n;
+        bubble.querySelector("p").textContent += x.text;
+    }
+});
@@ -8,6 +8,7 @@ from shared import shared
 import os
 import pandas as pd
 import toml
+import time
 
 # --- VARIABLES ---
 
@@ -17,24 +18,62 @@ with open(os.path.join(curDir, "scuirrel_config.toml"), "r") as f:
     config = toml.load(f)
 
 allowMultiGuess = config["general"]["allowMultiGuess"]
+streamResponses = config["general"]["streamResponses"]
+streamInterval = config["general"]["streamInterval"]
+speculativeTutor = config["general"]["speculativeTutor"]
+saveCount = config["messages"]["saveCount"]
+saveInterval = config["messages"]["saveInterval"]
+retrievalCount = config["messages"]["retrievalCount"]
+planConceptContext = config["plan"]["conceptContext"]
+planCheckInterval = float(config["plan"]["checkInterval"])
 
 if not os.path.exists(shared.vectorDB) and not shared.remoteAppDB:
     raise ConnectionError("The vector database was not found. Please run ACCORNS first")
 
 # Check if there are topics to discuss before proceeding
-conn = shared.appDBConn(shared.postgresScuirrel)
-topics = shared.pandasQuery(
-    conn,
-    'SELECT * FROM "topic" WHERE "status" = 0 AND "tID" IN'
-    '(SELECT DISTINCT "tID" from "concept" WHERE "status" = 0)',
-)
-
-if topics.shape[0] == 0:
-    raise ValueError(
-        "There are no active topics with at least one concept in the database."
-        " Please run the ACCORNS app first"
+with shared.appDBConn(shared.postgresScuirrel) as conn:
+    topics = shared.pandasQuery(
+        conn,
+        'SELECT * FROM "topic" WHERE "status" = 0 AND "tID" IN'
+        '(SELECT DISTINCT "tID" from "concept" WHERE "status" = 0)',
     )
-conn.close()
+
+    if topics.shape[0] == 0:
+        raise ValueError(
+            "There are no active topics with at least one concept in the database."
+            " Please run the ACCORNS app first"
+        )
+
+
+# Save the messages of a discussion that are not in the DB yet and update the
+# evaluations that changed after saving. The mIDs are stored in the Conversation
+def saveMessages(cursor, dID, messages):
+    for i in messages.evalUpdates:
+        _ = shared.executeQuery(
+            cursor,
+            'UPDATE "message" SET "progressCode" = ?, "progressMessage" = ? '
+            'WHERE "mID" = ?',
+            (messages.pCode[i], messages.pMessage[i], messages.mID[i]),
+        )
+
+    # Executemany can't return the lastrowid, so insert the messages one by one
+    mIDs = []
+    for msg in messages.astuple(
+        ["cID", "isBot", "timeStamp", "content", "pCode", "pMessage"],
+        start=len(messages.mID),
+    ):
+        mID = shared.executeQuery(
+            cursor,
+            'INSERT INTO "message"("dID","cID","isBot","timestamp","message","progressCode","progressMessage") '
+            f"VALUES({dID}, ?, ?, ?, ?, ?, ?)",
+            msg,
+            lastRowId="mID",
+        )
+        mIDs.append(int(mID))
+
+    messages.mID.extend(mIDs)
+    messages.evalUpdates.clear()
+    messages.savedAt = time.time()
 
 
 # Function to register the end of a discussion in the DB
@@ -42,27 +81,5 @@ def endDiscussion(cursor, dID, messages, timeStamp=shared.dt()):
     _ = shared.executeQuery(
         cursor, 'UPDATE "discussion" SET "end" = ? WHERE "dID" = ?', (timeStamp, dID)
     )
-    # Executemany is optimised in such a way that it can't return the lastrowid.
-    # Therefor we insert the last message separately as we need to know the ID
-    msg = messages.astuple(
-        ["cID", "isBot", "timeStamp", "content", "pCode", "pMessage"]
-    )
-    mID = shared.executeQuery(
-        cursor,
-        'INSERT INTO "message"("dID","cID","isBot","timestamp","message","progressCode","progressMessage") '
-        f"VALUES({dID}, ?, ?, ?, ?, ?, ?)",
-        msg,
-        lastRowId="mID",
-    )
-    # If a chat issue was submitted, update the temp IDs to the real ones
-    idShift = int(mID) - messages.id + 1
-    _ = shared.executeQuery(
-        cursor, 'SELECT "fcID" FROM "feedback_chat" WHERE "dID" = ?', (dID,)
-    )
-    if cursor.fetchone():
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "feedback_chat_msg" SET "mID" = "mID" + ? WHERE "fcID" IN '
-            '(SELECT "fcID" FROM "feedback_chat" WHERE "dID" = ?)',
-            (idShift, dID),
-        )
+    # Only the messages that were not saved during the discussion are left
+    saveMessages(cursor, dID, messages)
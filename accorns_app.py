@@ -4,6 +4,7 @@
 
 import shared.shared as shared
 import ACCORNS.accorns_shared as accorns_shared
+from ACCORNS.ingestion_worker import startWorkers, stopWorkers
 
 from modules.user_management_module import user_management_server, user_management_ui
 from modules.login_module import login_server, login_ui
@@ -19,7 +20,6 @@ from modules.groups_module import groups_ui, groups_server
 # -- General
 import os
 import traceback
-import concurrent.futures
 
 # -- Shiny
 from shiny import App, reactive, render, ui
@@ -34,7 +34,6 @@ from htmltools import HTML
 # *********************************
 
 uID = reactive.value(0)  # if registered admins make reactive later
-pool = concurrent.futures.ThreadPoolExecutor()
 
 # --- SETUP and CHECKS ---
 # Generate local databases if needed
@@ -44,9 +43,14 @@ if not (shared.remoteAppDB):
 else:
     # Check if a remote database is used and if it's accessible
     print(shared.checkRemoteDB(postgresUser=shared.postgresAccorns))
+    print(accorns_shared.migrateRemoteAccornsDB())
+    print(accorns_shared.migrateRemoteVectorDB())
 # Add the demo to the database if requested
 if shared.addDemo:
     print(accorns_shared.addDemo(None))
+# Start the workers adding uploaded files to the vector database
+print(accorns_shared.createIngestionDB())
+ingestionWorkers = startWorkers()
 
 
 # --- RENDERING UI ---
@@ -76,17 +80,16 @@ app_ui = ui.page_fluid(
 
 def server(input, output, session):
     # Register the session start in the DB
-    conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-    cursor = conn.cursor()
-    sID = shared.executeQuery(
-        cursor,
-        'INSERT INTO "session" ("shinyToken", "uID", "appID", "start")'
-        "VALUES(?, 1, 1, ?)",
-        (session.id, shared.dt()),
-        lastRowId="sID",
-    )
-    conn.commit()
-    conn.close()
+    with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+        cursor = conn.cursor()
+        sID = shared.executeQuery(
+            cursor,
+            'INSERT INTO "session" ("shinyToken", "uID", "appID", "start")'
+            "VALUES(?, 1, 1, ?)",
+            (session.id, shared.dt()),
+            lastRowId="sID",
+        )
+        conn.commit()
 
     # Check which user is using the app
     user = login_server(
@@ -151,17 +154,18 @@ def server(input, output, session):
             groups = groups_server(
                 "groups", sID=sID, user=user, postgresUser=shared.postgresAccorns
             )
+            files = vectorDB_management_server("vectorDB", user=user)
             topics, concepts = topics_server(
                 "topics",
                 sID=sID,
                 user=user,
                 groups=groups,
+                files=files,
                 postgresUser=shared.postgresAccorns,
             )
             _ = user_management_server(
                 "userManagement", user=user, postgresUser=shared.postgresAccorns
             )
-            files = vectorDB_management_server("vectorDB", user=user, pool=pool)
             _ = quiz_generation_server(
                 "quizGeneration",
                 sID=sID,
@@ -169,7 +173,6 @@ def server(input, output, session):
                 topicsx=topics,
                 groups=groups,
                 postgresUser=shared.postgresAccorns,
-                pool=pool,
             )
             # Tabs to show after successful login
             return uiList
@@ -179,28 +182,28 @@ def server(input, output, session):
 
     def theEnd():
         # Add logs to the database after user exits
-        conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-        cursor = conn.cursor()
-        # Register the end of the session and if an error occurred, log it
-        errMsg = traceback.format_exc().strip()
-
-        if errMsg == "NoneType: None":
-            _ = shared.executeQuery(
-                cursor,
-                'UPDATE "session" SET "end" = ? WHERE "sID" = ?',
-                (shared.dt(), sID),
-            )
-        else:
-            _ = shared.executeQuery(
-                cursor,
-                'UPDATE "session" SET "end" = ?, "error" = ? WHERE "sID" = ?',
-                (shared.dt(), errMsg, sID),
-            )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+            cursor = conn.cursor()
+            # Register the end of the session and if an error occurred, log it
+            errMsg = traceback.format_exc().strip()
+
+            if errMsg == "NoneType: None":
+                _ = shared.executeQuery(
+                    cursor,
+                    'UPDATE "session" SET "end" = ? WHERE "sID" = ?',
+                    (shared.dt(), sID),
+                )
+            else:
+                _ = shared.executeQuery(
+                    cursor,
+                    'UPDATE "session" SET "end" = ?, "error" = ? WHERE "sID" = ?',
+                    (shared.dt(), errMsg, sID),
+                )
+            conn.commit()
 
     return
 
 
 app = App(app_ui, server)
-app.on_shutdown(pool.shutdown)
+app.on_shutdown(lambda: stopWorkers(ingestionWorkers))
+app.on_shutdown(shared.closePools)
@@ -5,151 +5,266 @@ from modules.quiz_module import quiz_ui, quiz_server
 from modules.group_join_module import group_join_server, group_join_ui
 import shared.shared as shared
 import SCUIRREL.scuirrel_shared as scuirrel_shared
+from SCUIRREL.scuirrel_conversation import Conversation
 
 # -- General
 import json
-from html import escape
-import pandas as pd
 import asyncio
+from html import escape
+import time
 
 # -- Shiny
 from shiny import Inputs, Outputs, Session, module, reactive, ui, render
 from htmltools import HTML, div
 
 # Llamaindex
-from llama_index.core import ChatPromptTemplate
+from llama_index.core import ChatPromptTemplate, QueryBundle
+from llama_index.core.utils import get_tokenizer
 from llama_index.core.llms import ChatMessage, MessageRole
+from pydantic import BaseModel, Field
 
 # --- CLASSES
 
 
-# Messages and conversation
-class Conversation:
-    def __init__(self):
-        self.id = 0
-        columns = {
-            "id": int,
-            "cID": int,
-            "isBot": int,
-            "timeStamp": str,
-            "content": str,
-            "pCode": str,
-            "pMessage": str,
-        }
-        self.messages = pd.DataFrame(columns=columns.keys()).astype(columns)
-
-    def add_message(
-        self,
-        cID: int,
-        isBot: int,
-        content: str,
-        pCode: int = None,
-        pMessage: str = None,
-        timeStamp: str = None,
+# Conversation in the prompts: a summary of the discussion of each earlier concept and
+# the messages of the current one, so the prompts don't grow with every turn. The
+# summary of a concept is generated once, when the conversation moves on from it
+class ConversationMemory:
+    def __init__(self, sessionID):
+        self.sessionID = sessionID
+        self.summaries = {}  # cID: task generating the summary
+
+    # Start summarising the concepts the conversation moved on from
+    def summarise(self, messages, concepts):
+        for _, concept in concepts.iterrows():
+            cID = int(concept["cID"])
+            if cID not in self.summaries:
+                self.summaries[cID] = asyncio.ensure_future(
+                    summariseConcept(
+                        concept["concept"], messages.transcript(cID), self.sessionID
+                    )
+                )
+
+    # Transcript of the earlier concepts (summaries) and the current one, followed by
+    # the last student message
+    async def conversation(self, messages, concepts, cIndex):
+        parts = ["---- PREVIOUS CONVERSATION ----"]
+        for cID in concepts.head(cIndex)["cID"]:
+            parts.append(await self.summary(messages, int(cID)))
+        parts.append(
+            messages.transcript(int(concepts.iloc[cIndex]["cID"]), end=messages.id - 1)
+        )
+        parts.append(
+            f"---- NEW RESPONSE FROM STUDENT ----\n{messages.content[messages.id - 1]}"
+        )
+        return "\n".join(x for x in parts if x)
+
+    # Summary of a concept, or its messages if it could not be generated
+    async def summary(self, messages, cID):
+        task = self.summaries.get(cID)
+        if task is not None:
+            try:
+                return f"--- SUMMARY OF AN EARLIER CONCEPT:\n{await task}"
+            except Exception as e:
+                print(f"Summarising the discussion of concept {cID} failed\n{e}")
+        return messages.transcript(cID)
+
+    def cancel(self):
+        for task in self.summaries.values():
+            task.cancel()
+
+
+# Short summary of the discussion of a concept
+async def summariseConcept(concept, transcript, sessionID):
+    if not transcript:
+        return "The concept was not discussed"
+
+    prompt = (
+        "Below is part of a conversation between a tutor (MENTOR) and a student (STUDENT) "
+        f"about the following concept: {concept}\n\n{transcript}\n\n"
+        "Summarise in at most three sentences what the student understood, which "
+        "mistakes they made and what the MENTOR explained."
+    )
+    async with shared.llmScheduler.slot(
+        sessionID, shared.llmPriority["chat"], shared.estimateTokens(prompt)
     ):
-        timeStamp = timeStamp if timeStamp else shared.dt()
-        self.messages = pd.concat(
-            [
-                self.messages,
-                pd.DataFrame.from_dict(
-                    {
-                        "id": [self.id],
-                        "cID": [cID],
-                        "timeStamp": [timeStamp],
-                        "isBot": [isBot],
-                        "content": [content],
-                        "pCode": [pCode],
-                        "pMessage": [pMessage],
-                    }
-                ),
-            ],
-            ignore_index=True,
+        return (await shared.getLLM("tutor").acomplete(prompt)).text
+
+
+# Tutoring plan of a topic, shared by all sessions discussing it: the parts of the
+# prompts that only depend on the concepts, the chat engines built from them and the
+# context retrieved for each concept. Edits of the concepts (which update their
+# "modified" timestamp) or the topic files give a new signature and thus a new plan
+class TopicPlan:
+    def __init__(self, topic, concepts, fIDs, postgresUser, signature):
+        self.topic = topic
+        self.concepts = list(concepts["concept"])
+        self.fIDs = fIDs
+        self.postgresUser = postgresUser
+        self.signature = signature
+        n = len(self.concepts)
+        self.cAll = "CONCEPT LIST:\n* " + "\n* ".join(self.concepts)
+        # Concept lists of the progress check per concept index
+        self.cDone = [
+            ""
+            if i == 0
+            else "These concepts were already covered successfully:\n* "
+            + "\n* ".join(self.concepts[:i])
+            for i in range(n)
+        ]
+        self.cToDo = [
+            "The following concepts still need to be discussed:\n* "
+            + "\n* ".join(self.concepts[i:])
+            for i in range(n)
+        ]
+        self.engines = {}  # (cIndex, progress, streaming): chat engine
+        self.nodes = {}  # cIndex: task retrieving the context of the concept
+        self.corpus = None  # Corpus version and embedding the nodes were retrieved from
+        self.checked = 0
+
+    # Chat engine for the concept and progress instructions (built once)
+    def chatEngine(self, cIndex, progress, streaming=False):
+        key = (cIndex, progress, streaming)
+        if key not in self.engines:
+            self.engines[key] = chatEngine(self, progress, streaming)
+        return self.engines[key]
+
+    # Context of a concept. It is retrieved once (by the first session that needs it)
+    # and again after the files in the vector database changed
+    async def context(self, cIndex):
+        await self.checkCorpus()
+        task = self.nodes.get(cIndex)
+        if task is None:
+            concept = self.concepts[cIndex]
+            task = asyncio.ensure_future(
+                retrieveContext(
+                    concept, retrievalQuery(concept), self.postgresUser, self.fIDs
+                )
+            )
+            self.nodes[cIndex] = task
+        start = time.perf_counter()
+        try:
+            # A session leaving must not cancel the retrieval for the others
+            _, nodes, _ = await asyncio.shield(task)
+        except Exception:
+            if self.nodes.get(cIndex) is task:
+                del self.nodes[cIndex]
+            raise
+        return nodes, time.perf_counter() - start
+
+    # Forget the retrieved context when ACCORNS changed the files or the embedding. The
+    # database is queried in a thread so the other sessions are not blocked
+    async def checkCorpus(self):
+        if time.monotonic() - self.checked < scuirrel_shared.planCheckInterval:
+            return
+        self.checked = time.monotonic()
+        corpus = await asyncio.to_thread(
+            lambda: (
+                shared.corpusVersion(self.postgresUser),
+                shared.currentEmbedding(self.postgresUser),
+            )
         )
-        self.id += 1
+        if corpus != self.corpus:
+            self.nodes.clear()
+            self.corpus = corpus
+
+
+# Tutor reply generated before the progress check finished, with its duration
+async def speculativeReply(engine, query, nodes, slot):
+    start = time.perf_counter()
+    async with slot:
+        resp = await engine.asynthesize(query, nodes)
+    return str(resp), time.perf_counter() - start
+
+
+# The speculative reply if the progress check agreed with the guess (None otherwise).
+# The reply and the progress check ran at the same time, which saves the shortest of
+# the two compared to running them one after the other
+async def useSpeculation(task, hit, evalTime):
+    if hit:
+        try:
+            resp, tutorTime = await task
+            recordSpeculation(True, min(evalTime, tutorTime))
+            return resp
+        except Exception as e:
+            print(f"Speculative tutor reply failed\n{e}")
+    task.cancel()
+    recordSpeculation(False, 0)
+    return None
+
+
+# Keep track of how often the speculative tutor reply could be used and the time saved
+speculationStats = {"turns": 0, "hits": 0, "saved": 0.0}
+
+
+def recordSpeculation(hit, saved):
+    speculationStats["turns"] += 1
+    speculationStats["hits"] += hit
+    speculationStats["saved"] += saved
+    print(
+        f"Speculative tutor reply: {'hit' if hit else 'miss'}, saved {saved:.3f}s "
+        f"this turn ({speculationStats['hits']}/{speculationStats['turns']} hits, "
+        f"{speculationStats['saved']:.1f}s saved in total)"
+    )
 
-    def addEval(self, score, comment):
-        self.messages.at[self.messages.index[-1], "pCode"] = score
-        self.messages.at[self.messages.index[-1], "pMessage"] = comment
 
-    def astuple(self, order=None):
-        if order is not None and (
-            set(["cID", "isBot", "timeStamp", "content", "pCode", "pMessage"])
-            != set(order)
-        ):
-            raise ValueError("messages order not correct")
-        out = self.messages.drop(columns=["id"])
-        if order:
-            out = out[order]
-        return [tuple(x) for x in out.to_numpy()]
+# One plan per topic in this process, replaced when the concepts change. Sessions keep
+# the plan of the concepts they started with
+topicPlans = {}
 
 
-# ---- VARS & FUNCTIONS ----
-def groupQuery(user, postgresUser, demo=shared.addDemo):
-    includeDemo = (
-        'UNION SELECT "gID", "group" FROM "group" WHERE "gID" = 1 ' if demo else ""
-    )
-    userFilter = 'AND m."uID" = ? ' if user["adminLevel"] < 3 else ""
-    params = (user["uID"],) if user["adminLevel"] < 3 else ()
-
-    conn = shared.appDBConn(postgresUser)
-    getGroups = shared.pandasQuery(
-        conn,
-        (
-            'SELECT g."gID", g."group" '
-            'FROM "group_member" AS m, "group_topic" AS t, "group" AS g '
-            f'WHERE m."gID" = g."gID" AND t."gID" = g."gID" {userFilter}'
-            'AND t."tID" IN (SELECT DISTINCT "tID" FROM "concept" WHERE "status" = 0) '
-            f'{includeDemo} ORDER BY "group"'
+def getPlan(tID, topic, concepts, fIDs, postgresUser):
+    signature = (
+        topic,
+        tuple(fIDs or ()),
+        tuple(
+            concepts[["cID", "concept", "modified"]].itertuples(index=False, name=None)
         ),
-        params,
     )
-    conn.close()
-    return getGroups
+    key = (int(tID), postgresUser)
+    plan = topicPlans.get(key)
+    if plan is None or plan.signature != signature:
+        plan = TopicPlan(topic, concepts, fIDs, postgresUser, signature)
+        topicPlans[key] = plan
+    return plan
 
 
-# Chat Agent - Adapt the chat engine to the topic
-def chatEngine(topic, concepts, cIndex, eval):
-    # TUTORIAL Llamaindex + Prompt engineering
-    # https://github.com/run-llama/llama_index/blob/main/docs/examples/chat_engine/chat_engine_best.ipynb
-    # https://docs.llamaindex.ai/en/stable/examples/customization/prompts/chat_prompts/
+# Structured output of the progress check (function calling)
+class ProgressEval(BaseModel):
+    """Evaluation of the student's understanding of the current concept"""
 
-    # The two strings below have not been altered from the defaults set by llamaindex,
-    # but can be if needed
-    qa_prompt_str = (
-        "Context information is below.\n"
-        "---------------------\n"
-        "{context_str}\n"
-        "---------------------\n"
-        "Given the context information and not prior knowledge, "
-        "answer the question: {query_str}\n"
-    )
+    score: int = Field(ge=1, le=4, description="Understanding on a scale of 1-4")
+    progress: int = Field(ge=1, le=3, description="Decision on how to continue (1-3)")
+    comment: str = Field(description="Reasoning behind the score and decision")
 
-    refine_prompt_str = (
-        "We have the opportunity to refine the original answer "
-        "(only if needed) with some more context below.\n"
-        "------------\n"
-        "{context_msg}\n"
-        "------------\n"
-        "Given the new context, refine the original answer to better "
-        "answer the question: {query_str}. "
-        "If the context isn't useful, output the original answer again.\n"
-        "Original Answer: {existing_answer}"
-    )
 
-    cDone = (
-        ""
-        if cIndex == 0
-        else "Already discussed:\n* " + "\n* ".join(concepts.head(cIndex)["concept"])
+# ---- VARS & FUNCTIONS ----
+def groupQuery(user, postgresUser, demo=shared.addDemo):
+    includeDemo = (
+        'UNION SELECT "gID", "group" FROM "group" WHERE "gID" = 1 ' if demo else ""
     )
+    userFilter = 'AND m."uID" = ? ' if user["adminLevel"] < 3 else ""
+    params = (user["uID"],) if user["adminLevel"] < 3 else ()
 
-    cToDo = "Will be discussed later:\n* " + "\n* ".join(
-        concepts[(cIndex + 1) :]["concept"]
-    )
+    with shared.appDBConn(postgresUser) as conn:
+        getGroups = shared.pandasQuery(
+            conn,
+            (
+                'SELECT g."gID", g."group" '
+                'FROM "group_member" AS m, "group_topic" AS t, "group" AS g '
+                f'WHERE m."gID" = g."gID" AND t."gID" = g."gID" {userFilter}'
+                'AND t."tID" IN (SELECT DISTINCT "tID" FROM "concept" WHERE "status" = 0) '
+                f'{includeDemo} ORDER BY "group"'
+            ),
+            params,
+        )
+    return getGroups
 
-    cAll = "CONCEPT LIST:\n* " + "\n* ".join(concepts["concept"])
 
-    currentConcept = concepts.iloc[cIndex]["concept"]
-    prevConcept = concepts.iloc[cIndex - 1]["concept"] if cIndex > 0 else ""
+# Instructions for the tutor on how to continue, based on the progress check
+def chatProgress(concepts, cIndex, eval):
+    currentConcept = concepts[cIndex]
+    prevConcept = concepts[cIndex - 1] if cIndex > 0 else ""
 
     if int(eval["progress"]) == 1:
         if int(eval["score"]) == 1:
@@ -185,16 +300,48 @@ def chatEngine(topic, concepts, cIndex, eval):
                 f"Your next question will focus on: {currentConcept}"
             )
 
+    return progress
+
+
+# Chat Agent - Adapt the chat engine to the topic
+def chatEngine(plan, progress, streaming=False):
+    # TUTORIAL Llamaindex + Prompt engineering
+    # https://github.com/run-llama/llama_index/blob/main/docs/examples/chat_engine/chat_engine_best.ipynb
+    # https://docs.llamaindex.ai/en/stable/examples/customization/prompts/chat_prompts/
+
+    # The two strings below have not been altered from the defaults set by llamaindex,
+    # but can be if needed
+    qa_prompt_str = (
+        "Context information is below.\n"
+        "---------------------\n"
+        "{context_str}\n"
+        "---------------------\n"
+        "Given the context information and not prior knowledge, "
+        "answer the question: {query_str}\n"
+    )
+
+    refine_prompt_str = (
+        "We have the opportunity to refine the original answer "
+        "(only if needed) with some more context below.\n"
+        "------------\n"
+        "{context_msg}\n"
+        "------------\n"
+        "Given the new context, refine the original answer to better "
+        "answer the question: {query_str}. "
+        "If the context isn't useful, output the original answer again.\n"
+        "Original Answer: {existing_answer}"
+    )
+
     # System prompt
     chat_text_qa_msgs = [
         ChatMessage(
             role=MessageRole.SYSTEM,
             content=(
                 f"""You (MENTOR) are chatting with a student (STUDENT) to review their understanding of the following topic: 
-{topic}
+{plan.topic}
 
 You are using a list of concepts (i.e. facts / information) about this topic to guide the conversation.
-{cAll}
+{plan.cAll}
 
 {progress}
 
@@ -232,22 +379,15 @@ is not giving away the concept you are trying to test.
     return index.as_query_engine(
         text_qa_template=text_qa_template,
         refine_template=refine_template,
-        llm=shared.llm,
+        llm=shared.getLLM("tutor"),
+        streaming=streaming,
     )
 
 
 # Monitoring Agent - Adapt the chat engine to the topic
-def progressCheckEngine(conversation, topic, concepts, cIndex, postgresUser):
-    cDone = (
-        ""
-        if cIndex == 0
-        else "These concepts were already covered successfully:\n* "
-        + "\n* ".join(concepts.head(cIndex)["concept"])
-    )
-
-    cToDo = "The following concepts still need to be discussed:\n* " + "\n* ".join(
-        concepts[cIndex:]["concept"]
-    )
+def progressCheckEngine(conversation, plan, cIndex, postgresUser):
+    cDone = plan.cDone[cIndex]
+    cToDo = plan.cToDo[cIndex]
 
     # System prompt
     chat_text_qa_msgs = [
@@ -255,13 +395,13 @@ def progressCheckEngine(conversation, topic, concepts, cIndex, postgresUser):
             role=MessageRole.SYSTEM,
             content=(
                 f"""You are monitoring a conversation between a tutor (TUTOR) and a student (STUDENT) on following topic:  
-{topic}
+{plan.topic}
 
 {cDone}\n\n
 {cToDo}
 
 The conversation is currently focused on the following concept: 
-{concepts.iloc[cIndex]["concept"]}
+{plan.concepts[cIndex]}
 
 {conversation}
 
@@ -311,10 +451,28 @@ Provide a response in the form of a Python dictionary: \n"""
     return index.as_query_engine(
         text_qa_template=text_qa_template,
         refine_template=refine_template,
-        llm=shared.llm,
+        llm=shared.getLLM("evaluator"),
+        output_cls=ProgressEval,
     )
 
 
+# Compact query to search the vector database: the concept being discussed and the
+# latest messages (if any). The full conversation only goes into the prompts
+def retrievalQuery(concept, messages=None, n=scuirrel_shared.retrievalCount):
+    return "\n".join([f"CONCEPT: {concept}", *(messages.recent(n) if messages else [])])
+
+
+# Embed the retrieval query and retrieve the relevant nodes from the vector database
+# (only from the files of the topic if it has any). This is done once per chat turn
+# and the nodes are shared by both engines above, which get the conversation
+async def retrieveContext(conversation, retrieval, postgresUser, fIDs=None):
+    query = QueryBundle(conversation, custom_embedding_strs=[retrieval])
+    retriever = shared.getRetriever(postgresUser=postgresUser, fIDs=fIDs)
+    start = time.perf_counter()
+    nodes = await retriever.aretrieve(query)
+    return query, nodes, time.perf_counter() - start
+
+
 # --- UI
 @module.ui
 def chat_ui():
@@ -396,6 +554,7 @@ def chat_ui():
                 ),
                 ui.card(
                     HTML("<p><i>Scuirrel is foraging for an answer ...</i></p>"),
+                    ui.output_ui("queuePosition"),
                     id="waitResp",
                     style="display: none;",
                 ),
@@ -407,14 +566,15 @@ def chat_ui():
 
 @module.server
 def chat_server(
-    input: Inputs, output: Outputs, session: Session, user, sID, postgresUser, pool
+    input: Inputs, output: Outputs, session: Session, user, sID, postgresUser
 ):
     # Reactive variables
     discussionID = reactive.value(0)  # Current conversation
     conceptIndex = reactive.value(0)  # Current concept index to discuss
     messages = reactive.value(None)  # Raw chat messages
     groups = reactive.value(None)  # User's groups
-    botLog = reactive.value(None)  # Chat sent to the LLM
+    memory = reactive.value(None)  # Conversation sent to the LLM (ConversationMemory)
+    plan = reactive.value(None)  # Tutoring plan of the topic (TopicPlan)
 
     # The quiz question popup is a separate module
     _ = quiz_server("quiz", tID=input.selTopic, sID=sID, user=user)
@@ -441,6 +601,31 @@ def chat_server(
             ),
         )
 
+    # Save the new messages to the database once enough are waiting or the last save
+    # was long enough ago. Use force to save all of them (e.g. before reporting an issue)
+    def saveMessages(force=False):
+        msg = messages.get()
+        if msg is None or (msg.unsaved() == 0 and not msg.evalUpdates):
+            return
+        if not (
+            force
+            or msg.unsaved() >= scuirrel_shared.saveCount
+            or time.time() - msg.savedAt >= scuirrel_shared.saveInterval
+        ):
+            return
+
+        with shared.appDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+            scuirrel_shared.saveMessages(cursor, discussionID.get(), msg)
+            conn.commit()
+
+    # Regularly check if there are messages waiting to be saved
+    @reactive.effect
+    def _():
+        reactive.invalidate_later(scuirrel_shared.saveInterval)
+        with reactive.isolate():
+            saveMessages()
+
     # Update a custom, simple progress bar
     def progressBar(id, percent):
         @reactive.effect
@@ -449,6 +634,25 @@ def chat_server(
                 "progressBar", {"id": id, "percent": percent}
             )
 
+    # Show the (partial) reply of the bot in its chat bubble, creating it if needed
+    def streamChat(msgID, text, n=0, done=False):
+        @reactive.effect
+        async def _():
+            await session.send_custom_message(
+                "streamChat", streamChatMsg(msgID, text, n, done)
+            )
+
+    # The text is the new part of the reply, or the complete reply once it is done
+    def streamChatMsg(msgID, text, n=0, done=False):
+        return {
+            "container": module.resolve_id("conversation"),
+            "id": module.resolve_id(f"botChat{msgID}"),
+            "msgID": msgID,
+            "text": text,
+            "n": n,
+            "done": done,
+        }
+
     def scrollElement(selectors, direction="top"):
         @reactive.effect
         async def _():
@@ -469,19 +673,17 @@ def chat_server(
     @reactive.calc
     @reactive.event(input.gID)
     def topics():
-        conn = shared.appDBConn(postgresUser)
-
-        # Return all topics for a group
-        topics = shared.pandasQuery(
-            conn,
-            (
-                'SELECT t.* FROM "topic" AS t, "group_topic" AS gt '
-                'WHERE t."tID" = gt."tID" AND gt."gID" = ? AND t."status" = 0 '
-                'ORDER BY t."topic"'
-            ),
-            (int(input.gID()),),
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser) as conn:
+            # Return all topics for a group
+            topics = shared.pandasQuery(
+                conn,
+                (
+                    'SELECT t.* FROM "topic" AS t, "group_topic" AS gt '
+                    'WHERE t."tID" = gt."tID" AND gt."gID" = ? AND t."status" = 0 '
+                    'ORDER BY t."topic"'
+                ),
+                (int(input.gID()),),
+            )
 
         return topics
 
@@ -500,28 +702,29 @@ def chat_server(
     @reactive.event(input.startConversation)
     def _():
         tID = int(topics()[topics()["tID"] == int(input.selTopic())].iloc[0]["tID"])
-        conn = shared.appDBConn(postgresUser)
-        cursor = conn.cursor()
-
-        # Save the logs for the previous discussion (if any) adn wipe the chat window
-        if messages.get():
-            scuirrel_shared.endDiscussion(cursor, discussionID.get(), messages.get())
-            ui.remove_ui("#" + module.resolve_id("conversation"))
-            ui.insert_ui(
-                div(id=module.resolve_id("conversation")),
-                "#" + module.resolve_id("chatWindow"),
+        with shared.appDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+
+            # Save the logs for the previous discussion (if any) adn wipe the chat window
+            if messages.get():
+                scuirrel_shared.endDiscussion(
+                    cursor, discussionID.get(), messages.get()
+                )
+                ui.remove_ui("#" + module.resolve_id("conversation"))
+                ui.insert_ui(
+                    div(id=module.resolve_id("conversation")),
+                    "#" + module.resolve_id("chatWindow"),
+                )
+
+            # Register the start of the  new topic discussion
+            dID = shared.executeQuery(
+                cursor,
+                'INSERT INTO "discussion" ("tID", "sID", "start")' "VALUES(?, ?, ?)",
+                (tID, sID, shared.dt()),
+                lastRowId="dID",
             )
-
-        # Register the start of the  new topic discussion
-        dID = shared.executeQuery(
-            cursor,
-            'INSERT INTO "discussion" ("tID", "sID", "start")' "VALUES(?, ?, ?)",
-            (tID, sID, shared.dt()),
-            lastRowId="dID",
-        )
-        discussionID.set(int(dID))
-        conn.commit()
-        conn.close()
+            discussionID.set(int(dID))
+            conn.commit()
         # The first message is not generated by the bot
         firstWelcome = (
             'Hello, I\'m here to help you get a basic understanding of the following topic: '
@@ -542,7 +745,18 @@ def chat_server(
                                 What do you already know about this?</p></div>"""),
             "#" + module.resolve_id("conversation"),
         )
-        botLog.set(f"---- PREVIOUS CONVERSATION ----\n--- MENTOR:\n{firstWelcome}")
+        if memory.get() is not None:
+            memory.get().cancel()
+        memory.set(ConversationMemory(session.id))
+        plan.set(
+            getPlan(
+                tID,
+                topics()[topics()["tID"] == tID].iloc[0]["topic"],
+                concepts(),
+                topicFiles(),
+                postgresUser,
+            )
+        )
 
         shared.elementDisplay(session, {"chatIn": "s"})
         return tID
@@ -550,14 +764,18 @@ def chat_server(
     # Get the concepts related to the topic
     @reactive.calc
     def concepts():
-        conn = shared.appDBConn(postgresUser)
-        concepts = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "concept" WHERE "tID" = {int(input.selTopic())} AND "status" = 0 ORDER BY "order"',
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser) as conn:
+            concepts = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "concept" WHERE "tID" = {int(input.selTopic())} AND "status" = 0 ORDER BY "order"',
+            )
         return concepts
 
+    # Get the files searched for the topic (None for all files)
+    @reactive.calc
+    def topicFiles():
+        return shared.topicFiles(postgresUser, input.selTopic())
+
     # When the send button is clicked...
     @reactive.effect
     @reactive.event(input.send)
@@ -583,58 +801,201 @@ def chat_server(
             ),
             "#" + module.resolve_id("conversation"),
         )
-        botLog.set(botLog.get() + f"\n--- STUDENT:\n{newChat}")
-        topic = topics()[topics()["tID"] == int(input.selTopic())].iloc[0]["topic"]
         scrollElement(".chatWindow .card-body")
         messages.set(msg)
-        # Generate chat logs
-        conversation = (
-            botLog.get() + "\n---- NEW RESPONSE FROM STUDENT ----\n" + newChat
-        )
+        saveMessages()
+        retrieval = retrievalQuery(concepts().iloc[conceptIndex.get()]["concept"], msg)
         # Send the message to the LLM for processing
-        botResponse(topic, concepts(), conceptIndex.get(), conversation)
-
-    def botResponse_task(topic, concepts, cIndex, conversation):
-        # Check the student's progress on the current concept based on the last reply (other engine)
-        engine = progressCheckEngine(
-            conversation, topic, concepts, cIndex, postgresUser=postgresUser
+        botResponse(
+            plan.get(),
+            concepts(),
+            conceptIndex.get(),
+            msg,
+            memory.get(),
+            retrieval,
+            msg.id,
         )
-        tries = 0
-        while tries < 3:
-            try:
-                resp = str(engine.query(conversation))
-                print(resp)
-                eval = json.loads(resp)
-                break
-            except json.JSONDecodeError:
-                print("Conversation agent JSON decode error, retrying...")
-                tries += 1
-        eval = None if tries == 3 else eval
 
-        if eval is None:
-            return {"resp": None, "eval": None}
-
-        # See if the LLM thinks we can move on to the next concept or or not
-        if int(eval["progress"]) > 1:
-            cIndex += 1
-        # Check if all concepts have been covered successfully
-        if cIndex >= concepts.shape[0]:
-            resp = f"Well done! It seems you have demonstrated understanding of everything we wanted you to know about: {topic}"
+    async def botResponse_task(
+        plan, cIndex, conversation, retrieval, pushText=None, lastScore=None
+    ):
+        # Retrieve the context once, both engines only synthesise a response from it.
+        # With conceptContext the context of the concept in the plan is used instead of
+        # searching with the retrieval query
+        if scuirrel_shared.planConceptContext:
+            query = QueryBundle(conversation)
+            nodes, retrievalTime = await plan.context(cIndex)
+            retrieval = None
         else:
-            engine = chatEngine(topic, concepts, cIndex, eval)
-            # import pprint
-            # pprint.pprint(engine.get_prompts())
-            x = engine.query(conversation)
-            resp = str(x)
+            query, nodes, retrievalTime = await retrieveContext(
+                conversation, retrieval, postgresUser, plan.fIDs
+            )
+        synthesisCalls = 0
+
+        # Each LLM call waits for its own slot of the LLM scheduler
+        tokens = shared.estimateTokens(conversation)
 
-        return {"resp": resp, "eval": eval}
+        def llmSlot():
+            return shared.llmScheduler.slot(
+                session.id, shared.llmPriority["chat"], tokens
+            )
+
+        # Speculative mode: generate the reply for staying on the current concept (with
+        # the score of the previous reply) while the progress is checked
+        speculation = None
+        if scuirrel_shared.speculativeTutor:
+            guess = chatProgress(
+                plan.concepts, cIndex, {"progress": 1, "score": lastScore or 2}
+            )
+            speculation = asyncio.ensure_future(
+                speculativeReply(
+                    plan.chatEngine(cIndex, guess), query, nodes, llmSlot()
+                )
+            )
+            synthesisCalls += 1
+        # The speculative reply is not needed anymore once the turn ended
+        try:
+            start = time.perf_counter()
+            # Check the student's progress on the current concept based on the last reply (other engine)
+            engine = progressCheckEngine(
+                conversation, plan, cIndex, postgresUser=postgresUser
+            )
+            # The output is constrained to ProgressEval, so a retry should be very rare
+            tries = 0
+            while tries < 3:
+                try:
+                    synthesisCalls += 1
+                    async with llmSlot():
+                        resp = await engine.asynthesize(query, nodes)
+                    eval = shared.parseStructured(resp, ProgressEval).model_dump()
+                    break
+                except ValueError as e:
+                    print(f"Conversation agent output not valid, retrying...\n{e}")
+                    tries += 1
+            shared.recordParse("evaluator", failures=tries, retries=min(tries, 2))
+            eval = None if tries == 3 else eval
+            evalTime = time.perf_counter() - start
+
+            if eval is None:
+                reportRetrieval(retrievalTime, synthesisCalls, retrieval, conversation)
+                return {"resp": None, "eval": None}
+
+            # See if the LLM thinks we can move on to the next concept or or not
+            if int(eval["progress"]) > 1:
+                cIndex += 1
+                # The reply is about the next concept, so use its context (the retrieval
+                # query and context so far are about the previous one)
+                if cIndex < len(plan.concepts):
+                    nodes, t = await plan.context(cIndex)
+                    retrievalTime += t
+            # Check if all concepts have been covered successfully
+            finished = cIndex >= len(plan.concepts)
+            progress = None if finished else chatProgress(plan.concepts, cIndex, eval)
+            resp = None
+            if speculation is not None:
+                resp = await useSpeculation(
+                    speculation, not finished and progress == guess, evalTime
+                )
+
+            if finished:
+                resp = f"Well done! It seems you have demonstrated understanding of everything we wanted you to know about: {plan.topic}"
+            elif resp is not None:
+                # The speculative reply was not streamed, send it at once
+                if pushText is not None:
+                    await pushText(resp)
+            else:
+                engine = plan.chatEngine(
+                    cIndex, progress, streaming=pushText is not None
+                )
+                # import pprint
+                # pprint.pprint(engine.get_prompts())
+                synthesisCalls += 1
+                async with llmSlot():
+                    x = await engine.asynthesize(query, nodes)
+                    if pushText is None:
+                        resp = str(x)
+                    else:
+                        # Send the reply to the browser as it is being generated
+                        resp = ""
+                        async for token in x.async_response_gen():
+                            resp += token
+                            await pushText(resp)
+
+            reportRetrieval(retrievalTime, synthesisCalls, retrieval, conversation)
+            return {"resp": resp, "eval": eval}
+        finally:
+            if speculation is not None:
+                speculation.cancel()
+
+    # Each synthesis call used to do its own embedding and vector search (of the whole
+    # conversation). The retrieval is None if the context of the plan was used
+    def reportRetrieval(retrievalTime, synthesisCalls, retrieval, conversation):
+        saved = retrievalTime * (synthesisCalls - 1)
+        tokenizer = get_tokenizer()
+        embedded = (
+            "Used the concept context of the topic plan"
+            if retrieval is None
+            else f"Embedded {len(tokenizer(retrieval))} tokens"
+        )
+        print(
+            f"Chat turn retrieval: {retrievalTime:.3f}s for {synthesisCalls} "
+            f"LLM calls, saved {saved:.3f}s ({synthesisCalls - 1} retrievals). "
+            f"{embedded} (conversation {len(tokenizer(conversation))} tokens)"
+        )
 
     # Async Shiny task waiting for LLM reply
     @reactive.extended_task
-    async def botResponse(topic, concepts, cIndex, conversation):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            pool, botResponse_task, topic, concepts, cIndex, conversation
+    async def botResponse(plan, concepts, cIndex, messages, memory, retrieval, msgID):
+        pushText = None
+        if scuirrel_shared.streamResponses:
+            # Only the new text is sent (at most every streamInterval seconds) and
+            # appended in the browser. The counter makes sure no update is applied twice
+            n, sent, last = [0], [0], [0.0]
+
+            async def pushText(text):
+                if time.monotonic() - last[0] < scuirrel_shared.streamInterval:
+                    return
+                n[0] += 1
+                last[0] = time.monotonic()
+                delta, sent[0] = text[sent[0] :], len(text)
+                await session.send_custom_message(
+                    "streamChat", streamChatMsg(msgID, delta, n[0])
+                )
+
+        # Progress check and tutor reply, based on the messages of the current concept
+        # and the summaries of the earlier ones
+        conversation = await memory.conversation(messages, concepts, cIndex)
+        return await botResponse_task(
+            plan,
+            cIndex,
+            conversation,
+            retrieval,
+            pushText,
+            messages.lastScore(int(concepts.iloc[cIndex]["cID"])),
+        )
+
+    # Stop waiting for the LLM when the student leaves
+    _ = session.on_ended(botResponse.cancel)
+
+    def cancelSummaries():
+        with reactive.isolate():
+            if memory.get() is not None:
+                memory.get().cancel()
+
+    _ = session.on_ended(cancelSummaries)
+
+    # Let the student know when it's busy and they have to wait for their turn
+    @render.ui
+    def queuePosition():
+        if botResponse.status() != "running":
+            return None
+        reactive.invalidate_later(1)
+        position = shared.llmScheduler.position(session.id)
+        if not position:
+            return None
+        return HTML(
+            f"<p><i>It's busy in the forest, {position} "
+            f"{'student is' if position == 1 else 'students are'} ahead of you</i></p>"
         )
 
     # Processing LLM responses
@@ -666,14 +1027,21 @@ def chat_server(
             msg.addEval(eval["score"], eval["comment"])
             msg.add_message(isBot=1, cID=int(concepts().iloc[i]["cID"]), content=resp)
             messages.set(msg)
+            saveMessages()
+            # Summarise the concept the conversation moved on from for later prompts
+            if i > conceptIndex.get():
+                memory.get().summarise(msg, concepts().head(i))
             conceptIndex.set(i)
-            ui.insert_ui(
-                HTML(
-                    f"<div class='botChat talk-bubble' onclick='chatSelection(this,{msg.id - 1})'><p>{escape(resp)}</p></div>"
-                ),
-                "#" + module.resolve_id("conversation"),
-            )
-            botLog.set(botLog.get() + "\n--- MENTOR:\n" + resp)
+            if scuirrel_shared.streamResponses:
+                # Make sure the bubble shows the complete reply
+                streamChat(msg.id - 1, resp, done=True)
+            else:
+                ui.insert_ui(
+                    HTML(
+                        f"<div class='botChat talk-bubble' onclick='chatSelection(this,{msg.id - 1})'><p>{escape(resp)}</p></div>"
+                    ),
+                    "#" + module.resolve_id("conversation"),
+                )
 
             # Now the LLM has finished the user can send a new response
             shared.elementDisplay(session, {"waitResp": "h"})
@@ -726,32 +1094,30 @@ def chat_server(
     @reactive.effect
     @reactive.event(input.feedbackChatSubmit)
     def _():
-        # Because multiple issues can be submitted for a single conversation, we have to commit to the
-        # DB immediately or it would become harder to keep track of TODO
-        # This means we add a temp mID which will be updated in the end
-        conn = shared.appDBConn(postgresUser)
-        cursor = conn.cursor()
-        fcID = shared.executeQuery(
-            cursor,
-            'INSERT INTO "feedback_chat"("dID","code","created","details") '
-            "VALUES(?,?,?,?)",
-            (
-                discussionID.get(),
-                int(input.feedbackChatCode()),
-                shared.dt(),
-                input.feedbackChatDetails(),
-            ),
-            lastRowId="fcID",
-        )
-        tempID = json.loads(input.selectedMsg())
-        tempID.sort()
-        _ = shared.executeQuery(
-            cursor,
-            f'INSERT INTO "feedback_chat_msg"("fcID","mID") VALUES({fcID},?)',
-            [(x,) for x in tempID],
-        )
-        conn.commit()
-        conn.close()
+        # Make sure all selected messages are in the DB so we can refer to their mID
+        saveMessages(force=True)
+        msg = messages.get()
+        with shared.appDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+            fcID = shared.executeQuery(
+                cursor,
+                'INSERT INTO "feedback_chat"("dID","code","created","details") '
+                "VALUES(?,?,?,?)",
+                (
+                    discussionID.get(),
+                    int(input.feedbackChatCode()),
+                    shared.dt(),
+                    input.feedbackChatDetails(),
+                ),
+                lastRowId="fcID",
+            )
+            mIDs = sorted(msg.mID[x] for x in json.loads(input.selectedMsg()))
+            _ = shared.executeQuery(
+                cursor,
+                f'INSERT INTO "feedback_chat_msg"("fcID","mID") VALUES({fcID},?)',
+                [(x,) for x in mIDs],
+            )
+            conn.commit()
         # Remove modal and show confirmation
         ui.modal_remove()
         ui.notification_show("Feedback successfully submitted!", duration=3)
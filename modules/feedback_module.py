@@ -63,21 +63,20 @@ def feedback_server(
     @reactive.effect
     @reactive.event(input.feedbackSubmit)
     def _():
-        conn = shared.appDBConn(postgresUser)
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "feedback_general"("sID","code","created","email","details") VALUES(?,?,?,?,?)',
-            (
-                sID,
-                input.feedbackCode(),
-                shared.dt(),
-                input.feedbackContact(),
-                input.feedbackDetails(),
-            ),
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "feedback_general"("sID","code","created","email","details") VALUES(?,?,?,?,?)',
+                (
+                    sID,
+                    input.feedbackCode(),
+                    shared.dt(),
+                    input.feedbackContact(),
+                    input.feedbackDetails(),
+                ),
+            )
+            conn.commit()
         ui.modal_remove()
         ui.notification_show("Thank you for sharing feedback", duration=3)
 
@@ -45,63 +45,63 @@ def group_join_server(
     @reactive.event(input.submitJoin)
     def addToGroup():
         # Check the access code
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        code = shared.accessCodeCheck(
-            conn, accessCode=input.accessCode(), codeType=2, uID=int(user.get()["uID"])
-        )
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            code = shared.accessCodeCheck(
+                conn,
+                accessCode=input.accessCode(),
+                codeType=2,
+                uID=int(user.get()["uID"]),
+            )
 
-        invalid = code is None
-        if invalid:
-            shared.inputNotification(session, "accessCode", "Invalid access code")
-            conn.close()
-            return None
+            invalid = code is None
+            if invalid:
+                shared.inputNotification(session, "accessCode", "Invalid access code")
+                return None
 
-        invalid = (
-            code["adminLevel"].iloc[0] < 2 and postgresUser == shared.postgresAccorns
-        )
-        if invalid:
-            shared.inputNotification(
-                session,
-                "accessCode",
-                "This access code only allows you to join this group as a user in SCUIRREL",
+            invalid = (
+                code["adminLevel"].iloc[0] < 2
+                and postgresUser == shared.postgresAccorns
             )
-            conn.close()
-            return None
-
-        invalid = groups.get()[groups.get()["gID"] == int(code["gID"].iloc[0])]
-        if invalid.shape[0] > 0:
-            shared.inputNotification(
-                session,
-                "accessCode",
-                f"You already are a member of group: {invalid.iloc[0]['group']}",
+            if invalid:
+                shared.inputNotification(
+                    session,
+                    "accessCode",
+                    "This access code only allows you to join this group as a user in SCUIRREL",
+                )
+                return None
+
+            invalid = groups.get()[groups.get()["gID"] == int(code["gID"].iloc[0])]
+            if invalid.shape[0] > 0:
+                shared.inputNotification(
+                    session,
+                    "accessCode",
+                    f"You already are a member of group: {invalid.iloc[0]['group']}",
+                )
+                return None
+
+            dt = shared.dt()
+
+            # Add user to group in the DB
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "group_member"("gID", "uID", "adminLevel", "added")'
+                "VALUES(?, ?, ?, ?)",
+                (
+                    int(code.iloc[0]["gID"]),
+                    int(user.get()["uID"]),
+                    int(code.iloc[0]["adminLevel"]),
+                    dt,
+                ),
             )
-            conn.close()
-            return None
-
-        dt = shared.dt()
-
-        # Add user to group in the DB
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "group_member"("gID", "uID", "adminLevel", "added")'
-            "VALUES(?, ?, ?, ?)",
-            (
-                int(code.iloc[0]["gID"]),
-                int(user.get()["uID"]),
-                int(code.iloc[0]["adminLevel"]),
-                dt,
-            ),
-        )
 
-        # Update the access code to be used
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "aID" = ?',
-            (int(user.get()["uID"]), dt, int(code.iloc[0]["aID"])),
-        )
-        conn.commit()
-        conn.close()
+            # Update the access code to be used
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "aID" = ?',
+                (int(user.get()["uID"]), dt, int(code.iloc[0]["aID"])),
+            )
+            conn.commit()
 
         ui.modal_remove()
 
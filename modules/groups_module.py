@@ -105,9 +105,8 @@ def groups_server(
     @reactive.effect
     @reactive.event(newGroup)
     def _():
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        newGroups = groupQuery(conn, user.get())
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            newGroups = groupQuery(conn, user.get())
         groups.set(newGroups)
 
     # ---
@@ -117,9 +116,8 @@ def groups_server(
     @reactive.event(user)
     def _():
         # Set reactive variables
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        groups.set(groupQuery(conn, user.get()))
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            groups.set(groupQuery(conn, user.get()))
 
     # Update group list based on user
     @reactive.effect
@@ -136,22 +134,21 @@ def groups_server(
     @reactive.effect
     @reactive.event(input.gID)
     def _():
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        members.set(
-            shared.pandasQuery(
-                conn,
-                (
-                    'SELECT m.*, u."username", u."fName", u."lName", u."email" '
-                    'FROM "group" AS g, "user" AS u, "group_member" AS m '
-                    'WHERE m."gID" = g."gID" AND m."uID" = u."uID" AND g."gID" = ?'
-                ),
-                params=(int(input.gID()),),
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            members.set(
+                shared.pandasQuery(
+                    conn,
+                    (
+                        'SELECT m.*, u."username", u."fName", u."lName", u."email" '
+                        'FROM "group" AS g, "user" AS u, "group_member" AS m '
+                        'WHERE m."gID" = g."gID" AND m."uID" = u."uID" AND g."gID" = ?'
+                    ),
+                    params=(int(input.gID()),),
+                )
+            )
+            groupCodes.set(
+                shared.pandasQuery(conn, accessCodesQuery, params=(int(input.gID()),))
             )
-        )
-        groupCodes.set(
-            shared.pandasQuery(conn, accessCodesQuery, params=(int(input.gID()),))
-        )
-        conn.close()
 
     # Members table
     @render.data_frame
@@ -199,25 +196,24 @@ def groups_server(
             return
 
         # Add new topic to DB
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        gID = shared.executeQuery(
-            cursor,
-            'INSERT INTO "group"("sID", "group", "created", "modified", "description")'
-            "VALUES(?, ?, ?, ?, ?)",
-            (sID, input.ngGroup(), shared.dt(), shared.dt(), input.ngDescr()),
-            lastRowId="gID",
-        )
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "group_member"("gID", "uID", "adminLevel", "added")'
-            "VALUES(?, ?, ?, ?)",
-            (gID, int(user.get()["uID"]), 2, shared.dt()),
-        )
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            gID = shared.executeQuery(
+                cursor,
+                'INSERT INTO "group"("sID", "group", "created", "modified", "description")'
+                "VALUES(?, ?, ?, ?, ?)",
+                (sID, input.ngGroup(), shared.dt(), shared.dt(), input.ngDescr()),
+                lastRowId="gID",
+            )
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "group_member"("gID", "uID", "adminLevel", "added")'
+                "VALUES(?, ?, ?, ?)",
+                (gID, int(user.get()["uID"]), 2, shared.dt()),
+            )
 
-        newGroups = groupQuery(conn, user.get())
-        conn.commit()
-        conn.close()
+            newGroups = groupQuery(conn, user.get())
+            conn.commit()
 
         groups.set(newGroups)
         ui.modal_remove()
@@ -227,23 +223,22 @@ def groups_server(
     @reactive.event(input.generateCodes)
     def newgroupCodes():
         req(user.get()["uID"] != 1)
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        newCodes = shared.generate_access_codes(
-            cursor=cursor,
-            codeType=2,
-            gID=int(input.gID()),
-            n=input.numCodes(),
-            creatorID=user.get()["uID"],
-            adminLevel=int(input.role()),
-            note=input.note(),
-        )
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            newCodes = shared.generate_access_codes(
+                cursor=cursor,
+                codeType=2,
+                gID=int(input.gID()),
+                n=input.numCodes(),
+                creatorID=user.get()["uID"],
+                adminLevel=int(input.role()),
+                note=input.note(),
+            )
 
-        groupCodes.set(
-            shared.pandasQuery(conn, accessCodesQuery, params=(int(input.gID()),))
-        )
-        conn.commit()
-        conn.close()
+            groupCodes.set(
+                shared.pandasQuery(conn, accessCodesQuery, params=(int(input.gID()),))
+            )
+            conn.commit()
 
         return newCodes
 
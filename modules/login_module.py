@@ -79,45 +79,40 @@ def login_server(
     minAdminLevel=0,
 ):
     # Default to anonymous
-    conn = shared.appDBConn(postgresUser=postgresUser)
-    user = shared.pandasQuery(conn, 'SELECT * FROM "user" WHERE "uID" = 1')
-    conn.close()
+    with shared.appDBConn(postgresUser=postgresUser) as conn:
+        user = shared.pandasQuery(conn, 'SELECT * FROM "user" WHERE "uID" = 1')
     user = reactive.value(user.to_dict(orient="records")[0])
 
     # Login
     @reactive.effect
     @reactive.event(input.login)
     def _():
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        userCheck = shared.authCheck(conn, input.username(), input.password())
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            userCheck = shared.authCheck(conn, input.username(), input.password())
 
-        if userCheck["user"] is None:
-            ui.notification_show("Invalid username")
-            conn.close()
-            return
+            if userCheck["user"] is None:
+                ui.notification_show("Invalid username")
+                return
 
-        if userCheck["adminLevel"] < minAdminLevel:
-            ui.notification_show(
-                "You do not have the required permissions to access this application"
-            )
-            conn.close()
-            return
+            if userCheck["adminLevel"] < minAdminLevel:
+                ui.notification_show(
+                    "You do not have the required permissions to access this application"
+                )
+                return
 
-        if not userCheck["password_check"]:
-            ui.notification_show("Incorrect password")
-            conn.close()
-            return
+            if not userCheck["password_check"]:
+                ui.notification_show("Incorrect password")
+                return
 
-        userCheck = userCheck["user"]
+            userCheck = userCheck["user"]
 
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "session" SET "uID" = ? WHERE "sID" = ?',
-            (int(userCheck.uID.iloc[0]), sessionID),
-        )
-        conn.commit()
-        conn.close()
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "session" SET "uID" = ? WHERE "sID" = ?',
+                (int(userCheck.uID.iloc[0]), sessionID),
+            )
+            conn.commit()
 
         # Clear the input fields
         ui.update_text_area("username", value="")
@@ -140,102 +135,97 @@ def login_server(
             return
 
         # Check if the username already exists
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        checkUser = shared.pandasQuery(
-            conn,
-            'SELECT * FROM "user" WHERE "username" = ?',
-            (username,),
-        )
-
-        if checkUser.shape[0] > 0:
-            ui.notification_show("Username already exists")
-            conn.close()
-            return
-
-        if shared.personalInfo:
-            # Check if the personal information is long enough
-            fName = input.firstName().strip()
-            lName = input.lastName().strip()
-            email = input.email().strip()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            checkUser = shared.pandasQuery(
+                conn,
+                'SELECT * FROM "user" WHERE "username" = ?',
+                (username,),
+            )
 
-            if len(fName) == 0:
-                ui.notification_show("First name cannot be empty")
-                conn.close()
-                return
-            if len(lName) == 0:
-                ui.notification_show("Last name cannot be empty")
-                conn.close()
+            if checkUser.shape[0] > 0:
+                ui.notification_show("Username already exists")
                 return
-            if re_search(shared.validEmail, email) is None:
-                ui.notification_show("Invalid email address")
-                conn.close()
+
+            if shared.personalInfo:
+                # Check if the personal information is long enough
+                fName = input.firstName().strip()
+                lName = input.lastName().strip()
+                email = input.email().strip()
+
+                if len(fName) == 0:
+                    ui.notification_show("First name cannot be empty")
+                    return
+                if len(lName) == 0:
+                    ui.notification_show("Last name cannot be empty")
+                    return
+                if re_search(shared.validEmail, email) is None:
+                    ui.notification_show("Invalid email address")
+                    return
+
+            # Check the password
+            pCheck = shared.passCheck(input.newPassword(), input.newPassword2())
+            if pCheck:
+                ui.notification_show(pCheck)
                 return
 
-        # Check the password
-        pCheck = shared.passCheck(input.newPassword(), input.newPassword2())
-        if pCheck:
-            ui.notification_show(pCheck)
-            conn.close()
-            return
+            code = shared.accessCodeCheck(conn=conn, accessCode=accessCode, codeType=0)
 
-        code = shared.accessCodeCheck(conn=conn, accessCode=accessCode, codeType=0)
+            if code is None:
+                ui.notification_show("Invalid access code")
+                return
 
-        if code is None:
-            ui.notification_show("Invalid access code")
-            conn.close()
-            return
+            # Create the user
+            hashed = bcrypt.hashpw(
+                input.newPassword().encode("utf-8"), bcrypt.gensalt()
+            )
 
-        # Create the user
-        hashed = bcrypt.hashpw(input.newPassword().encode("utf-8"), bcrypt.gensalt())
+            if shared.personalInfo:
+                newuID = shared.executeQuery(
+                    cursor,
+                    'INSERT INTO "user" ("username", "password", "adminLevel", "created", "modified", "fName", "lName", "email")'
+                    "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        username,
+                        hashed.decode("utf-8"),
+                        int(code["adminLevel"].iloc[0]),
+                        shared.dt(),
+                        shared.dt(),
+                        fName,
+                        lName,
+                        email,
+                    ),
+                    lastRowId="uID",
+                )
+            else:
+                newuID = shared.executeQuery(
+                    cursor,
+                    'INSERT INTO "user" ("username", "password", "adminLevel", "created", "modified")'
+                    "VALUES(?, ?, ?, ?, ?)",
+                    (
+                        username,
+                        hashed.decode("utf-8"),
+                        int(code["adminLevel"].iloc[0]),
+                        shared.dt(),
+                        shared.dt(),
+                    ),
+                    lastRowId="uID",
+                )
 
-        if shared.personalInfo:
-            newuID = shared.executeQuery(
+            # Update the access code to show it has been used
+            _ = shared.executeQuery(
                 cursor,
-                'INSERT INTO "user" ("username", "password", "adminLevel", "created", "modified", "fName", "lName", "email")'
-                "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    username,
-                    hashed.decode("utf-8"),
-                    int(code["adminLevel"].iloc[0]),
-                    shared.dt(),
-                    shared.dt(),
-                    fName,
-                    lName,
-                    email,
-                ),
-                lastRowId="uID",
-            )
-        else:
-            newuID = shared.executeQuery(
-                cursor,
-                'INSERT INTO "user" ("username", "password", "adminLevel", "created", "modified")'
-                "VALUES(?, ?, ?, ?, ?)",
-                (
-                    username,
-                    hashed.decode("utf-8"),
-                    int(code["adminLevel"].iloc[0]),
-                    shared.dt(),
-                    shared.dt(),
-                ),
-                lastRowId="uID",
+                'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "code" = ?',
+                (int(newuID), shared.dt(), accessCode),
             )
 
-        # Update the access code to show it has been used
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "code" = ?',
-            (int(newuID), shared.dt(), accessCode),
-        )
-
-        newUser = shared.pandasQuery(
-            conn,
-            'SELECT * FROM "user" WHERE "uID" = ?',
-            (int(newuID),),
-        )
+            newUser = shared.pandasQuery(
+                conn,
+                'SELECT * FROM "user" WHERE "uID" = ?',
+                (int(newuID),),
+            )
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         # Clear the input fields
         ui.update_text_area("newUsername", value="")
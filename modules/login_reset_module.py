@@ -38,9 +38,8 @@ def login_reset_server(
     postgresUser,
 ):
     # Default to anonymous
-    conn = shared.appDBConn(postgresUser=postgresUser)
-    user = shared.pandasQuery(conn, 'SELECT * FROM "user" WHERE "uID" = 1')
-    conn.close()
+    with shared.appDBConn(postgresUser=postgresUser) as conn:
+        user = shared.pandasQuery(conn, 'SELECT * FROM "user" WHERE "uID" = 1')
     user = reactive.value(user.to_dict(orient="records")[0])
 
     # Request reset code
@@ -49,47 +48,44 @@ def login_reset_server(
     def _():
         username = input.rUsername()
 
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        checkUser = shared.authCheck(conn, username, "")
-
-        invalid = checkUser["user"] is None
-        shared.inputNotification(
-            session, "rUsername", "This username does not exist", invalid
-        )
-
-        if invalid:
-            conn.close()
-            return
-
-        # Generate a new access code to be used for resetting password
-        cursor = conn.cursor()
-        uID = int(checkUser["user"]["uID"].iloc[0])
-
-        # Check if there are any existing, unused reset codes
-        existing = shared.pandasQuery(
-            conn,
-            'SELECT * FROM "accessCode" WHERE "uID_user" = ? AND "codeType" = 1 AND "used" IS NULL',
-            (uID,),
-        )
-
-        invalid = existing.shape[0] > 0
-        shared.inputNotification(
-            session,
-            "request",
-            "You already requested a new reset code, please contact your admin to get it",
-            invalid,
-        )
-
-        if invalid:
-            conn.close()
-            return
-
-        # Generate a new reset code
-        code = shared.generate_access_codes(
-            cursor=cursor, codeType=1, creatorID=uID, userID=uID
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            checkUser = shared.authCheck(conn, username, "")
+
+            invalid = checkUser["user"] is None
+            shared.inputNotification(
+                session, "rUsername", "This username does not exist", invalid
+            )
+
+            if invalid:
+                return
+
+            # Generate a new access code to be used for resetting password
+            cursor = conn.cursor()
+            uID = int(checkUser["user"]["uID"].iloc[0])
+
+            # Check if there are any existing, unused reset codes
+            existing = shared.pandasQuery(
+                conn,
+                'SELECT * FROM "accessCode" WHERE "uID_user" = ? AND "codeType" = 1 AND "used" IS NULL',
+                (uID,),
+            )
+
+            invalid = existing.shape[0] > 0
+            shared.inputNotification(
+                session,
+                "request",
+                "You already requested a new reset code, please contact your admin to get it",
+                invalid,
+            )
+
+            if invalid:
+                return
+
+            # Generate a new reset code
+            code = shared.generate_access_codes(
+                cursor=cursor, codeType=1, creatorID=uID, userID=uID
+            )
+            conn.commit()
 
         # Clear the input fields
         ui.update_text_area("rUsername", value="")
@@ -111,59 +107,57 @@ def login_reset_server(
         username = input.rUsername()
         accessCode = input.rAccessCode()
 
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        checkUser = shared.authCheck(conn, username, "")
-
-        invalid = checkUser["user"] is None
-        shared.inputNotification(
-            session, "rUsername", "This username does not exist", invalid
-        )
-
-        if invalid:
-            conn.close()
-            return
-
-        # Check the passwords
-        pCheck = shared.passCheck(input.rPassword(), input.rPassword2())
-        shared.inputNotification(session, "rPassword2", pCheck, pCheck)
-        if pCheck:
-            conn.close()
-            return
-
-        # Check the access code
-        code = shared.accessCodeCheck(
-            conn=conn,
-            accessCode=accessCode,
-            codeType=1,
-            uID=checkUser["user"]["uID"].iloc[0],
-        )
-
-        invalid = code is None
-        shared.inputNotification(session, "rAccessCode", "Invalid reset code", invalid)
-        if invalid:
-            conn.close()
-            return
-
-        # Update the password
-        cursor = conn.cursor()
-        uID = int(checkUser["user"]["uID"].iloc[0])
-        dt = shared.dt()
-
-        hashed = bcrypt.hashpw(input.rPassword().encode("utf-8"), bcrypt.gensalt())
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "user" SET "password" = ?, "modified" = ? WHERE "uID" = ?',
-            (hashed.decode("utf-8"), dt, uID),
-        )
-
-        # Update the access code to show it has been used
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "aID" = ?',
-            (uID, dt, int(code["aID"].iloc[0])),
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            checkUser = shared.authCheck(conn, username, "")
+
+            invalid = checkUser["user"] is None
+            shared.inputNotification(
+                session, "rUsername", "This username does not exist", invalid
+            )
+
+            if invalid:
+                return
+
+            # Check the passwords
+            pCheck = shared.passCheck(input.rPassword(), input.rPassword2())
+            shared.inputNotification(session, "rPassword2", pCheck, pCheck)
+            if pCheck:
+                return
+
+            # Check the access code
+            code = shared.accessCodeCheck(
+                conn=conn,
+                accessCode=accessCode,
+                codeType=1,
+                uID=checkUser["user"]["uID"].iloc[0],
+            )
+
+            invalid = code is None
+            shared.inputNotification(
+                session, "rAccessCode", "Invalid reset code", invalid
+            )
+            if invalid:
+                return
+
+            # Update the password
+            cursor = conn.cursor()
+            uID = int(checkUser["user"]["uID"].iloc[0])
+            dt = shared.dt()
+
+            hashed = bcrypt.hashpw(input.rPassword().encode("utf-8"), bcrypt.gensalt())
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "user" SET "password" = ?, "modified" = ? WHERE "uID" = ?',
+                (hashed.decode("utf-8"), dt, uID),
+            )
+
+            # Update the access code to show it has been used
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "accessCode" SET "uID_user" = ?, "used" = ? WHERE "aID" = ?',
+                (uID, dt, int(code["aID"].iloc[0])),
+            )
+            conn.commit()
 
         # Clear the input fields
         ui.update_text_area("rUsername", value="")
@@ -6,8 +6,6 @@ import ACCORNS.accorns_shared as accorns_shared
 
 # -- General
 import pandas as pd
-import json
-import asyncio
 import regex as re
 
 # -- Shiny
@@ -17,6 +15,35 @@ from htmltools import HTML, div, br
 # -- Llamaindex
 from llama_index.core import ChatPromptTemplate
 from llama_index.core.llms import ChatMessage, MessageRole
+from pydantic import BaseModel, field_validator
+
+
+# --- Classes ---
+
+
+# Structured output of the quiz generator (function calling)
+class QuizQuestion(BaseModel):
+    """Multiple choice question with one correct option and an explanation per option"""
+
+    question: str
+    answer: str
+    optionA: str
+    explanationA: str
+    optionB: str
+    explanationB: str
+    optionC: str
+    explanationC: str
+    optionD: str
+    explanationD: str
+
+    # Make sure only to keep one capital letter for the answer
+    @field_validator("answer")
+    @classmethod
+    def answerLetter(cls, answer):
+        letter = re.search("[A-D]", answer)
+        if letter is None:
+            raise ValueError(f"The answer should be A, B, C or D, not {answer}")
+        return letter.group(0)
 
 
 # --- Functions ---
@@ -68,8 +95,8 @@ def qDisplayNames(questions, input, selected=None):
     return
 
 
-# LLM engine for generation
-def quizEngine():
+# LLM engine for generation, searching the files with the given fIDs (all if None)
+def quizEngine(fIDs=None):
     qa_prompt_str = (
         "Context information is below.\n"
         "---------------------\n"
@@ -139,7 +166,9 @@ The output should be a python dictionary according to the template below. Make s
     return index.as_query_engine(
         text_qa_template=text_qa_template,
         refine_template=refine_template,
-        llm=shared.llm,
+        llm=shared.getLLM("quiz"),
+        output_cls=QuizQuestion,
+        filters=shared.fileFilters(fIDs),
     )
 
 
@@ -221,7 +250,6 @@ def quiz_generation_server(
     topicsx,
     groups,
     postgresUser,
-    pool,
 ):
     topics = reactive.value(None)
     questions = reactive.value(None)
@@ -250,17 +278,16 @@ def quiz_generation_server(
     @reactive.event(input.gID, topicsx)
     def _():
         # Get all active topics from the accorns database
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        activeTopics = shared.pandasQuery(
-            conn,
-            (
-                'SELECT t.* FROM "topic" AS t, "group_topic" AS gt '
-                'WHERE t."tID" = gt."tID" AND gt."gID" = ? AND t."status" = 0 '
-                'ORDER BY t."topic"'
-            ),
-            (int(input.gID()),),
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            activeTopics = shared.pandasQuery(
+                conn,
+                (
+                    'SELECT t.* FROM "topic" AS t, "group_topic" AS gt '
+                    'WHERE t."tID" = gt."tID" AND gt."gID" = ? AND t."status" = 0 '
+                    'ORDER BY t."topic"'
+                ),
+                (int(input.gID()),),
+            )
 
         ui.update_select(
             "qtID", choices=dict(zip(activeTopics["tID"], activeTopics["topic"]))
@@ -320,26 +347,24 @@ def quiz_generation_server(
         # Get the topic
         topic = topics.get()[topics.get()["tID"] == int(input.qtID())].iloc[0]["topic"]
 
-        conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-
-        # Get the concept with the least questions
-        conceptList = shared.pandasQuery(
-            conn,
-            'SELECT "cID", max("concept") as "concept", count(*) as n FROM '
-            f'(SELECT "cID", "concept" FROM "concept" WHERE "tID" = {int(input.qtID())} AND "status" = 0 '
-            f'UNION ALL SELECT "cID", \'\' as concept FROM "question" where "tID" = {int(input.qtID())}) GROUP BY "cID"',
-        )
+        with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+            # Get the concept with the least questions
+            conceptList = shared.pandasQuery(
+                conn,
+                'SELECT "cID", max("concept") as "concept", count(*) as n FROM '
+                f'(SELECT "cID", "concept" FROM "concept" WHERE "tID" = {int(input.qtID())} AND "status" = 0 '
+                f'UNION ALL SELECT "cID", \'\' as concept FROM "question" where "tID" = {int(input.qtID())}) GROUP BY "cID"',
+            )
 
-        cID = int(
-            conceptList[conceptList["n"] == min(conceptList["n"])]
-            .sample(1)["cID"]
-            .iloc[0]
-        )
-        prevQuestions = shared.pandasQuery(
-            conn,
-            f'SELECT "question" FROM "question" WHERE "cID" = {cID} AND "status" = 0',
-        )
-        conn.close()
+            cID = int(
+                conceptList[conceptList["n"] == min(conceptList["n"])]
+                .sample(1)["cID"]
+                .iloc[0]
+            )
+            prevQuestions = shared.pandasQuery(
+                conn,
+                f'SELECT "question" FROM "question" WHERE "cID" = {cID} AND "status" = 0',
+            )
 
         focusConcept = "* ".join(conceptList[conceptList["cID"] == cID]["concept"])
         conceptList = "* " + "\n* ".join(conceptList["concept"])
@@ -359,35 +384,51 @@ def quiz_generation_server(
     The question should center around the following concept:
     {focusConcept}\n
     {prevQuestions}"""
-        botResponse(quizEngine(), info, cID)
+        botResponse(
+            quizEngine(shared.topicFiles(shared.postgresAccorns, input.qtID())),
+            info,
+            cID,
+        )
 
-    def botResponse_task(quizEngine, info, cID):
-        # Given the LLM output might not be correct format (or fails to convert to a DF, try again if needed)
+    async def botResponse_task(quizEngine, info, cID):
+        # The output is constrained to QuizQuestion, only try again if it is not valid
         valid = False
         tries = 0
         while not valid:
             try:
-                x = str(quizEngine.query(info))
-                resp = pd.json_normalize(json.loads(x))
-                # Make sure only to keep one capital letter for the answer
-                resp["answer"] = re.search("[A-D]", resp["answer"].iloc[0]).group(0)[0]
+                # Each try is an LLM call with its own slot of the LLM scheduler
+                async with shared.llmScheduler.slot(
+                    session.id, shared.llmPriority["quiz"], shared.estimateTokens(info)
+                ):
+                    x = await quizEngine.aquery(info)
+                x = shared.parseStructured(x, QuizQuestion)
+                resp = pd.DataFrame([x.model_dump()])
                 valid = True
+            except ValueError as e:
+                print(("Failed to generate quiz question\n" + str(e)))
+                if tries > 1:
+                    shared.recordParse("quiz", failures=tries + 1, retries=tries)
+                    return {"resp": None, "cID": cID}
+                tries += 1
             except Exception as e:
+                # Other errors (e.g. the LLM API) are not retried but still reported
                 import traceback
 
                 print(("Failed to generate quiz question\n" + str(e)))
                 print(traceback.format_exc())
-                if tries > 1:
-                    return {"resp": None, "cID": cID}
-                tries += 1
+                shared.recordParse("quiz", failures=tries, retries=tries)
+                return {"resp": None, "cID": cID}
 
+        shared.recordParse("quiz", failures=tries, retries=tries)
         return {"resp": resp, "cID": cID}
 
     # Async Shiny task waiting for LLM reply
     @reactive.extended_task
     async def botResponse(quizEngine, info, cID):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(pool, botResponse_task, quizEngine, info, cID)
+        return await botResponse_task(quizEngine, info, cID)
+
+    # Stop waiting for the LLM when the session ends
+    _ = session.on_ended(botResponse.cancel)
 
     # Processing LLM response
     @reactive.effect
@@ -405,39 +446,38 @@ def quiz_generation_server(
         with reactive.isolate():
             q = resp["resp"].iloc[0]  # For now only processing one
             # Save the questions in the appAB
-            conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-            cursor = conn.cursor()
-            # Insert question
-            qID = shared.executeQuery(
-                cursor,
-                'INSERT INTO "question"("sID","tID","cID","question","answer","status","created","modified",'
-                '"optionA","explanationA","optionB","explanationB","optionC","explanationC","optionD","explanationD")'
-                "VALUES(?,?,?,?,?,1,?,?,?,?,?,?,?,?,?,?)",
-                (
-                    sID,
-                    int(input.qtID()),
-                    resp["cID"],
-                    q["question"],
-                    q["answer"],
-                    shared.dt(),
-                    shared.dt(),
-                    q["optionA"],
-                    q["explanationA"],
-                    q["optionB"],
-                    q["explanationB"],
-                    q["optionC"],
-                    q["explanationC"],
-                    q["optionD"],
-                    q["explanationD"],
-                ),
-                lastRowId="qID",
-            )
-            q = shared.pandasQuery(
-                conn,
-                f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
-            )
-            conn.commit()
-            conn.close()
+            with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+                cursor = conn.cursor()
+                # Insert question
+                qID = shared.executeQuery(
+                    cursor,
+                    'INSERT INTO "question"("sID","tID","cID","question","answer","status","created","modified",'
+                    '"optionA","explanationA","optionB","explanationB","optionC","explanationC","optionD","explanationD")'
+                    "VALUES(?,?,?,?,?,1,?,?,?,?,?,?,?,?,?,?)",
+                    (
+                        sID,
+                        int(input.qtID()),
+                        resp["cID"],
+                        q["question"],
+                        q["answer"],
+                        shared.dt(),
+                        shared.dt(),
+                        q["optionA"],
+                        q["explanationA"],
+                        q["optionB"],
+                        q["explanationB"],
+                        q["optionC"],
+                        q["explanationC"],
+                        q["optionD"],
+                        q["explanationD"],
+                    ),
+                    lastRowId="qID",
+                )
+                q = shared.pandasQuery(
+                    conn,
+                    f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
+                )
+                conn.commit()
 
             questions.set(q)
             qDisplayNames(q, input, qID)
@@ -463,12 +503,11 @@ def quiz_generation_server(
         tID = int(input.qtID()) if input.qtID() else 0
 
         # Get the question info from the DB
-        conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-        q = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "question" WHERE "tID" = {tID} ',
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+            q = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "question" WHERE "tID" = {tID} ',
+            )
 
         if q.shape[0] == 0:
             shared.elementDisplay(session, {"qEditPanel": "h", "qShowArchived": "d"})
@@ -569,58 +608,57 @@ def quiz_generation_server(
         # Get the original question
         q = questions.get()[questions.get()["qID"] == int(input.qID())].iloc[0]
 
-        conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-        cursor = conn.cursor()
-
-        fields = {
-            "rqQuestion": "question",
-            "rqCorrect": "answer",
-            "rqOA": "optionA",
-            "rqOAexpl": "explanationA",
-            "rqOB": "optionB",
-            "rqOBexpl": "explanationB",
-            "rqOC": "optionC",
-            "rqOCexpl": "explanationC",
-            "rqOD": "optionD",
-            "rqODexpl": "explanationD",
-        }
-        now = shared.dt()
-
-        # Backup any changes
-        updates = []
-        values = ()
-        for element, column in fields.items():
-            if input[element].get().strip() != q[column]:
-                accorns_shared.backupQuery(
-                    cursor,
-                    sID,
-                    "question",
-                    q["qID"],
-                    column,
-                    dataType="str",
-                    isBot=False,
-                    timeStamp=now,
+        with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+            cursor = conn.cursor()
+
+            fields = {
+                "rqQuestion": "question",
+                "rqCorrect": "answer",
+                "rqOA": "optionA",
+                "rqOAexpl": "explanationA",
+                "rqOB": "optionB",
+                "rqOBexpl": "explanationB",
+                "rqOC": "optionC",
+                "rqOCexpl": "explanationC",
+                "rqOD": "optionD",
+                "rqODexpl": "explanationD",
+            }
+            now = shared.dt()
+
+            # Backup any changes
+            updates = []
+            values = ()
+            for element, column in fields.items():
+                if input[element].get().strip() != q[column]:
+                    accorns_shared.backupQuery(
+                        cursor,
+                        sID,
+                        "question",
+                        q["qID"],
+                        column,
+                        dataType="str",
+                        isBot=False,
+                        timeStamp=now,
+                    )
+                    updates.append(f'"{column}" = ?')
+                    values += (input[element].get().strip(),)
+            # Update the question
+            if updates != []:
+                updates = ",".join(updates) + f", \"modified\" = '{now}'"
+                values += (int(q["qID"]),)
+                _ = shared.executeQuery(
+                    cursor, f'UPDATE "question" SET {updates} WHERE "qID" = ?', values
                 )
-                updates.append(f'"{column}" = ?')
-                values += (input[element].get().strip(),)
-        # Update the question
-        if updates != []:
-            updates = ",".join(updates) + f", \"modified\" = '{now}'"
-            values += (int(q["qID"]),)
-            _ = shared.executeQuery(
-                cursor, f'UPDATE "question" SET {updates} WHERE "qID" = ?', values
-            )
-            q = shared.pandasQuery(
-                conn,
-                f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
-            )
-            conn.commit()
-            questions.set(q)
-            ui.notification_show("Your edits were successfully saved")
-        else:
-            ui.notification_show("No changes were detected. Nothing was saved")
+                q = shared.pandasQuery(
+                    conn,
+                    f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
+                )
+                conn.commit()
+                questions.set(q)
+                ui.notification_show("Your edits were successfully saved")
+            else:
+                ui.notification_show("No changes were detected. Nothing was saved")
 
-        conn.close()
         ui.modal_remove()
 
     @reactive.effect
@@ -652,20 +690,19 @@ def quiz_generation_server(
         ] == int(input.qStatus()):
             return
 
-        conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "question" SET "status" = ? WHERE "qID" = ?',
-            (int(input.qStatus()), int(input.qID())),
-        )
+        with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "question" SET "status" = ? WHERE "qID" = ?',
+                (int(input.qStatus()), int(input.qID())),
+            )
 
-        q = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
-        )
-        conn.commit()
-        conn.close()
+            q = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "question" WHERE "tID" = {int(input.qtID())}',
+            )
+            conn.commit()
 
         questions.set(q)
         qDisplayNames(q, input)
@@ -30,13 +30,12 @@ def quiz_server(input: Inputs, output: Outputs, session: Session, tID, sID, user
     @reactive.event(tID)
     def _():
         # Get a random question on the topic from the DB
-        conn = shared.appDBConn(postgresScuirrel)
-        q = shared.pandasQuery(
-            conn,
-            'SELECT "qID" FROM "question" WHERE "tID" = ? AND "status" = 0 LIMIT 1',
-            params=(int(tID()),),
-        )
-        conn.close()
+        with shared.appDBConn(postgresScuirrel) as conn:
+            q = shared.pandasQuery(
+                conn,
+                'SELECT "qID" FROM "question" WHERE "tID" = ? AND "status" = 0 LIMIT 1',
+                params=(int(tID()),),
+            )
 
         if q.empty:
             elementDisplay(session, {"quizQuestion": "h"})
@@ -49,13 +48,12 @@ def quiz_server(input: Inputs, output: Outputs, session: Session, tID, sID, user
     @reactive.event(input.quizQuestion)
     def _():
         # Get a random question on the topic from the DB
-        conn = shared.appDBConn(postgresScuirrel)
-        q = shared.pandasQuery(
-            conn,
-            'SELECT * FROM "question" WHERE "tID" = ? AND "status" = 0',
-            params=(int(tID()),),
-        )
-        conn.close()
+        with shared.appDBConn(postgresScuirrel) as conn:
+            q = shared.pandasQuery(
+                conn,
+                'SELECT * FROM "question" WHERE "tID" = ? AND "status" = 0',
+                params=(int(tID()),),
+            )
 
         q = q.sample(1).iloc[0].to_dict()
         q["start"] = shared.dt()
@@ -133,24 +131,23 @@ def quiz_server(input: Inputs, output: Outputs, session: Session, tID, sID, user
             q["correct"] = None
 
         # Add the response to the DB
-        conn = shared.appDBConn(postgresScuirrel)
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "response" ("sID", "qID", "response", "correct", "start", "check", "end")'
-            "VALUES(?, ?, ?, ?, ?, ?, ?)",
-            (
-                sID,
-                q["qID"],
-                q["response"],
-                q["correct"],
-                q["start"],
-                q["check"],
-                shared.dt(),
-            ),
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresScuirrel) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "response" ("sID", "qID", "response", "correct", "start", "check", "end")'
+                "VALUES(?, ?, ?, ?, ?, ?, ?)",
+                (
+                    sID,
+                    q["qID"],
+                    q["response"],
+                    q["correct"],
+                    q["start"],
+                    q["check"],
+                    shared.dt(),
+                ),
+            )
+            conn.commit()
         ui.modal_remove()
 
     return
@@ -2,7 +2,7 @@
 # --------------------------
 
 # -- Shiny
-from shiny import Inputs, Outputs, Session, module, reactive, ui, render, module
+from shiny import Inputs, Outputs, Session, module, reactive, ui, render, module, req
 from htmltools import HTML, div
 
 import shared.shared as shared
@@ -126,13 +126,35 @@ def topics_ui():
                 ),
             ),
         ),
+        # Files searched for context on the topic
+        ui.panel_conditional(
+            "input.tID",
+            ui.card(
+                ui.card_header("Files used for the topic"),
+                ui.input_selectize(
+                    "tFiles", None, choices={}, multiple=True, width="100%"
+                ),
+                div(ui.input_action_button("tFilesSave", "Save files", width="180px")),
+                HTML(
+                    "<i>SCUIRREL and the quiz generation only search these files for context on the topic. "
+                    "This is faster and keeps out unrelated documents. Leave empty to search all files</i>"
+                ),
+            ),
+        ),
     ]
 
 
 # --- Server ---
 @module.server
 def topics_server(
-    input: Inputs, output: Outputs, session: Session, sID, user, groups, postgresUser
+    input: Inputs,
+    output: Outputs,
+    session: Session,
+    sID,
+    user,
+    groups,
+    files,
+    postgresUser,
 ):
     topics = reactive.value(None)
     concepts = reactive.value(None)
@@ -171,9 +193,8 @@ def topics_server(
         # req(user.get()["uID"] != 1)
 
         # Get all active topics from the accorns database
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        topicsList = topicsQuery(conn, input.gID())
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            topicsList = topicsQuery(conn, input.gID())
 
         # IN case there are no topics (including archived) hide the show archived button
         if topicsList.shape[0] == 0:
@@ -204,15 +225,60 @@ def topics_server(
         ui.update_radio_buttons("tStatus", selected=str(status))
 
         tID = input.tID() if input.tID() else 0
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        conceptList = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "concept" WHERE "tID" = {tID} AND "status" = 0 ORDER BY "order"',
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            conceptList = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "concept" WHERE "tID" = {tID} AND "status" = 0 ORDER BY "order"',
+            )
 
         concepts.set(conceptList)
 
+    # --- Load the files searched for the topic when a topic is selected
+    @reactive.effect
+    @reactive.event(input.tID, files)
+    def _():
+        req(input.tID())
+        fIDs = shared.topicFiles(postgresUser, input.tID()) or []
+        fileList = files.get()
+        ui.update_selectize(
+            "tFiles",
+            choices=dict(
+                zip(
+                    fileList["fID"].astype(str),
+                    fileList["title"].fillna(fileList["fileName"]),
+                )
+            ),
+            selected=[str(x) for x in fIDs],
+        )
+
+    # When the save files button is clicked
+    @reactive.effect
+    @reactive.event(input.tFilesSave)
+    def _():
+        req(input.tID())
+        tID = int(input.tID())
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor, 'DELETE FROM "topic_file" WHERE "tID" = ?', (tID,)
+            )
+            if input.tFiles():
+                _ = shared.executeQuery(
+                    cursor,
+                    'INSERT INTO "topic_file"("tID", "fID", "uID", "added") VALUES(?, ?, ?, ?)',
+                    [
+                        (tID, int(x), int(user.get()["uID"]), shared.dt())
+                        for x in input.tFiles()
+                    ],
+                )
+            conn.commit()
+
+        ui.notification_show(
+            f"The topic now uses {len(input.tFiles())} files"
+            if input.tFiles()
+            else "The topic now uses all files"
+        )
+
     @reactive.effect
     @reactive.event(input.tShowArchived, ignore_init=True)
     def _():
@@ -255,25 +321,24 @@ def topics_server(
             shared.inputNotification(session, "ntDescr", show=False)
 
         # Add new topic to DB
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        dt = shared.dt()
-        tID = shared.executeQuery(
-            cursor,
-            'INSERT INTO "topic"("sID", "topic", "created", "modified", "description")'
-            "VALUES(?, ?, ?, ?, ?)",
-            (sID, input.ntTopic(), dt, dt, input.ntDescr()),
-            lastRowId="tID",
-        )
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            dt = shared.dt()
+            tID = shared.executeQuery(
+                cursor,
+                'INSERT INTO "topic"("sID", "topic", "created", "modified", "description")'
+                "VALUES(?, ?, ?, ?, ?)",
+                (sID, input.ntTopic(), dt, dt, input.ntDescr()),
+                lastRowId="tID",
+            )
 
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "group_topic"("gID", "tID", "uID", "added") VALUES(?, ?, ?, ?)',
-            (int(input.gID()), tID, int(user.get()["uID"]), dt),
-        )
-        newTopics = topicsQuery(conn, input.gID())
-        conn.commit()
-        conn.close()
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "group_topic"("gID", "tID", "uID", "added") VALUES(?, ?, ?, ?)',
+                (int(input.gID()), tID, int(user.get()["uID"]), dt),
+            )
+            newTopics = topicsQuery(conn, input.gID())
+            conn.commit()
 
         # Update the topics select input
         tDisplayNames(newTopics, input, session, selected=tID)
@@ -330,40 +395,39 @@ def topics_server(
             shared.inputNotification(session, "etInput", show=False)
 
         # Update the DB
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        # Backup old values
-        ts = shared.dt()
-        accorns_shared.backupQuery(
-            cursor=cursor,
-            sID=sID,
-            table="topic",
-            rowID=input.tID(),
-            attribute="topic",
-            dataType="str",
-            isBot=False,
-            timeStamp=ts,
-        )
-        accorns_shared.backupQuery(
-            cursor=cursor,
-            sID=sID,
-            table="topic",
-            rowID=input.tID(),
-            attribute="sID",
-            dataType="int",
-            isBot=False,
-            timeStamp=ts,
-        )
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            # Backup old values
+            ts = shared.dt()
+            accorns_shared.backupQuery(
+                cursor=cursor,
+                sID=sID,
+                table="topic",
+                rowID=input.tID(),
+                attribute="topic",
+                dataType="str",
+                isBot=False,
+                timeStamp=ts,
+            )
+            accorns_shared.backupQuery(
+                cursor=cursor,
+                sID=sID,
+                table="topic",
+                rowID=input.tID(),
+                attribute="sID",
+                dataType="int",
+                isBot=False,
+                timeStamp=ts,
+            )
 
-        # Update to new
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "topic" SET "sID" = ?, "topic" = ?, "modified" = ? WHERE "tID" = ?',
-            (sID, input.etInput(), shared.dt(), input.tID()),
-        )
-        conn.commit()
-        topicsList = topicsQuery(conn, input.gID())
-        conn.close()
+            # Update to new
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "topic" SET "sID" = ?, "topic" = ?, "modified" = ? WHERE "tID" = ?',
+                (sID, input.etInput(), shared.dt(), input.tID()),
+            )
+            conn.commit()
+            topicsList = topicsQuery(conn, input.gID())
 
         tDisplayNames(topicsList, input, session)
 
@@ -422,17 +486,16 @@ def topics_server(
         if statusCode == prevStatus:
             return
 
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "topic" SET "status" = ?, "modified" = ? WHERE "tID" = ?',
-            (statusCode, shared.dt(), input.tID()),
-        )
-        newTopics = topicsQuery(conn, input.gID())
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "topic" SET "status" = ?, "modified" = ? WHERE "tID" = ?',
+                (statusCode, shared.dt(), input.tID()),
+            )
+            newTopics = topicsQuery(conn, input.gID())
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         tDisplayNames(newTopics, input, session)
 
@@ -486,19 +549,25 @@ def topics_server(
         order = concepts.get()["order"].tolist()
         order = 1 if len(order) == 0 else max(order) + 1
 
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        _ = shared.executeQuery(
-            cursor,
-            'INSERT INTO "concept"("sID", "tID", "order", "concept", "created", "modified") VALUES(?, ?, ?, ?, ?, ?)',
-            (sID, input.tID(), int(order), input.ncInput(), shared.dt(), shared.dt()),
-        )
-        conceptList = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = shared.executeQuery(
+                cursor,
+                'INSERT INTO "concept"("sID", "tID", "order", "concept", "created", "modified") VALUES(?, ?, ?, ?, ?, ?)',
+                (
+                    sID,
+                    input.tID(),
+                    int(order),
+                    input.ncInput(),
+                    shared.dt(),
+                    shared.dt(),
+                ),
+            )
+            conceptList = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
+            )
+            conn.commit()
         # Update concept table
         concepts.set(conceptList)
         ui.modal_remove()
@@ -552,42 +621,41 @@ def topics_server(
         cID = concepts.get().iloc[conceptsTable.data_view(selected=True).index[0]][
             "cID"
         ]
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        # Backup old value
-        ts = shared.dt()
-        accorns_shared.backupQuery(
-            cursor=cursor,
-            sID=sID,
-            table="concept",
-            rowID=int(cID),
-            attribute="concept",
-            dataType="str",
-            isBot=False,
-            timeStamp=ts,
-        )
-        accorns_shared.backupQuery(
-            cursor=cursor,
-            sID=sID,
-            table="concept",
-            rowID=int(cID),
-            attribute="sID",
-            dataType="int",
-            isBot=False,
-            timeStamp=ts,
-        )
-        # Update to new
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "concept" SET "sID" = ?, "concept" = ?, "modified" = ? WHERE "cID" = ?',
-            (sID, input.ecInput(), shared.dt(), int(cID)),
-        )
-        conceptList = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            # Backup old value
+            ts = shared.dt()
+            accorns_shared.backupQuery(
+                cursor=cursor,
+                sID=sID,
+                table="concept",
+                rowID=int(cID),
+                attribute="concept",
+                dataType="str",
+                isBot=False,
+                timeStamp=ts,
+            )
+            accorns_shared.backupQuery(
+                cursor=cursor,
+                sID=sID,
+                table="concept",
+                rowID=int(cID),
+                attribute="sID",
+                dataType="int",
+                isBot=False,
+                timeStamp=ts,
+            )
+            # Update to new
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "concept" SET "sID" = ?, "concept" = ?, "modified" = ? WHERE "cID" = ?',
+                (sID, input.ecInput(), shared.dt(), int(cID)),
+            )
+            conceptList = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
+            )
+            conn.commit()
         # Update concept table
         concepts.set(conceptList)
         ui.modal_remove()
@@ -602,27 +670,26 @@ def topics_server(
         cID = concepts.get().iloc[conceptsTable.data_view(selected=True).index[0]][
             "cID"
         ]
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        # Set the status of the concept to archived
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "concept" SET "status" = 1, "modified" = ? WHERE "cID" = ?',
-            (shared.dt(), int(cID)),
-        )
-        # Make sure to archive any related quiz questions
-        _ = shared.executeQuery(
-            cursor,
-            'UPDATE "question" SET "status" = 1, "modified" = ? WHERE "cID" = ?',
-            (shared.dt(), int(cID)),
-        )
-        # Get the new list of active concepts
-        conceptList = shared.pandasQuery(
-            conn,
-            f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            # Set the status of the concept to archived
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "concept" SET "status" = 1, "modified" = ? WHERE "cID" = ?',
+                (shared.dt(), int(cID)),
+            )
+            # Make sure to archive any related quiz questions
+            _ = shared.executeQuery(
+                cursor,
+                'UPDATE "question" SET "status" = 1, "modified" = ? WHERE "cID" = ?',
+                (shared.dt(), int(cID)),
+            )
+            # Get the new list of active concepts
+            conceptList = shared.pandasQuery(
+                conn,
+                f'SELECT * FROM "concept" WHERE "tID" = {input.tID()} AND "status" = 0 ORDER BY "order"',
+            )
+            conn.commit()
 
         concepts.set(conceptList)
 
@@ -687,29 +754,30 @@ def topics_server(
             shared.inputNotification(session, "rcNewOrder", show=False)
 
         # Get the connection to the database
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        ts = shared.dt()
-        for _, row in changedOrder.iterrows():
-            # Backup old value
-            accorns_shared.backupQuery(
-                cursor=cursor,
-                sID=sID,
-                table="concept",
-                rowID=row["cID"],
-                attribute="order",
-                dataType="int",
-                isBot=False,
-                timeStamp=ts,
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            ts = shared.dt()
+            for _, row in changedOrder.iterrows():
+                # Backup old value
+                accorns_shared.backupQuery(
+                    cursor=cursor,
+                    sID=sID,
+                    table="concept",
+                    rowID=row["cID"],
+                    attribute="order",
+                    dataType="int",
+                    isBot=False,
+                    timeStamp=ts,
+                )
+            # Update the order of the concept with changedOrder["newOrder"] for changedOrder["cID"]
+            _ = shared.executeQuery(
+                cursor,
+                f'UPDATE "concept" SET "order" = ?, "modified" = \'{ts}\' WHERE "cID" = ?',
+                list(
+                    changedOrder[["newOrder", "cID"]].itertuples(index=False, name=None)
+                ),
             )
-        # Update the order of the concept with changedOrder["newOrder"] for changedOrder["cID"]
-        _ = shared.executeQuery(
-            cursor,
-            f'UPDATE "concept" SET "order" = ?, "modified" = \'{ts}\' WHERE "cID" = ?',
-            list(changedOrder[["newOrder", "cID"]].itertuples(index=False, name=None)),
-        )
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         # Replace the order with newOrder and remove the newOrder column
         newConcepts["order"] = newConcepts["newOrder"]
@@ -11,18 +11,16 @@ import shared.shared as shared
 
 
 def getAccessCodes(uID, adminLevel):
-    conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-    # Admins can see all codes, instructors only their own
-    if adminLevel < 3:
-        query = f'SELECT * FROM "accessCode" WHERE "uID_creator" = {uID} AND "used" IS NULL AND "adminLevel" IS NOT NULL'
-        result = shared.pandasQuery(conn, query=query)
-        result = result[["code", "adminLevel", "created", "note"]]
-    else:
-        query = 'SELECT * FROM "accessCode" WHERE "used" IS NULL AND "adminLevel" IS NOT NULL'
-        result = shared.pandasQuery(conn, query=query)
-        result = result.drop(columns=["uID_user", "used"])
-
-    conn.close()
+    with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+        # Admins can see all codes, instructors only their own
+        if adminLevel < 3:
+            query = f'SELECT * FROM "accessCode" WHERE "uID_creator" = {uID} AND "used" IS NULL AND "adminLevel" IS NOT NULL'
+            result = shared.pandasQuery(conn, query=query)
+            result = result[["code", "adminLevel", "created", "note"]]
+        else:
+            query = 'SELECT * FROM "accessCode" WHERE "used" IS NULL AND "adminLevel" IS NOT NULL'
+            result = shared.pandasQuery(conn, query=query)
+            result = result.drop(columns=["uID_user", "used"])
 
     result["adminLevel"] = [shared.adminLevels[i] for i in result["adminLevel"]]
     return result
@@ -91,16 +89,15 @@ def user_management_server(
     # Render the table with the reset codes for the users who requested a password reset
     @render.data_frame
     def resetTable():
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        resetTable = shared.pandasQuery(
-            conn,
-            (
-                'SELECT u."username", a."code" AS "resetCode", u."fName", u."lName", u."email" '
-                'FROM "accessCode" AS a, "user" AS u WHERE a."uID_user" = u."uID" '
-                'AND a."codeType" = 1 AND a."used" IS NULL'
-            ),
-        )
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            resetTable = shared.pandasQuery(
+                conn,
+                (
+                    'SELECT u."username", a."code" AS "resetCode", u."fName", u."lName", u."email" '
+                    'FROM "accessCode" AS a, "user" AS u WHERE a."uID_user" = u."uID" '
+                    'AND a."codeType" = 1 AND a."used" IS NULL'
+                ),
+            )
 
         return render.DataTable(resetTable, width="100%", height="auto")
 
@@ -109,18 +106,17 @@ def user_management_server(
     @reactive.event(input.generateCodes)
     def newAccessCodes():
         req(user.get()["uID"] != 1)
-        conn = shared.appDBConn(postgresUser=postgresUser)
-        cursor = conn.cursor()
-        newCodes = shared.generate_access_codes(
-            cursor=cursor,
-            codeType=0,
-            n=input.numCodes(),
-            creatorID=user.get()["uID"],
-            adminLevel=int(input.role()),
-            note=input.note(),
-        )
-        conn.commit()
-        conn.close()
+        with shared.appDBConn(postgresUser=postgresUser) as conn:
+            cursor = conn.cursor()
+            newCodes = shared.generate_access_codes(
+                cursor=cursor,
+                codeType=0,
+                n=input.numCodes(),
+                creatorID=user.get()["uID"],
+                adminLevel=int(input.role()),
+                note=input.note(),
+            )
+            conn.commit()
         accessCodes.set(
             getAccessCodes(uID=user.get()["uID"], adminLevel=user.get()["adminLevel"])
         )
@@ -58,17 +58,21 @@ def vectorDB_management_ui():
                 id="uiUploadFile",
             ),
         ),
+        # Files waiting to be added to the vector database
+        ui.card(
+            ui.card_header("Files being processed"),
+            ui.output_data_frame("jobsTable"),
+        ),
+        # Index on the embeddings (admins only)
+        ui.output_ui("vectorIndex"),
     ]
 
 
 # --- Server ---
 @module.server
-def vectorDB_management_server(
-    input: Inputs, output: Outputs, session: Session, user, pool
-):
-    conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-    files = shared.pandasQuery(conn, query='SELECT * FROM "file"')
-    conn.close()
+def vectorDB_management_server(input: Inputs, output: Outputs, session: Session, user):
+    with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+        files = shared.pandasQuery(conn, query='SELECT * FROM "file"')
 
     files = reactive.value(files)
 
@@ -86,68 +90,61 @@ def vectorDB_management_server(
     @reactive.effect
     @reactive.event(input.newFile)
     def _():
-        # Move the file to the uploadedFiles folder
-        updateVectorDB(
+        # Add the file to the ingestion queue, the workers will process it
+        result = accorns_shared.addIngestionJob(
             input.newFile()[0]["datapath"],
-            shared.vectorDB,
-            accorns_shared.storageFolder,
-            input.newFile()[0]["name"],
-        )
-        shared.elementDisplay(
-            session, {"uiUploadFile": "h", "newFile": "e"}, alertNotFound=False
-        )
-        # TODO add nice loading animation https://codepen.io/nzbin/pen/GGrXbp
-        ui.insert_ui(
-            HTML(
-                f'<div id=processFile><i>Processing {input.newFile()[0]["name"]}</i></div>'
-            ),
-            "#uiUploadFile",
-            "afterEnd",
-        )
-
-    def updateVectorDB_task(newFile, vectorDB, storageFolder, newFileName):
-        return accorns_shared.addFileToDB(
-            newFile=newFile,
             shinyToken=session.id,
-            vectorDB=vectorDB,
-            storageFolder=storageFolder,
-            newFileName=newFileName,
+            newFileName=input.newFile()[0]["name"],
         )
 
-    # Add the file to the vector database
-    @reactive.extended_task
-    async def updateVectorDB(newFile, vectorDB, storageFolder, newFileName):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            pool, updateVectorDB_task, newFile, vectorDB, storageFolder, newFileName
-        )
+        if result[0] == 0:
+            ui.notification_show(
+                f"{input.newFile()[0]['name']} will be added to the vector database"
+            )
+        else:
+            ui.notification_show(result[1])
 
-    # Process the result of adding the file to the vector database
-    @reactive.effect
-    def _():
-        insertionResult = updateVectorDB.result()[0]
+    # Check the job queue for updates
+    @reactive.poll(accorns_shared.ingestionJobsVersion, accorns_shared.pollInterval)
+    def jobs():
+        return accorns_shared.ingestionJobs(session.id)
 
-        if insertionResult == 0:
-            msg = "File successfully added to the vector database"
-        elif insertionResult == 1:
-            msg = "A file with the same name already exists. Please rename the file and try again"
-        else:
-            msg = "Not a valid file type. Please upload a .csv, .pdf, .docx, .txt, .md, .epub, .ipynb, .ppt or .pptx file"
+    @render.data_frame
+    def jobsTable():
+        req(not jobs().empty)
+        table = jobs()[["fileName", "status", "stage", "progress", "message"]].copy()
+        table["status"] = [accorns_shared.jobStatus[x] for x in table["status"]]
+        table["progress"] = [f"{x}%" for x in table["progress"]]
+        return render.DataTable(table, width="100%")
 
-        ui.notification_show(msg)
-        # ui.modal_show(ui.modal(msg, title="Success" if insertionResult == 0 else "Issue"))
+    # Let the user know when their files are done and refresh the file list
+    jobsDone = reactive.value(None)
 
-        # Get the new file info
-        conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-        getFiles = shared.pandasQuery(conn, 'SELECT * FROM "file"')
-        conn.close()
+    @reactive.effect
+    @reactive.event(jobs)
+    def _():
+        done = jobs()[jobs()["status"] >= 2]
+        newDone = done[~done["jID"].isin(jobsDone.get() or [])]
+        jobsDone.set(done["jID"].tolist())
+        if newDone.empty:
+            return
 
-        files.set(getFiles)
+        for job in newDone.itertuples():
+            if job.status == 3:
+                msg = f"Adding {job.fileName} failed: {job.message}"
+            elif job.result == 0:
+                msg = f"{job.fileName} successfully added to the vector database"
+            elif job.result == 1:
+                msg = "A file with the same name already exists. Please rename the file and try again"
+            elif job.result == 3:
+                msg = job.message
+            else:
+                msg = "Not a valid file type. Please upload a .csv, .pdf, .docx, .txt, .md, .epub, .ipynb, .ppt or .pptx file"
+            ui.notification_show(msg)
 
-        shared.elementDisplay(
-            session, {"uiUploadFile": "s", "newFile": "d"}, alertNotFound=False
-        )
-        ui.remove_ui("#processFile")
+        # Get the new file info
+        with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+            files.set(shared.pandasQuery(conn, 'SELECT * FROM "file"'))
 
     # Get file details
     @render.ui
@@ -158,11 +155,10 @@ def vectorDB_management_server(
 
         info = files().iloc[filesTable.data_view(selected=True).index[0]]
 
-        conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-        keywords = shared.pandasQuery(
-            conn, f'SELECT "keyword" FROM "keyword" WHERE "fID" = {int(info.fID)}'
-        )
-        conn.close()
+        with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+            keywords = shared.pandasQuery(
+                conn, f'SELECT "keyword" FROM "keyword" WHERE "fID" = {int(info.fID)}'
+            )
         keywords = "; ".join(keywords["keyword"])
 
         return ui.TagList(
@@ -185,13 +181,12 @@ def vectorDB_management_server(
             shinyToken = (
                 files().iloc[filesTable.data_view(selected=True).index[0]].shinyToken
             )
-            conn = shared.appDBConn(postgresUser=shared.postgresAccorns)
-            shinyToken = shared.pandasQuery(
-                conn,
-                'SELECT "uID" FROM "session" WHERE "shinyToken" = ?',
-                (shinyToken,),
-            )
-            conn.close()
+            with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+                shinyToken = shared.pandasQuery(
+                    conn,
+                    'SELECT "uID" FROM "session" WHERE "shinyToken" = ?',
+                    (shinyToken,),
+                )
             if user.get()["uID"] not in shinyToken["uID"].values:
                 ui.notification_show("Only admins can delete files uploaded by others")
                 return
@@ -218,37 +213,33 @@ def vectorDB_management_server(
     def _():
         if input.deleteConfirm() == "DELETE":
             file = files().iloc[filesTable.data_view(selected=True).index[0]]
-            conn = shared.vectorDBConn(postgresUser=shared.postgresAccorns)
-            # Delete the vectors
-            cursor = conn.cursor()
-            # The syntax is different between DuckDB and PostgreSQL for JSON extraction
-            if shared.remoteAppDB:
-                _ = cursor.execute(
-                    ("DELETE FROM data_document WHERE metadata_ ->> 'file_name' = %s"),
-                    (file.fileName,),
+            with shared.vectorDBConn(postgresUser=shared.postgresAccorns) as conn:
+                # Delete the vectors
+                cursor = conn.cursor()
+                accorns_shared.deleteFileVectors(cursor, file.fileName)
+
+                _ = shared.executeQuery(
+                    cursor,
+                    'DELETE FROM "keyword" WHERE "fID" = ?',
+                    (int(file.fID),),
                 )
-            else:
-                _ = cursor.execute(
-                    (
-                        'DELETE FROM "documents" WHERE '
-                        "CAST(json_extract(metadata_, '$.file_name') as VARCHAR) = ?"
-                    ),
-                    parameters=('"' + file.fileName + '"',),
+                _ = shared.executeQuery(
+                    cursor,
+                    'DELETE FROM "file" WHERE "fID" = ?',
+                    (int(file.fID),),
                 )
-
-            _ = shared.executeQuery(
-                cursor,
-                'DELETE FROM "keyword" WHERE "fID" = ?',
-                (int(file.fID),),
-            )
-            _ = shared.executeQuery(
-                cursor,
-                'DELETE FROM "file" WHERE "fID" = ?',
-                (int(file.fID),),
-            )
-            files.set(shared.pandasQuery(conn, query='SELECT * FROM "file"'))
-            conn.commit()
-            conn.close()
+                shared.bumpCorpusVersion(cursor)
+                files.set(shared.pandasQuery(conn, query='SELECT * FROM "file"'))
+                conn.commit()
+            # Topics no longer search the file
+            with shared.appDBConn(postgresUser=shared.postgresAccorns) as conn:
+                cursor = conn.cursor()
+                _ = shared.executeQuery(
+                    cursor, 'DELETE FROM "topic_file" WHERE "fID" = ?', (int(file.fID),)
+                )
+                conn.commit()
+            # The corpus changed, so cached indexes need to be rebuilt
+            shared.clearIndexCache()
             ui.notification_show("File successfully deleted")
             ui.modal_remove()
         else:
@@ -256,4 +247,96 @@ def vectorDB_management_server(
                 "Incorrect input. Please type DELETE in all caps to confirm deletion"
             )
 
+    # Info on the index on the embeddings and the option to rebuild it or to re-embed
+    # the chunks with the configured embedding model
+    @reactive.extended_task
+    async def rebuildIndex():
+        return await asyncio.to_thread(
+            accorns_shared.runVectorTask,
+            accorns_shared.rebuildVectorIndex,
+            "Rebuilding the index, this can take a while...",
+        )
+
+    @reactive.extended_task
+    async def reembed():
+        return await asyncio.to_thread(
+            accorns_shared.runVectorTask,
+            accorns_shared.reembedVectorDB,
+            "Re-embedding the chunks, this can take a while. SCUIRREL keeps using "
+            "the current embeddings until all chunks are done...",
+            progress=accorns_shared.vectorTaskProgress,
+        )
+
+    @render.ui
+    def vectorIndex():
+        req(user.get()["adminLevel"] == 3)
+        _ = files.get()
+        # Show the progress (also to other admins) and disable the buttons while running
+        running = accorns_shared.vectorTask["lock"].locked()
+        if running or "running" in [rebuildIndex.status(), reembed.status()]:
+            reactive.invalidate_later(1)
+            return ui.card(
+                ui.card_header("Vector index"),
+                HTML(
+                    f"<p><i>{accorns_shared.vectorTask['message'] or 'Starting...'}"
+                    f"</i></p><p>{accorns_shared.vectorTask['progress'] or ''}</p>"
+                ),
+                ui.input_action_button(
+                    "rebuildIndex", "Rebuild index", width="150px", disabled=True
+                ),
+                ui.input_action_button(
+                    "reembed", "Re-embed", width="150px", disabled=True
+                ),
+            )
+
+        info = accorns_shared.vectorIndexInfo()
+        configured = (shared.embedModelName, shared.embedDim)
+        return ui.card(
+            ui.card_header("Vector index"),
+            HTML(
+                f"<ul><li><b>Chunks</b>: {info['chunks']}</li>"
+                "<li><b>Embeddings</b>: "
+                f"{accorns_shared.embeddingName(info['embedding'])}</li>"
+                f"<li><b>Index</b>: {info['index'] or 'None'} ({info['settings']})</li>"
+                f"<li><b>Size</b>: {info['size'] or '-'}</li></ul>"
+                "<p><i>Rebuild the index after adding many files or changing the index "
+                "settings to keep searches fast and accurate</i></p>"
+            ),
+            ui.input_action_button("rebuildIndex", "Rebuild index", width="150px"),
+            HTML(
+                "<p><i>The embedding model in the config is "
+                f"{accorns_shared.embeddingName(configured)}. Re-embed all chunks to "
+                "switch to it</i></p>"
+            )
+            if info["embedding"] != configured
+            else None,
+            ui.input_action_button("reembed", "Re-embed", width="150px")
+            if info["embedding"] != configured
+            else None,
+        )
+
+    @reactive.effect
+    @reactive.event(input.rebuildIndex)
+    def _():
+        rebuildIndex()
+
+    @reactive.effect
+    @reactive.event(input.reembed)
+    def _():
+        reembed()
+
+    @reactive.effect
+    def _():
+        if reembed.status() == "success":
+            ui.notification_show(reembed.result()[1])
+        elif reembed.status() == "error":
+            ui.notification_show("Re-embedding the chunks failed")
+
+    @reactive.effect
+    def _():
+        if rebuildIndex.status() == "success":
+            ui.notification_show(rebuildIndex.result()[1])
+        elif rebuildIndex.status() == "error":
+            ui.notification_show("Rebuilding the index failed")
+
     return files
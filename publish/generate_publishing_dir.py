@@ -110,6 +110,24 @@ for toGenerate in apps:
                 copyfile(os.path.join(baseFolder, "ACCORNS","appDB", file),
                         os.path.join(newFolder, "appDB", file))
 
+        # Copy the ingestion worker and fix its imports
+        with open(os.path.join(baseFolder, "ACCORNS", "ingestion_worker.py"), "r") as f:
+            toEdit = f.read()
+            toEdit = toEdit.replace("import shared.shared as shared", "import shared")
+            toEdit = toEdit.replace("import ACCORNS.accorns_shared as accorns_shared", "import accorns_shared")
+
+        with open(os.path.join(newFolder, "ingestion_worker.py"), "w") as f:
+            f.write(toEdit)
+
+    # In case of SCUIRREL, copy the conversation log and fix its imports
+    if toGenerate == "SCUIRREL":
+        with open(os.path.join(baseFolder, "SCUIRREL", "scuirrel_conversation.py"), "r") as f:
+            toEdit = f.read()
+            toEdit = toEdit.replace("import shared.shared as shared", "import shared")
+
+        with open(os.path.join(newFolder, "scuirrel_conversation.py"), "w") as f:
+            f.write(toEdit)
+
     # Create a new modules directory in the publish directory
     os.makedirs(os.path.join(newFolder, "modules"))
 
@@ -138,6 +156,7 @@ for toGenerate in apps:
         toEdit = toEdit.replace(f"import {toGenerate}.{toGenerate.lower()}_shared as {toGenerate.lower()}_shared",
                                 f"import {toGenerate.lower()}_shared")
         toEdit = toEdit.replace("import shared.shared as shared", "import shared")
+        toEdit = toEdit.replace("from ACCORNS.ingestion_worker import", "from ingestion_worker import")
         toEdit = toEdit.replace('curDir, "shared",', 'curDir, ')
         toEdit = toEdit.replace(f'curDir, "{toGenerate}",', 'curDir, ')
 
@@ -163,6 +182,7 @@ for toGenerate in apps:
             toEdit = toEdit.replace("shared.shared", "shared")
             toEdit = toEdit.replace("ACCORNS.accorns_shared","accorns_shared")
             toEdit = toEdit.replace("SCUIRREL.scuirrel_shared","scuirrel_shared")
+            toEdit = toEdit.replace("SCUIRREL.scuirrel_conversation","scuirrel_conversation")
 
         with open(os.path.join(newFolder, "modules", file), "w") as f:
             f.write(toEdit)
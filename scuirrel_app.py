@@ -12,7 +12,6 @@ from modules.feedback_module import feedback_ui, feedback_server
 # General
 import os
 import traceback
-import concurrent.futures
 
 # -- Shiny
 from shiny import App, reactive, render, ui
@@ -25,11 +24,14 @@ from htmltools import HTML
 if shared.remoteAppDB:
     _ = shared.checkRemoteDB(postgresUser=shared.postgresScuirrel)
 
+# Load the chunks of the vector database in memory before the first chat
+if shared.memoryIndexEnabled:
+    shared.getMemoryIndex(postgresUser=shared.postgresScuirrel).refresh()
+
 # --- RENDERING UI ---
 # ********************
 
 curDir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
-pool = concurrent.futures.ThreadPoolExecutor()
 
 # --- UI LAYOUT ---
 # Add some JS so that pressing enter can send the message too
@@ -60,17 +62,16 @@ app_ui = ui.page_fluid(
 
 def server(input, output, session):
     # Register the session start in the DB
-    conn = shared.appDBConn(postgresUser=shared.postgresScuirrel)
-    cursor = conn.cursor()
-    sID = shared.executeQuery(
-        cursor,
-        'INSERT INTO "session" ("shinyToken", "uID", "appID", "start")'
-        "VALUES(?, 1, 0, ?)",
-        (session.id, shared.dt()),
-        lastRowId="sID",
-    )
-    conn.commit()
-    conn.close()
+    with shared.appDBConn(postgresUser=shared.postgresScuirrel) as conn:
+        cursor = conn.cursor()
+        sID = shared.executeQuery(
+            cursor,
+            'INSERT INTO "session" ("shinyToken", "uID", "appID", "start")'
+            "VALUES(?, 1, 0, ?)",
+            (session.id, shared.dt()),
+            lastRowId="sID",
+        )
+        conn.commit()
 
     # Login screen
     user = login_server(
@@ -114,9 +115,7 @@ application, please use the access code provided by your administrator to create
             )
 
     # Server functions for the different tabs are found in their respective modules
-    chat = chat_server(
-        "chat", user=user, sID=sID, postgresUser=shared.postgresScuirrel, pool=pool
-    )
+    chat = chat_server("chat", user=user, sID=sID, postgresUser=shared.postgresScuirrel)
 
     # Code to run at the END of the session (i.e. when user disconnects)
     _ = session.on_ended(lambda: theEnd())
@@ -125,32 +124,31 @@ application, please use the access code provided by your administrator to create
     def theEnd():
         with reactive.isolate():
             # Add logs to the database after user exits
-            conn = shared.appDBConn(postgresUser=shared.postgresScuirrel)
-            cursor = conn.cursor()
-
-            if chat["dID"].get() != 0:
-                endDiscussion(cursor, chat["dID"].get(), chat["messages"].get())
-
-            # Register the end of the session and if an error occurred, log it
-            errMsg = traceback.format_exc().strip()
-
-            if errMsg == "NoneType: None":
-                _ = shared.executeQuery(
-                    cursor,
-                    'UPDATE "session" SET "end" = ? WHERE "sID" = ?',
-                    (shared.dt(), sID),
-                )
-            else:
-                _ = shared.executeQuery(
-                    cursor,
-                    'UPDATE "session" SET "end" = ?, "error" = ? WHERE "sID" = ?',
-                    (shared.dt(), errMsg, sID),
-                )
-            conn.commit()
-            conn.close()
+            with shared.appDBConn(postgresUser=shared.postgresScuirrel) as conn:
+                cursor = conn.cursor()
+
+                if chat["dID"].get() != 0:
+                    endDiscussion(cursor, chat["dID"].get(), chat["messages"].get())
+
+                # Register the end of the session and if an error occurred, log it
+                errMsg = traceback.format_exc().strip()
+
+                if errMsg == "NoneType: None":
+                    _ = shared.executeQuery(
+                        cursor,
+                        'UPDATE "session" SET "end" = ? WHERE "sID" = ?',
+                        (shared.dt(), sID),
+                    )
+                else:
+                    _ = shared.executeQuery(
+                        cursor,
+                        'UPDATE "session" SET "end" = ?, "error" = ? WHERE "sID" = ?',
+                        (shared.dt(), errMsg, sID),
+                    )
+                conn.commit()
 
     return
 
 
 app = App(app_ui, server)
-app.on_shutdown(pool.shutdown)
+app.on_shutdown(shared.closePools)
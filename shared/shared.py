@@ -7,12 +7,21 @@
 
 # General
 import os
+import asyncio
 import sqlite3
 import duckdb
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
+import numpy as np
 import pandas as pd
+from sqlalchemy import event, text
 import toml
+import json
 import warnings
 from regex import search as re_search
 from bcrypt import checkpw
@@ -21,7 +30,18 @@ import string
 
 # Llamaindex
 from llama_index.llms.openai import OpenAI
+from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core import VectorStoreIndex
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.core.vector_stores.types import (
+    VectorStoreQueryResult,
+    MetadataFilters,
+    MetadataFilter,
+    FilterOperator,
+)
 from llama_index.vector_stores.duckdb import DuckDBVectorStore
 from llama_index.vector_stores.postgres import PGVectorStore
 
@@ -44,13 +64,42 @@ addDemo = config["general"]["addDemo"]
 demoFile = "https://github.com/pieterjanvc/seq2mgs/files/14964109/Central_dogma_of_molecular_biology.pdf"
 postgresHost = config["postgres"]["host"]
 postgresPort = int(config["postgres"]["port"])
+poolMinConn = int(config["postgres"]["poolMinConn"])
+poolMaxConn = int(config["postgres"]["poolMaxConn"])
+poolTimeout = float(config["postgres"]["poolTimeout"])
+pgVectorIndex = config["postgres"]["vectorIndex"]
+pgHnswM = int(config["postgres"]["hnswM"])
+pgHnswEfConstruction = int(config["postgres"]["hnswEfConstruction"])
+pgHnswEfSearch = int(config["postgres"]["hnswEfSearch"])
+pgIvfflatLists = int(config["postgres"]["ivfflatLists"])
+pgIvfflatProbes = int(config["postgres"]["ivfflatProbes"])
 vectorDB = os.path.normpath(config["localStorage"]["duckDB"])
+hnswM = int(config["localStorage"]["hnswM"])
+hnswEfConstruction = int(config["localStorage"]["hnswEfConstruction"])
+hnswEfSearch = int(config["localStorage"]["hnswEfSearch"])
+hnswFilterFactor = int(config["localStorage"]["hnswFilterFactor"])
+memoryIndexEnabled = config["memoryIndex"]["enabled"]
+memoryIndexMmap = config["memoryIndex"]["mmap"]
+memoryIndexFolder = os.path.normpath(config["memoryIndex"]["folder"])
+memoryIndexCheckInterval = float(config["memoryIndex"]["checkInterval"])
+memoryIndexPrecision = config["memoryIndex"]["precision"]
+memoryIndexRerank = int(config["memoryIndex"]["rerank"])
 sqliteDB = os.path.normpath(config["localStorage"]["sqliteDB"])
 postgresAccorns = "accorns"
 postgresScuirrel = "scuirrel"
 personalInfo = config["auth"]["personalInfo"]
 validEmail = config["auth"]["validEmail"]
 
+if memoryIndexPrecision not in ["float32", "float16", "int8"]:
+    raise ValueError(
+        "The memoryIndex precision in shared_config.toml must be float32, float16 or int8"
+    )
+
+if pgVectorIndex not in ["hnsw", "ivfflat"]:
+    raise ValueError(
+        "The postgres vectorIndex in shared_config.toml must be hnsw or ivfflat"
+    )
+
 # Create the parent directory for the sqliteDB if it does not exist
 if not os.path.exists(os.path.dirname(sqliteDB)):
     os.makedirs(os.path.dirname(sqliteDB))
@@ -64,7 +113,26 @@ if not os.path.exists(os.path.dirname(vectorDB)):
 os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
 os.environ["OPENAI_ORGANIZATION"] = os.environ.get("OPENAI_ORGANIZATION")
 gptModel = config["LLM"]["gptModel"]
-llm = OpenAI(model=gptModel)
+# Each role can use its own model and parameters ([LLM.<role>] in shared_config.toml)
+llmRoles = ["evaluator", "tutor", "quiz", "ingestion"]
+llmRoleParams = {x: config["LLM"].get(x, {}) for x in llmRoles}
+llmMaxConcurrent = int(config["LLM"]["maxConcurrent"])
+llmTokensPerMinute = int(config["LLM"]["tokensPerMinute"])
+llmCallTokens = 1500  # Estimate for system prompt, retrieved context and reply
+# Embedding model for new vector databases and for re-embedding (ACCORNS). The model
+# the vector database was embedded with is stored in its corpus table
+embedModelName = config["embedding"]["model"]
+embedDim = int(config["embedding"]["dimensions"])
+embedCheckInterval = float(config["embedding"]["checkInterval"])
+# Vector databases created by an older version
+legacyEmbedding = ("text-embedding-ada-002", 1536)
+
+for role in config["LLM"]:
+    if isinstance(config["LLM"][role], dict) and role not in llmRoles:
+        raise ValueError(
+            f"Unknown LLM role {role} in shared_config.toml, use one of "
+            + ", ".join(llmRoles)
+        )
 
 if os.environ["OPENAI_API_KEY"] is None:
     raise ValueError(
@@ -72,6 +140,630 @@ if os.environ["OPENAI_API_KEY"] is None:
     )
 
 
+# --- CLASSES ---
+
+
+# A connection checked out from a pool. Calling close() (or leaving a with block)
+# hands it back to the pool instead of closing it. All other attributes (cursor,
+# commit, rollback, ...) are passed on to the underlying connection. It is not
+# released when garbage collected, as that can happen on another thread than the one
+# of the (thread-local) checkout, so always use a with block
+class PooledConnection:
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self.__dict__.get("_conn") is None:
+            raise ConnectionError("This connection was already returned to the pool")
+        return getattr(self._conn, name)
+
+    def __repr__(self):
+        return repr(self.__dict__.get("_conn"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        if self.__dict__.get("_conn") is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+
+# Pool of psycopg2 connections for one postgres user and database. Threads wait
+# (up to poolTimeout seconds) for a free connection once poolMaxConn are in use
+class PostgresPool:
+    def __init__(self, name, minConn=poolMinConn, maxConn=poolMaxConn, **params):
+        self.name = name
+        self.maxConn = maxConn
+        self._pool = ThreadedConnectionPool(minConn, maxConn, **params)
+        self._slots = threading.BoundedSemaphore(maxConn)
+        self._lock = threading.Lock()
+        self.stats = {"checkouts": 0, "inUse": 0, "waitTotal": 0.0, "waitMax": 0.0}
+
+    def acquire(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=poolTimeout):
+            raise ConnectionError(
+                f"No free connection in pool {self.name} after {poolTimeout} seconds"
+            )
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        wait = time.perf_counter() - start
+
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["inUse"] += 1
+            self.stats["waitTotal"] += wait
+            self.stats["waitMax"] = max(self.stats["waitMax"], wait)
+
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        # putconn rolls back any transaction that was left open
+        self._pool.putconn(conn)
+        self._slots.release()
+        with self._lock:
+            self.stats["inUse"] -= 1
+
+    def size(self):
+        return len(self._pool._pool) + len(self._pool._used)
+
+    def closeAll(self):
+        self._pool.closeall()
+
+
+# Reusable local (sqlite/duckdb) handles, one per thread. Nested checkouts in the
+# same thread share the handle; uncommitted work is rolled back once the outer
+# checkout is returned. Without keep the handle is closed then, which DuckDB needs:
+# an open handle locks the file for the other app
+class LocalPool:
+    def __init__(self, name, connect, keep=True):
+        self.name = name
+        self._connect = connect
+        self.keep = keep
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+        self.stats = {"checkouts": 0, "inUse": 0, "waitTotal": 0.0, "waitMax": 0.0}
+
+    def acquire(self):
+        start = time.perf_counter()
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = self._connect()
+            self._local.depth = 0
+            with self._lock:
+                self._handles.append(self._local.conn)
+        self._local.depth += 1
+        wait = time.perf_counter() - start
+
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["inUse"] += 1
+            self.stats["waitTotal"] += wait
+            self.stats["waitMax"] = max(self.stats["waitMax"], wait)
+
+        return PooledConnection(self, self._local.conn)
+
+    def release(self, conn):
+        if getattr(self._local, "conn", None) is conn:
+            self._local.depth -= 1
+            if self._local.depth == 0 and not self.keep:
+                self._local.conn = None
+                with self._lock:
+                    self._handles.remove(conn)
+                conn.close()
+            elif self._local.depth == 0 and getattr(conn, "in_transaction", False):
+                conn.rollback()
+        with self._lock:
+            self.stats["inUse"] -= 1
+
+    def size(self):
+        return len(self._handles)
+
+    def closeAll(self):
+        with self._lock:
+            for conn in self._handles:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._handles = []
+        self._local = threading.local()
+
+
+# Central scheduler for the LLM calls of this app (process). At most maxConcurrent
+# calls run at the same time and the (estimated) tokens sent in the last minute stay
+# within tokensPerMinute. Waiting calls are served by priority (lower first, see
+# llmPriority) and within a priority round robin over sessions, FIFO per session.
+# Every LLM call takes its own slot. ACCORNS and SCUIRREL each have their own
+# scheduler, so priorities and budgets do not apply across the two apps
+class LLMScheduler:
+    def __init__(self, maxConcurrent, tokensPerMinute):
+        self.maxConcurrent = maxConcurrent
+        self.tokensPerMinute = tokensPerMinute
+        self.running = 0
+        self._queues = {}  # priority: {sessionID: deque of (future, tokens)}
+        self._usage = deque()  # (time, tokens) of the requests in the last minute
+        self._timer = None
+        self.stats = {"requests": 0, "waitTotal": 0.0, "waitMax": 0.0}
+
+    # Wait until the request is allowed to run
+    async def acquire(self, sessionID, priority, tokens):
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(priority, OrderedDict())
+        queue.setdefault(sessionID, deque()).append((waiter, tokens))
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._remove(waiter, priority, sessionID)
+            raise
+
+        wait = time.perf_counter() - start
+        self.stats["requests"] += 1
+        self.stats["waitTotal"] += wait
+        self.stats["waitMax"] = max(self.stats["waitMax"], wait)
+
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+
+    # Usage: async with llmScheduler.slot(session.id, llmPriority["chat"], tokens):
+    @asynccontextmanager
+    async def slot(self, sessionID, priority, tokens=0):
+        await self.acquire(sessionID, priority, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    # Estimated number of requests that will be started before the first waiting
+    # request of a session (None if the session has nothing waiting)
+    def position(self, sessionID):
+        ahead = 0
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            if sessionID in queue:
+                # Round robin: every session before it in the rotation gets one turn
+                for other in queue:
+                    if other == sessionID:
+                        return ahead
+                    ahead += 1
+            ahead += sum(len(x) for x in queue.values())
+        return None
+
+    def waiting(self):
+        return sum(len(x) for q in self._queues.values() for x in q.values())
+
+    def _remove(self, waiter, priority, sessionID):
+        queue = self._queues[priority]
+        requests = queue.get(sessionID)
+        if requests is None:
+            return
+        for request in requests:
+            if request[0] is waiter:
+                requests.remove(request)
+                break
+        if not requests:
+            del queue[sessionID]
+
+    # Tokens used in the last minute
+    def _tokensUsed(self, now):
+        while self._usage and now - self._usage[0][0] >= 60:
+            self._usage.popleft()
+        return sum(x[1] for x in self._usage)
+
+    # Start as many waiting requests as the limits allow
+    def _dispatch(self):
+        while self.running < self.maxConcurrent:
+            nextRequest = None
+            for priority in sorted(self._queues):
+                if self._queues[priority]:
+                    queue = self._queues[priority]
+                    sessionID = next(iter(queue))
+                    nextRequest = queue[sessionID][0]
+                    break
+            if nextRequest is None:
+                return
+
+            # A request larger than the whole budget still runs when nothing else did
+            now = time.monotonic()
+            used = self._tokensUsed(now)
+            if used > 0 and used + nextRequest[1] > self.tokensPerMinute:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(
+                        60 - (now - self._usage[0][0]), self._wakeUp
+                    )
+                return
+
+            # Move the session to the back of the rotation
+            requests = queue.pop(sessionID)
+            requests.popleft()
+            if requests:
+                queue[sessionID] = requests
+            if nextRequest[0].done():
+                continue
+            self.running += 1
+            self._usage.append((now, nextRequest[1]))
+            nextRequest[0].set_result(None)
+
+    def _wakeUp(self):
+        self._timer = None
+        self._dispatch()
+
+
+# DuckDB vector store that uses the pooled connections (with the vss extension loaded)
+# and searches the fixed size embedding column so the HNSW index can be used
+class LocalVectorStore(DuckDBVectorStore):
+    @classmethod
+    def from_local(
+        cls, database_path, table_name="documents", embed_dim=embedDim, **kwargs
+    ):
+        store = cls(
+            database_name=os.path.basename(database_path),
+            table_name=table_name,
+            embed_dim=embed_dim,
+            persist_dir=os.path.dirname(database_path),
+            **kwargs,
+        )
+        store._is_initialized = True
+        return store
+
+    def _connect(self):
+        return vectorDBConn(None, remoteAppDB=False, vectorDB=self._database_path)
+
+    def add(self, nodes, **add_kwargs):
+        rows = [self._node_to_table_row(x) for x in nodes]
+        with self._connect() as conn:
+            conn.executemany(
+                f'INSERT INTO "{self.table_name}" ("node_id", "text", "embedding", '
+                '"metadata_", "file_name", "fID") VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        x[0],
+                        x[1],
+                        x[2],
+                        json.dumps(x[3]),
+                        x[3].get("file_name"),
+                        x[3].get("fID"),
+                    )
+                    for x in rows
+                ],
+            )
+            conn.commit()
+        return [x.node_id for x in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        with self._connect() as conn:
+            conn.execute(
+                f'DELETE FROM "{self.table_name}" '
+                "WHERE json_extract_string(metadata_, '$.ref_doc_id') = ?",
+                (ref_doc_id,),
+            )
+            conn.commit()
+
+    def query(self, query, **kwargs):
+        # Searching the chunks of some files uses the indexed fID column
+        fIDs = None
+        if query.filters is not None:
+            fIDs = filterFileIDs(query.filters)
+            if fIDs is None:
+                return super().query(query, **kwargs)
+
+        # The HNSW index is only used for ORDER BY distance to a constant + LIMIT
+        k = int(query.similarity_top_k)
+        vector = f"{list(query.query_embedding)}::FLOAT[{self.embed_dim}]"
+        columns = (
+            "node_id, text, embedding, metadata_, "
+            f"1 - array_cosine_distance(embedding, {vector}) AS score"
+        )
+        with self._connect() as conn:
+            if fIDs is None:
+                rows = conn.execute(
+                    f'SELECT {columns} FROM "{self.table_name}" '
+                    f"ORDER BY array_cosine_distance(embedding, {vector}) LIMIT {k}"
+                ).fetchall()
+            else:
+                # The filter is applied to the results of the index, so more candidates
+                # are fetched. If fewer than k of them are in the files, the chunks of
+                # the files are searched exactly (the materialized CTE skips the index)
+                where = f'"fID" IN ({", ".join(str(int(x)) for x in fIDs)})'
+                rows = conn.execute(
+                    f'SELECT node_id, text, embedding, metadata_, score FROM (SELECT "fID", {columns} '
+                    f'FROM "{self.table_name}" '
+                    f"ORDER BY array_cosine_distance(embedding, {vector}) "
+                    f"LIMIT {k * hnswFilterFactor}) WHERE {where} "
+                    f"ORDER BY score DESC LIMIT {k}"
+                ).fetchall()
+                if len(rows) < k:
+                    rows = conn.execute(
+                        f"WITH chunks AS MATERIALIZED (SELECT {columns} "
+                        f'FROM "{self.table_name}" WHERE {where}) '
+                        f"SELECT * FROM chunks ORDER BY score DESC LIMIT {k}"
+                    ).fetchall()
+
+        return VectorStoreQueryResult(
+            nodes=[self._table_row_to_node(x) for x in rows],
+            similarities=[x[4] for x in rows],
+            ids=[x[0] for x in rows],
+        )
+
+
+# Postgres vector store whose connections use the hnsw.ef_search and ivfflat.probes
+# settings for the index on the embeddings (see accorns_shared.createRemoteVectorIndex)
+class RemoteVectorStore(PGVectorStore):
+    def _connect(self):
+        super()._connect()
+        for engine in [self._engine, self._async_engine.sync_engine]:
+            event.listen(engine, "connect", self._setSearchParams)
+
+    @staticmethod
+    def _setSearchParams(dbapiConn, connectionRecord):
+        cursor = dbapiConn.cursor()
+        cursor.execute(f"SET hnsw.ef_search = {pgHnswEfSearch}")
+        cursor.execute(f"SET ivfflat.probes = {pgIvfflatProbes}")
+        cursor.close()
+        # Otherwise the settings are rolled back when the connection returns to the pool
+        dbapiConn.commit()
+
+    # Searching the chunks of some files uses the indexed fID column
+    def _build_filter_clause(self, filter_):
+        if filter_.key == "fID" and filter_.operator == FilterOperator.IN:
+            return text(f'"fID" IN ({", ".join(str(int(x)) for x in filter_.value)})')
+        return super()._build_filter_clause(filter_)
+
+
+# In-memory copy of the chunks in the vector database with their normalised embeddings
+# (float32, or quantised to float16 / int8, optionally memory-mapped), searched with a
+# single matrix-vector product. Loaded again when ACCORNS changes the corpus version
+class MemoryIndex:
+    def __init__(self, postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+        self.postgresUser = postgresUser
+        self.remote = remote
+        self.vectorDB = vectorDB
+        self.version = None
+        self.embedding = None
+        self.checked = 0
+        self.name = (
+            "postgres" if remote else os.path.splitext(os.path.basename(vectorDB))[0]
+        )
+        # Embeddings, their scale (int8), the float32 embeddings for re-ranking, the
+        # (node_id, text, metadata) rows, their fIDs and the row numbers per set of
+        # files searched, replaced together on reload
+        self._data = (
+            np.zeros((0, embedDim), dtype=np.float32),
+            None,
+            None,
+            [],
+            np.zeros(0, dtype=np.int64),
+            {},
+        )
+        self._lock = threading.Lock()
+
+    # Load the chunks again if the corpus changed (checked every checkInterval seconds)
+    def refresh(self):
+        with self._lock:
+            if time.monotonic() - self.checked < memoryIndexCheckInterval:
+                return
+            version = corpusVersion(self.postgresUser, self.remote, self.vectorDB)
+            if version != self.version:
+                self.load(version)
+            self.checked = time.monotonic()
+
+    # All normalised float32 embeddings, (node_id, text, metadata) rows, their fIDs and
+    # the (model, dimensions) of the embeddings
+    def fetch(self):
+        # Read the chunks again if ACCORNS switched the embedding model meanwhile
+        while True:
+            embedding = corpusEmbedding(self.postgresUser, self.remote, self.vectorDB)
+            embeddings, rows, fIDs = self._fetchRows(embedding[1])
+            if (
+                corpusEmbedding(self.postgresUser, self.remote, self.vectorDB)
+                == embedding
+            ):
+                return embeddings, rows, fIDs, embedding
+
+    def _fetchRows(self, dimensions):
+        with vectorDBConn(self.postgresUser, self.remote, self.vectorDB) as conn:
+            if self.remote:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'SELECT node_id, text, metadata_, "fID", embedding::real[] '
+                    "FROM data_document"
+                )
+                rows = cursor.fetchall()
+            else:
+                result = conn.execute(
+                    'SELECT node_id, text, metadata_, "fID", embedding FROM "documents"'
+                ).fetchnumpy()
+                rows = list(
+                    zip(
+                        result["node_id"],
+                        result["text"],
+                        [
+                            None if x is None else json.loads(x)
+                            for x in columnValues(result["metadata_"])
+                        ],
+                        np.ma.filled(result["fID"], -1).tolist(),
+                        columnValues(result["embedding"]),
+                    )
+                )
+
+        # Chunks without the node content (or embedding) can't be returned as nodes
+        valid = [x for x in rows if usableChunk(x[2], x[4])]
+        if len(valid) < len(rows):
+            print(
+                f"Memory index {self.name}: skipped {len(rows) - len(valid)} chunks "
+                "without node content or embedding"
+            )
+        embeddings = (
+            np.stack([np.asarray(x[4], dtype=np.float32) for x in valid])
+            if valid
+            else np.zeros((0, dimensions), dtype=np.float32)
+        )
+        fIDs = [x[3] for x in valid]
+        rows = [x[:3] for x in valid]
+
+        embeddings = embeddings.reshape(-1, dimensions)
+        embeddings /= np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        # Chunks without a file are never searched when filtering on files
+        fIDs = np.array([-1 if x is None else x for x in fIDs], dtype=np.int64)
+        return embeddings, rows, fIDs
+
+    def load(self, version):
+        embeddings, rows, fIDs, embedding = self.fetch()
+        matrix, scale = quantise(embeddings, memoryIndexPrecision)
+
+        # The float32 embeddings for re-ranking are only read for the candidates, so
+        # they are always memory-mapped
+        full = None
+        if memoryIndexRerank > 0 and matrix.dtype != np.float32:
+            full = self._mapped(embeddings, version, "full")
+        if memoryIndexMmap:
+            matrix = self._mapped(matrix, version, memoryIndexPrecision)
+
+        self._data = (matrix, scale, full, rows, fIDs, {})
+        self.embedding = embedding
+        self.version = version
+        self._removeOldFiles()
+
+    # Save an array for the corpus version (once) and memory-map it
+    def _mapped(self, array, version, suffix):
+        os.makedirs(memoryIndexFolder, exist_ok=True)
+        path = os.path.join(memoryIndexFolder, f"{self.name}_{version}_{suffix}.npy")
+        # Other app processes might be writing / reading the same version
+        if not os.path.exists(path):
+            tmp = f"{path[:-4]}.{os.getpid()}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, path)
+        return np.load(path, mmap_mode="r")
+
+    # Remove the files of older versions (files still mapped by other processes can't
+    # be removed on Windows, they will be removed on a later reload)
+    def _removeOldFiles(self):
+        if not os.path.exists(memoryIndexFolder):
+            return
+        for file in os.listdir(memoryIndexFolder):
+            if (
+                file.startswith(f"{self.name}_")
+                and not file.startswith(f"{self.name}_{self.version}_")
+                and ".tmp" not in file
+            ):
+                try:
+                    os.remove(os.path.join(memoryIndexFolder, file))
+                except OSError:
+                    pass
+
+    # Top k rows (node_id, text, metadata) and their cosine similarity to the query,
+    # optionally only searching the chunks of some files
+    def search(self, queryEmbedding, k=DEFAULT_SIMILARITY_TOP_K, fIDs=None):
+        matrix, scale, full, rows, fileIDs, partitions = self._data
+        part = None
+        if fIDs:
+            key = tuple(sorted(fIDs))
+            if key not in partitions:
+                partitions[key] = np.flatnonzero(np.isin(fileIDs, key))
+            part = partitions[key]
+            matrix = matrix[part]
+            scale = scale[part] if scale is not None else None
+
+        k = min(k, len(matrix))
+        if k == 0:
+            return []
+
+        query = np.asarray(queryEmbedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        scores = quantisedScores(matrix, scale, query)
+
+        # Re-rank the best candidates of the quantised search with the exact scores
+        n = min(max(k, memoryIndexRerank), len(matrix)) if full is not None else k
+        top = np.argpartition(-scores, n - 1)[:n]
+        if full is not None:
+            scores[top] = full[top if part is None else part[top]] @ query
+        top = top[np.argsort(-scores[top])][:k]
+        return [(rows[i if part is None else part[i]], float(scores[i])) for i in top]
+
+
+# Quantise normalised float32 embeddings to float16, or to int8 with a scale per
+# vector. Returns the embeddings and the scales (None if not int8)
+def quantise(embeddings, precision):
+    if precision == "float16":
+        return embeddings.astype(np.float16), None
+    if precision == "int8":
+        scale = np.abs(embeddings).max(axis=1) / 127
+        scale[scale == 0] = 1
+        return (
+            np.round(embeddings / scale[:, None]).astype(np.int8),
+            scale.astype(np.float32),
+        )
+    return embeddings, None
+
+
+# Dot products of (quantised) embeddings with a query. Quantised embeddings are
+# converted in blocks so only a small float32 copy is made at a time
+def quantisedScores(matrix, scale, query, blockSize=1024):
+    if matrix.dtype == np.float32:
+        return matrix @ query
+
+    scores = np.empty(len(matrix), dtype=np.float32)
+    for i in range(0, len(matrix), blockSize):
+        scores[i : i + blockSize] = matrix[i : i + blockSize].astype(np.float32) @ query
+    return scores * scale if scale is not None else scores
+
+
+# Retriever for the MemoryIndex, used instead of the vector store retriever
+class MemoryRetriever(BaseRetriever):
+    def __init__(self, memoryIndex, similarityTopK=DEFAULT_SIMILARITY_TOP_K, fIDs=None):
+        super().__init__()
+        self.memoryIndex = memoryIndex
+        self.similarityTopK = similarityTopK
+        self.fIDs = fIDs
+
+    def _retrieve(self, query_bundle):
+        self.memoryIndex.refresh()
+        if query_bundle.embedding is None:
+            query_bundle.embedding = getEmbedModel(
+                *self.memoryIndex.embedding
+            ).get_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._toNodes(query_bundle.embedding)
+
+    async def _aretrieve(self, query_bundle):
+        await asyncio.to_thread(self.memoryIndex.refresh)
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await getEmbedModel(
+                *self.memoryIndex.embedding
+            ).aget_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._toNodes(query_bundle.embedding)
+
+    def _toNodes(self, queryEmbedding):
+        return [
+            NodeWithScore(node=metadata_dict_to_node(metadata, text), score=score)
+            for (_, text, metadata), score in self.memoryIndex.search(
+                queryEmbedding, self.similarityTopK, self.fIDs
+            )
+        ]
+
+
+# Priority of the LLM calls within an app. Both apps have their own scheduler, so chat
+# calls (SCUIRREL) are not ordered before quiz generation (ACCORNS)
+llmPriority = {"chat": 0, "quiz": 1}
+llmScheduler = LLMScheduler(llmMaxConcurrent, llmTokensPerMinute)
+
+
 # --- FUNCTIONS ---
 
 
@@ -152,66 +844,344 @@ def consecutiveInt(nums, start=1):
     return all(sorted_nums[i] == i + start for i in range(len(sorted_nums)))
 
 
-# Get a local or remote DB connection (depending on config)
+# Connect to a local DuckDB vector database with the vss extension (HNSW index) loaded
+def duckdbConnect(path):
+    conn = duckdb.connect(path)
+    try:
+        conn.load_extension("vss")
+    except duckdb.Error:
+        conn.install_extension("vss")
+        conn.load_extension("vss")
+    conn.execute("SET hnsw_enable_experimental_persistence = true")
+    conn.execute(f"SET hnsw_ef_search = {hnswEfSearch}")
+    return conn
+
+
+# Connection pools are shared by all sessions of the app (see getPool)
+pools = {}
+poolsLock = threading.Lock()
+
+
+# Get (or create) the connection pool for a database
+def getPool(postgresUser, database, remoteAppDB=remoteAppDB, path=None):
+    key = (postgresUser, database) if remoteAppDB else (database, path)
+
+    with poolsLock:
+        if key not in pools:
+            if remoteAppDB:
+                pools[key] = PostgresPool(
+                    name=f"{postgresUser}@{database}",
+                    host=postgresHost,
+                    port=postgresPort,
+                    user=postgresUser,
+                    password=os.environ.get(
+                        "POSTGRES_PASS_"
+                        + (
+                            "SCUIRREL"
+                            if postgresUser == postgresScuirrel
+                            else "ACCORNS"
+                        )
+                    ),
+                    database=database,
+                )
+            elif database == "accorns":
+                pools[key] = LocalPool(path, lambda: sqlite3.connect(path))
+            else:
+                pools[key] = LocalPool(path, lambda: duckdbConnect(path), keep=False)
+
+        return pools[key]
+
+
+# Get a local or remote DB connection (depending on config). The connection comes
+# from a pool and can be used as a context manager: with appDBConn(...) as conn:
 def appDBConn(postgresUser, remoteAppDB=remoteAppDB):
-    if remoteAppDB:
-        return psycopg2.connect(
-            host=postgresHost,
-            user=postgresUser,
-            password=os.environ.get(
-                "POSTGRES_PASS_"
-                + ("SCUIRREL" if postgresUser == postgresScuirrel else "ACCORNS")
-            ),
-            database="accorns",
+    if not remoteAppDB and not os.path.exists(config["localStorage"]["sqliteDB"]):
+        raise ConnectionError(
+            "The app database was not found. Please run ACCORNS first"
         )
 
-    else:
-        if not os.path.exists(config["localStorage"]["sqliteDB"]):
-            raise ConnectionError(
-                "The app database was not found. Please run ACCORNS first"
-            )
-        return sqlite3.connect(config["localStorage"]["sqliteDB"])
+    return getPool(
+        postgresUser, "accorns", remoteAppDB, config["localStorage"]["sqliteDB"]
+    ).acquire()
 
 
-# Connect to the vector database
+# Connect to the vector database (pooled, see appDBConn)
 def vectorDBConn(postgresUser, remoteAppDB=remoteAppDB, vectorDB=vectorDB):
-    if remoteAppDB:
-        conn = psycopg2.connect(
-            host=postgresHost,
-            port=postgresPort,
-            user=postgresUser,
-            password=os.environ.get(
-                "POSTGRES_PASS_"
-                + ("SCUIRREL" if postgresUser == postgresScuirrel else "ACCORNS")
-            ),
-            database="vector_db",
+    return getPool(postgresUser, "vector_db", remoteAppDB, vectorDB).acquire()
+
+
+# Pool size, wait time and checkout metrics for all connection pools
+def poolStats():
+    with poolsLock:
+        return pd.DataFrame(
+            [
+                {
+                    "pool": pool.name,
+                    "size": pool.size(),
+                    "inUse": pool.stats["inUse"],
+                    "checkouts": pool.stats["checkouts"],
+                    "waitTotal": pool.stats["waitTotal"],
+                    "waitMean": pool.stats["waitTotal"]
+                    / max(pool.stats["checkouts"], 1),
+                    "waitMax": pool.stats["waitMax"],
+                }
+                for pool in pools.values()
+            ]
         )
-    else:
-        conn = duckdb.connect(vectorDB)
 
-    return conn
+
+# Close all pooled connections (run when the app shuts down)
+def closePools():
+    with poolsLock:
+        for pool in pools.values():
+            pool.closeAll()
+        pools.clear()
+
+
+# Vector stores and their indexes are built once per process and shared by all
+# sessions. Keyed by postgres user, backend and the embedding model of the corpus
+indexCache = {}
+indexCacheLock = threading.Lock()
+
+
+# Get the (cached) vector store and index for a postgres user and backend
+def getCachedIndex(postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+    model, dimensions = currentEmbedding(postgresUser, remote, vectorDB)
+    backend = (postgresUser, "postgres") if remote else (postgresUser, vectorDB)
+    key = (*backend, model, dimensions)
+
+    with indexCacheLock:
+        if key not in indexCache:
+            # Indexes using the embedding model from before a switch are not needed
+            for oldKey in [x for x in indexCache if x[:2] == backend]:
+                del indexCache[oldKey]
+
+            if remote:
+                vectorStore = RemoteVectorStore.from_params(
+                    host=postgresHost,
+                    port=postgresPort,
+                    user=postgresUser,
+                    password=os.environ.get(
+                        "POSTGRES_PASS_"
+                        + (
+                            "SCUIRREL"
+                            if postgresUser == postgresScuirrel
+                            else "ACCORNS"
+                        )
+                    ),
+                    database="vector_db",
+                    table_name="document",
+                    embed_dim=dimensions,
+                )
+            else:
+                vectorStore = LocalVectorStore.from_local(
+                    vectorDB, embed_dim=dimensions
+                )
+
+            indexCache[key] = (
+                vectorStore,
+                VectorStoreIndex.from_vector_store(
+                    vectorStore, embed_model=getEmbedModel(model, dimensions)
+                ),
+            )
+
+        return indexCache[key]
+
+
+# Get the current vector store
+def getVectorStore(postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+    return getCachedIndex(postgresUser, remote, vectorDB)[0]
 
 
 # Get the current vector database index
-def getIndex(postgresUser, remote=remoteAppDB):
-    if remote:
-        vectorStore = PGVectorStore.from_params(
-            host=postgresHost,
-            port=postgresPort,
-            user=postgresUser,
-            password=os.environ.get(
-                "POSTGRES_PASS_"
-                + ("SCUIRREL" if postgresUser == postgresScuirrel else "ACCORNS")
-            ),
-            database="vector_db",
-            table_name="document",
-            embed_dim=1536,  # openai embedding dimension
+def getIndex(postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+    return getCachedIndex(postgresUser, remote, vectorDB)[1]
+
+
+# Version of the files in the vector database, increased by ACCORNS after each change
+def corpusVersion(postgresUser, remoteAppDB=remoteAppDB, vectorDB=vectorDB):
+    with vectorDBConn(postgresUser, remoteAppDB, vectorDB) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT "version" FROM "corpus"')
+        return cursor.fetchone()[0]
+
+
+# Embedding model and dimensions of the chunks in the vector database
+def corpusEmbedding(postgresUser, remoteAppDB=remoteAppDB, vectorDB=vectorDB):
+    with vectorDBConn(postgresUser, remoteAppDB, vectorDB) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT "embedModel", "embedDim" FROM "corpus"')
+        return tuple(cursor.fetchone())
+
+
+# The corpus embedding is checked at most every checkInterval seconds per backend
+embeddingChecks = {}
+
+
+def currentEmbedding(postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+    key = (postgresUser, "postgres") if remote else (postgresUser, vectorDB)
+    checked, embedding = embeddingChecks.get(key, (0, None))
+    if time.monotonic() - checked >= embedCheckInterval:
+        embedding = corpusEmbedding(postgresUser, remote, vectorDB)
+        embeddingChecks[key] = (time.monotonic(), embedding)
+    return embedding
+
+
+# OpenAI LLM of a role, shared by all sessions. Without an [LLM.<role>] section the
+# gptModel is used with the default parameters
+llms = {}
+
+
+def getLLM(role, **kwargs):
+    key = (role, *sorted(kwargs.items()))
+    if key not in llms:
+        llms[key] = OpenAI(**{"model": gptModel, **llmRoleParams[role], **kwargs})
+    return llms[key]
+
+
+# OpenAI embedding model, shared by all sessions. Only the text-embedding-3 models
+# can return shortened embeddings
+embedModels = {}
+
+
+def getEmbedModel(model=embedModelName, dimensions=embedDim, **kwargs):
+    key = (model, dimensions, *sorted(kwargs.items()))
+    if key not in embedModels:
+        embedModels[key] = OpenAIEmbedding(
+            model=model,
+            dimensions=None if model == legacyEmbedding[0] else dimensions,
+            **kwargs,
         )
-        return VectorStoreIndex.from_vector_store(vectorStore)
-    else:
-        return VectorStoreIndex.from_vector_store(
-            DuckDBVectorStore.from_local(vectorDB)
+    return embedModels[key]
+
+
+# Increase the corpus version (in the transaction that adds or deletes a file)
+def bumpCorpusVersion(cursor, remoteAppDB=remoteAppDB):
+    executeQuery(
+        cursor,
+        'UPDATE "corpus" SET "version" = "version" + 1, "modified" = ?',
+        (dt(),),
+        remoteAppDB=remoteAppDB,
+    )
+
+
+# MemoryIndex per postgres user and backend, shared by all sessions
+memoryIndexes = {}
+
+
+def getMemoryIndex(postgresUser, remote=remoteAppDB, vectorDB=vectorDB):
+    key = (postgresUser, "postgres") if remote else (postgresUser, vectorDB)
+    with indexCacheLock:
+        if key not in memoryIndexes:
+            memoryIndexes[key] = MemoryIndex(postgresUser, remote, vectorDB)
+        return memoryIndexes[key]
+
+
+# Retriever for the chat: the in-memory index if enabled, otherwise the vector store.
+# Only the chunks of the files with the given fIDs are searched (all if None)
+def getRetriever(postgresUser, remote=remoteAppDB, vectorDB=vectorDB, fIDs=None):
+    if memoryIndexEnabled:
+        return MemoryRetriever(
+            getMemoryIndex(postgresUser, remote, vectorDB), fIDs=fIDs
+        )
+    return getIndex(postgresUser, remote, vectorDB).as_retriever(
+        filters=fileFilters(fIDs)
+    )
+
+
+# fIDs of the files linked to a topic, None if there are none (search all files)
+def topicFiles(postgresUser, tID, remoteAppDB=remoteAppDB):
+    with appDBConn(postgresUser, remoteAppDB) as conn:
+        cursor = conn.cursor()
+        executeQuery(
+            cursor,
+            'SELECT "fID" FROM "topic_file" WHERE "tID" = ?',
+            (int(tID),),
+            remoteAppDB=remoteAppDB,
         )
+        return [x[0] for x in cursor.fetchall()] or None
+
+
+# Vector store filter on the chunks of files (None if all files are searched)
+def fileFilters(fIDs):
+    if not fIDs:
+        return None
+    return MetadataFilters(
+        filters=[
+            MetadataFilter(
+                key="fID", value=[int(x) for x in fIDs], operator=FilterOperator.IN
+            )
+        ]
+    )
+
+
+# fIDs of a fileFilters filter (None for any other filter)
+def filterFileIDs(filters):
+    if len(filters.filters) != 1:
+        return None
+    filter_ = filters.filters[0]
+    if (
+        isinstance(filter_, MetadataFilter)
+        and filter_.key == "fID"
+        and filter_.operator == FilterOperator.IN
+    ):
+        return filter_.value
+    return None
+
+
+# Values of a column fetched with DuckDB's fetchnumpy (NULL values are masked)
+def columnValues(column):
+    return [None if m else x for x, m in zip(column, np.ma.getmaskarray(column))]
+
+
+# Check if a chunk of the vector database has the metadata llama-index needs to
+# rebuild the node (the node content) and an embedding
+def usableChunk(metadata, embedding):
+    return (
+        isinstance(metadata, dict)
+        and "_node_content" in metadata
+        and embedding is not None
+    )
+
+
+# Drop all cached vector stores / indexes (after the files in the corpus changed)
+def clearIndexCache():
+    with indexCacheLock:
+        indexCache.clear()
+        embeddingChecks.clear()
+
+
+# Validate structured LLM output locally. Takes the response of an engine with an
+# output_cls (already parsed by the LLM function call) or the raw JSON text
+def parseStructured(response, outputCls):
+    output = getattr(response, "response", response)
+    if isinstance(output, outputCls):
+        return output
+    return outputCls.model_validate_json(str(output))
+
+
+# Keep track of how often structured LLM output failed to parse per role. Each retry
+# is an extra LLM call
+parseStats = {}
+
+
+def recordParse(role, failures, retries):
+    stats = parseStats.setdefault(
+        role, {"requests": 0, "parseFailures": 0, "retries": 0}
+    )
+    stats["requests"] += 1
+    stats["parseFailures"] += failures
+    stats["retries"] += retries
+    print(
+        f"{role} output: {failures} parse failures, {retries} retries this request "
+        f"({stats['parseFailures']} failures, {stats['retries']} retries "
+        f"in {stats['requests']} requests)"
+    )
+
+
+# Rough estimate of the tokens used by LLM calls sending the texts (~4 characters per token)
+def estimateTokens(*texts, calls=1):
+    return calls * (sum(len(x) for x in texts) // 4 + llmCallTokens)
 
 
 # Execute a query on the accorns database
@@ -250,15 +1220,13 @@ def pandasQuery(conn, query, params=()):
 # Check if the postgres scuirrel database is available when remoteAppDB is set to True
 def checkRemoteDB(postgresUser):
     try:
-        conn = appDBConn(postgresUser)
-        cursor = conn.cursor()
-        _ = executeQuery(cursor, 'SELECT 1 FROM "session"')
-        conn.close()
+        with appDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = executeQuery(cursor, 'SELECT 1 FROM "session"')
 
-        conn = vectorDBConn(postgresUser)
-        cursor = conn.cursor()
-        _ = executeQuery(cursor, 'SELECT 1 FROM "file"')
-        conn.close()
+        with vectorDBConn(postgresUser) as conn:
+            cursor = conn.cursor()
+            _ = executeQuery(cursor, 'SELECT 1 FROM "file"')
 
         return "Connections to postgres accorns and vector database successful"
 
@@ -0,0 +1,91 @@
+# *************************************************
+# ----------- BENCHMARK CONVERSATION LOG -----------
+# *************************************************
+
+# Compares the append-only Conversation log of SCUIRREL with the previous
+# pandas-based implementation (copied below) for appending messages, adding the
+# evaluation and exporting the rows that are inserted by endDiscussion
+#
+# Run the benchmark from the root folder with the following command:
+#   python -m tests.benchmark_conversation
+
+from SCUIRREL.scuirrel_conversation import Conversation
+import shared.shared as shared
+
+import pandas as pd
+import timeit
+import tracemalloc
+
+order = ["cID", "isBot", "timeStamp", "content", "pCode", "pMessage"]
+
+
+# The pandas-based Conversation before it was replaced
+class PandasConversation:
+    def __init__(self):
+        self.id = 0
+        columns = {
+            "id": int,
+            "cID": int,
+            "isBot": int,
+            "timeStamp": str,
+            "content": str,
+            "pCode": str,
+            "pMessage": str,
+        }
+        self.messages = pd.DataFrame(columns=columns.keys()).astype(columns)
+
+    def add_message(
+        self, cID, isBot, content, pCode=None, pMessage=None, timeStamp=None
+    ):
+        timeStamp = timeStamp if timeStamp else shared.dt()
+        self.messages = pd.concat(
+            [
+                self.messages,
+                pd.DataFrame.from_dict(
+                    {
+                        "id": [self.id],
+                        "cID": [cID],
+                        "timeStamp": [timeStamp],
+                        "isBot": [isBot],
+                        "content": [content],
+                        "pCode": [pCode],
+                        "pMessage": [pMessage],
+                    }
+                ),
+            ],
+            ignore_index=True,
+        )
+        self.id += 1
+
+    def addEval(self, score, comment):
+        self.messages.at[self.messages.index[-1], "pCode"] = score
+        self.messages.at[self.messages.index[-1], "pMessage"] = comment
+
+    def astuple(self, order=None):
+        out = self.messages.drop(columns=["id"])
+        if order:
+            out = out[order]
+        return [tuple(x) for x in out.to_numpy()]
+
+
+# Simulate a discussion of n student / bot turns and export it
+def discussion(cls, n):
+    msg = cls()
+    for i in range(n):
+        msg.add_message(cID=1, isBot=0, content=f"Student message {i}")
+        msg.addEval(3, "Evaluation of the student message")
+        msg.add_message(cID=1, isBot=1, content=f"Bot message {i}")
+    return msg.astuple(order)
+
+
+if __name__ == "__main__":
+    print(f"{'turns':>6} {'class':>20} {'time (ms)':>10} {'peak memory (kB)':>17}")
+    for n in [10, 100, 500]:
+        for cls in [PandasConversation, Conversation]:
+            repeat = 3 if cls is PandasConversation else 20
+            t = min(timeit.repeat(lambda: discussion(cls, n), number=1, repeat=repeat))
+            tracemalloc.start()
+            _ = discussion(cls, n)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{n:>6} {cls.__name__:>20} {t * 1000:>10.2f} {peak / 1024:>17.1f}")
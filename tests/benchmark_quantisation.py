@@ -0,0 +1,81 @@
+# *****************************************************
+# ------------ BENCHMARK QUANTISED EMBEDDINGS ------------
+# *****************************************************
+
+# Compares the float32 embeddings of the in-memory index (see shared.MemoryIndex) with
+# float16 and int8 (per vector scale) embeddings, with and without re-ranking the best
+# candidates using the float32 embeddings. The embeddings of the vector database from
+# shared_config.toml are used (random vectors if it is empty or with the --random
+# option). For each precision the memory, mean query latency and recall@k (compared to
+# the float32 search) are reported
+#
+# Run the benchmark from the root folder with the following command (optionally with
+# --random and the number of random vectors, e.g. --random 100000):
+#   python -m tests.benchmark_quantisation
+
+import shared.shared as shared
+
+import sys
+import time
+import numpy as np
+
+k = 10
+nQueries = 50
+rerank = [0, 50, 200]
+
+
+# Normalised embeddings of the vector database, or n random ones
+def getEmbeddings(rng, random, n):
+    if not random:
+        embeddings, _, _, _ = shared.MemoryIndex(shared.postgresScuirrel).fetch()
+        if len(embeddings) > k:
+            return embeddings, "vector database"
+
+    embeddings = rng.normal(size=(n, shared.embedDim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, "random"
+
+
+# Indices of the top k results (after re-ranking n candidates) and the query time in ms
+def search(matrix, scale, full, query, n):
+    start = time.perf_counter()
+    scores = shared.quantisedScores(matrix, scale, query)
+    top = np.argpartition(-scores, max(k, n) - 1)[: max(k, n)]
+    if n > 0:
+        scores[top] = full[top] @ query
+    top = top[np.argsort(-scores[top])][:k]
+    return top, (time.perf_counter() - start) * 1000
+
+
+if __name__ == "__main__":
+    random = "--random" in sys.argv
+    sizes = [int(x) for x in sys.argv[1:] if x.isdigit()] or [100000]
+    rng = np.random.default_rng(42)
+    embeddings, source = getEmbeddings(rng, random, sizes[0])
+
+    # Query with slightly perturbed stored embeddings
+    queries = []
+    for i in rng.choice(len(embeddings), nQueries, replace=len(embeddings) < nQueries):
+        query = embeddings[i] + rng.normal(scale=0.02, size=shared.embedDim)
+        queries.append((query / np.linalg.norm(query)).astype(np.float32))
+    exact = [set(search(embeddings, None, None, x, 0)[0]) for x in queries]
+
+    print(f"{len(embeddings)} embeddings ({source})")
+    print(
+        f"{'precision':>10} {'rerank':>7} {'memory (MB)':>12} {'query (ms)':>11} "
+        f"{'recall@' + str(k):>10}"
+    )
+    for precision in ["float32", "float16", "int8"]:
+        matrix, scale = shared.quantise(embeddings, precision)
+        memory = (matrix.nbytes + (scale.nbytes if scale is not None else 0)) / 1e6
+        for n in rerank if precision != "float32" else [0]:
+            n = min(n, len(embeddings))
+            recall, times = [], []
+            for query, expected in zip(queries, exact):
+                top, t = search(matrix, scale, embeddings, query, n)
+                times.append(t)
+                recall.append(len(expected & set(top)) / k)
+            print(
+                f"{precision:>10} {n:>7} {memory:>12.1f} {np.mean(times):>11.2f} "
+                f"{np.mean(recall):>10.3f}"
+            )
@@ -0,0 +1,118 @@
+# *************************************************
+# ------------ BENCHMARK LOCAL VECTOR DB ------------
+# *************************************************
+
+# Compares the exact (full scan) cosine search that the local DuckDB vector store used
+# before with the HNSW index from the vss extension. Random vectors (spread over nFiles
+# files) are added to a temporary database and for each size the recall@k of the index
+# (compared to the exact search) and the mean query latency of both searches are
+# reported. This is done for all vectors and for the vectors of a few files (the topic
+# files filter), for which the number of queries returning fewer than k rows is counted
+#
+# Run the benchmark from the root folder with the following command (optionally with
+# the number of vectors to test, e.g. 10000 100000):
+#   python -m tests.benchmark_vectordb
+
+import shared.shared as shared
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+dim = shared.embedDim
+k = 10
+nQueries = 20
+nFiles = 100
+filterFiles = 5  # Files searched by the filtered queries
+
+
+# Add n random vectors of random files to a new table, as a FLOAT[] (old) and
+# FLOAT[dim] column
+def createTable(conn, n, rng):
+    vectors = rng.normal(size=(n, dim)).astype(np.float32)
+    df = pd.DataFrame(
+        {
+            "node_id": [str(i) for i in range(n)],
+            "fID": rng.integers(1, nFiles + 1, size=n),
+            "embedding": list(vectors),
+        }
+    )
+    conn.register("df", df)
+    conn.execute(
+        'CREATE TABLE documents AS SELECT node_id, "fID", '
+        "embedding::FLOAT[] AS embedding_list, "
+        f"embedding::FLOAT[{dim}] AS embedding FROM df"
+    )
+    conn.unregister("df")
+    return vectors
+
+
+# Return the node_ids of the top k results and the query time in ms
+def search(conn, query, vector, where=""):
+    start = time.perf_counter()
+    ids = [
+        x[0] for x in conn.execute(query.format(vector=vector, where=where)).fetchall()
+    ]
+    return ids, (time.perf_counter() - start) * 1000
+
+
+exactQuery = (
+    "SELECT node_id FROM documents {where} "
+    "ORDER BY list_cosine_similarity(embedding_list, {vector}) DESC "
+    f"LIMIT {k}"
+)
+hnswQuery = (
+    "SELECT node_id FROM documents {where} "
+    "ORDER BY array_cosine_distance(embedding, {vector}::FLOAT[" + str(dim) + "]) "
+    f"LIMIT {k}"
+)
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    rng = np.random.default_rng(42)
+
+    print(
+        f"{'vectors':>8} {'filter':>7} {'build (s)':>10} {'exact (ms)':>11} "
+        f"{'hnsw (ms)':>10} {'recall@' + str(k):>10} {'< k rows':>9}"
+    )
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            conn = shared.duckdbConnect(os.path.join(folder, "benchmark.duckdb"))
+            vectors = createTable(conn, n, rng)
+
+            start = time.perf_counter()
+            conn.execute(
+                'CREATE INDEX "documents_embedding" ON "documents" USING HNSW ("embedding") '
+                f"WITH (metric = 'cosine', M = {shared.hnswM}, "
+                f"ef_construction = {shared.hnswEfConstruction})"
+            )
+            build = time.perf_counter() - start
+
+            # Query with slightly perturbed stored vectors, for all files and for a
+            # few files like the retrieval of a topic with files
+            for filtered in [False, True]:
+                recall, exactTime, hnswTime, short = [], [], [], 0
+                for i in rng.choice(n, nQueries, replace=False):
+                    vector = (vectors[i] + rng.normal(scale=0.1, size=dim)).tolist()
+                    fIDs = rng.choice(nFiles, filterFiles, replace=False) + 1
+                    where = (
+                        f'WHERE "fID" IN ({", ".join(str(x) for x in fIDs)})'
+                        if filtered
+                        else ""
+                    )
+                    exact, t = search(conn, exactQuery, vector, where)
+                    exactTime.append(t)
+                    hnsw, t = search(conn, hnswQuery, vector, where)
+                    hnswTime.append(t)
+                    recall.append(len(set(exact) & set(hnsw)) / len(exact))
+                    short += len(hnsw) < len(exact)
+
+                print(
+                    f"{n:>8} {'files' if filtered else 'none':>7} {build:>10.1f} "
+                    f"{np.mean(exactTime):>11.2f} {np.mean(hnswTime):>10.2f} "
+                    f"{np.mean(recall):>10.3f} {short:>9}"
+                )
+            conn.close()